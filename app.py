@@ -1,12 +1,11 @@
-from scenery_app.extensions import app, db
+from scenery_app.extensions import app
 from scenery_app.main.routes import main
 from scenery_app.auth.routes import auth
+from scenery_app.api.routes import api
 
 app.register_blueprint(main)
 app.register_blueprint(auth)
-
-with app.app_context():
-    db.create_all()
+app.register_blueprint(api)
 
 if __name__ == "__main__":
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,21 @@
+"""gunicorn settings: `gunicorn app:app` picks this file up automatically."""
+import multiprocessing
+import os
+
+bind = os.getenv('GUNICORN_BIND', '127.0.0.1:8000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('GUNICORN_THREADS', 1))
+# Importing the app once in the master saves memory, but then every worker
+# inherits its connection pools; post_fork drops them.
+preload_app = os.getenv('GUNICORN_PRELOAD', '0') == '1'
+
+def post_fork(server, worker):
+    from scenery_app.extensions import app, db
+    from scenery_app.auth import hashing
+    from scenery_app import itinerary, jobs, media
+    db.dispose_engines(app)
+    hashing.shutdown()
+    media.shutdown()
+    itinerary.shutdown()
+    with app.app_context():
+        jobs.shutdown()
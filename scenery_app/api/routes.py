@@ -0,0 +1,535 @@
+"""
+Version 1 of the JSON API, for clients that would otherwise make one
+form round trip per object.
+
+Reads are column-only queries serialized straight from the result rows,
+paged by keyset, and `?fields=id,title` narrows both the SELECT and the
+response. Writes take a batch, {"items": [...]}, validate all of it up
+front and apply it in a single transaction, keeping facet counts, user
+stats and cached fragments in step and queueing search indexing just
+like the form routes do.
+"""
+from collections import Counter, defaultdict
+from datetime import date
+
+from flask import Blueprint, current_app, jsonify, request
+from flask_login import current_user
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import HTTPException
+
+from scenery_app.extensions import db
+from scenery_app.models import (Location, List, Entry, Landscape,
+    location_entry_table, favorite_locations_table, visitlist_locations_table)
+from scenery_app.pagination import keyset_page, page_size
+from scenery_app.routing import read_only
+from scenery_app.choices import list_choices, entry_choices
+from scenery_app.search import index_later
+from scenery_app.facets import adjust_counts, facet_values
+from scenery_app.geo import position_hash, set_position
+from scenery_app.recommendations import refresh_later
+from scenery_app.user_stats import links_changed, favorited_location_changed
+from scenery_app.fragment_cache import (bump_location_version,
+    bump_list_locations, bump_entry_locations)
+
+api = Blueprint('api', __name__, url_prefix='/api/v1')
+
+COLLECTIONS = {
+    'favorites': favorite_locations_table,
+    'visitlist': visitlist_locations_table,
+}
+
+###########################
+# Errors
+###########################
+
+class APIError(Exception):
+    """An error reported to the client as {"error": ..., "errors": ...}."""
+    def __init__(self, status, message, errors=None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.errors = errors
+
+@api.errorhandler(APIError)
+def handle_api_error(error):
+    body = {'error': error.message}
+    if error.errors is not None:
+        body['errors'] = error.errors
+    return jsonify(body), error.status
+
+@api.errorhandler(HTTPException)
+def handle_http_error(error):
+    return jsonify(error=error.description), error.code
+
+@api.before_request
+def check_write():
+    """Writes need a logged in user and a JSON body. Requiring JSON also
+    keeps plain cross-site form posts out, as browsers can't send it."""
+    if request.method in ('GET', 'HEAD'):
+        return
+    if not current_user.is_authenticated:
+        raise APIError(401, 'Login required.')
+    if not request.is_json:
+        raise APIError(415, 'Expected an application/json body.')
+
+###########################
+# Serialization
+###########################
+
+LOCATION_FIELDS = {
+    'id': Location.id,
+    'title': Location.title,
+    'visited_date': Location.visited_date,
+    'list_id': Location.list_id,
+    'landscape': Location.landscape,
+    'latitude': Location.latitude,
+    'longitude': Location.longitude,
+}
+LIST_FIELDS = {
+    'id': List.id,
+    'name': List.name,
+    'description': List.description,
+}
+ENTRY_FIELDS = {
+    'id': Entry.id,
+    'name': Entry.name,
+}
+
+def _json_value(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, Landscape):
+        return value.name
+    return value
+
+def selected_fields(available, extra=()):
+    """The field names requested with ?fields=, defaulting to all of them."""
+    known = list(available) + list(extra)
+    requested = request.args.get('fields')
+    if not requested:
+        return known
+    names = [name.strip() for name in requested.split(',') if name.strip()]
+    unknown = [name for name in names if name not in known]
+    if unknown:
+        raise APIError(400, f'Unknown fields: {", ".join(unknown)}.')
+    return names
+
+def _id_list(value, name):
+    if (not isinstance(value, list) or
+            not all(isinstance(id, int) and not isinstance(id, bool)
+                for id in value)):
+        raise APIError(400, f'"{name}" must be a list of integer ids.')
+    if len(value) > current_app.config['API_MAX_BATCH']:
+        raise APIError(413, f'At most {current_app.config["API_MAX_BATCH"]} '
+            f'ids per request.')
+    return value
+
+def read_page(model, fields, names):
+    """
+    Return (rows, next_after) for one page of `model`, selecting only the
+    requested columns (plus the id, which the cursor needs).
+    """
+    columns = [fields[name] for name in names if name in fields]
+    if fields['id'] not in columns:
+        columns.insert(0, fields['id'])
+    query = db.session.query(*columns)
+    ids = request.args.get('ids')
+    if ids:
+        try:
+            ids = [int(id) for id in ids.split(',')]
+        except ValueError:
+            raise APIError(400, '"ids" must be comma separated integers.')
+        query = query.filter(model.id.in_(_id_list(ids, 'ids')))
+    return keyset_page(query, model.id,
+        after=request.args.get('after', type=int), limit=page_size())
+
+def serialize(rows, names, extra=None):
+    """Turn result rows into dicts of the requested fields. `extra` maps
+    computed field names to {id: value}."""
+    extra = extra or {}
+    return [{name: extra[name].get(row.id, []) if name in extra
+            else _json_value(getattr(row, name))
+        for name in names} for row in rows]
+
+def entry_ids_for(location_ids):
+    """{location_id: [entry_id, ...]} for a page of locations, in one query."""
+    entry_ids = defaultdict(list)
+    if location_ids:
+        rows = (db.session.query(location_entry_table.c.location_id,
+                location_entry_table.c.entry_id)
+            .filter(location_entry_table.c.location_id.in_(location_ids))
+            .order_by(location_entry_table.c.entry_id))
+        for location_id, entry_id in rows:
+            entry_ids[location_id].append(entry_id)
+    return entry_ids
+
+###########################
+# Validation
+###########################
+
+def read_items():
+    """The list of objects in a batch request body."""
+    body = request.get_json(silent=True)
+    items = body.get('items') if isinstance(body, dict) else None
+    if (not isinstance(items, list) or
+            not all(isinstance(item, dict) for item in items)):
+        raise APIError(400, 'Expected a body of the form {"items": [...]}.')
+    if len(items) > current_app.config['API_MAX_BATCH']:
+        raise APIError(413, f'At most {current_app.config["API_MAX_BATCH"]} '
+            f'items per request.')
+    return items
+
+def _text(item, name, errors, min=3, max=80, required=True):
+    value = item.get(name)
+    if value is None and not required:
+        return None
+    if not isinstance(value, str) or not min <= len(value.strip()) <= max:
+        errors[name] = f'Must be between {min} and {max} characters long.'
+    return value
+
+def _date(item, name, errors):
+    try:
+        return date.fromisoformat(item.get(name))
+    except (TypeError, ValueError):
+        errors[name] = 'Must be a YYYY-mm-dd date.'
+
+def _choice(item, name, errors):
+    value = item.get(name)
+    if value not in Landscape.__members__:
+        errors[name] = 'Not a valid choice.'
+        return None
+    return Landscape[value]
+
+def _coordinates(item, errors):
+    latitude, longitude = item.get('latitude'), item.get('longitude')
+    if latitude is None and longitude is None:
+        return None, None
+    for name, value, limit in (('latitude', latitude, 90),
+            ('longitude', longitude, 180)):
+        if (not isinstance(value, (int, float)) or isinstance(value, bool)
+                or not -limit <= value <= limit):
+            errors[name] = f'Must be a number between -{limit} and {limit}.'
+    return latitude, longitude
+
+def _ref(item, name, errors):
+    value = item.get(name)
+    if not isinstance(value, int) or isinstance(value, bool):
+        errors[name] = 'Must be an integer id.'
+    return value
+
+def _refs(item, name, errors):
+    value = item.get(name, [])
+    if (not isinstance(value, list) or
+            not all(isinstance(id, int) and not isinstance(id, bool)
+                for id in value)):
+        errors[name] = 'Must be a list of integer ids.'
+        return []
+    return list(dict.fromkeys(value))
+
+def validate_items(items, validator, partial):
+    """
+    Run `validator(item, errors)` over a batch, returning a list of
+    {field: value} dicts. With `partial`, only the fields present in an
+    item are validated and each item must name an existing `id`.
+    Raises a 422 listing every item's errors if any are invalid.
+    """
+    all_values, all_errors = [], []
+    seen = set()
+    for index, item in enumerate(items):
+        errors = {}
+        fields = set(item) if partial else None
+        values = validator(item, errors, fields)
+        if partial:
+            values['id'] = _ref(item, 'id', errors)
+            if values['id'] in seen:
+                errors['id'] = 'Duplicate id in batch.'
+            seen.add(values['id'])
+        if errors:
+            all_errors.append({'index': index, 'errors': errors})
+        all_values.append(values)
+    if all_errors:
+        raise APIError(422, 'Invalid items.', all_errors)
+    return all_values
+
+def check_refs(values, name, model, error):
+    """Make sure every id under `name` refers to an existing `model` row,
+    looking them all up in one query."""
+    wanted = set()
+    for item in values:
+        refs = item.get(name)
+        if refs is not None:
+            wanted.update(refs if isinstance(refs, list) else [refs])
+    found = {id for (id,) in
+        db.session.query(model.id).filter(model.id.in_(wanted))} if wanted else set()
+    errors = []
+    for index, item in enumerate(values):
+        refs = item.get(name)
+        if refs is None:
+            continue
+        if set(refs if isinstance(refs, list) else [refs]) - found:
+            errors.append({'index': index, 'errors': {name: error}})
+    if errors:
+        raise APIError(422, 'Invalid items.', errors)
+
+def load_existing(model, values):
+    """{id: object} for the items of an update batch, in one query."""
+    ids = [item['id'] for item in values]
+    existing = {obj.id: obj for obj in model.query.filter(model.id.in_(ids))}
+    missing = [{'index': index, 'errors': {'id': 'No such object.'}}
+        for index, id in enumerate(ids) if id not in existing]
+    if missing:
+        raise APIError(404, 'Unknown ids.', missing)
+    return existing
+
+def location_values(item, errors, fields=None):
+    values = {}
+    if fields is None or 'title' in fields:
+        values['title'] = _text(item, 'title', errors)
+    if fields is None or 'visited_date' in fields:
+        values['visited_date'] = _date(item, 'visited_date', errors)
+    if fields is None or 'list_id' in fields:
+        values['list_id'] = _ref(item, 'list_id', errors)
+    if fields is None or 'landscape' in fields:
+        values['landscape'] = _choice(item, 'landscape', errors)
+    if fields is None or 'entry_ids' in fields:
+        values['entry_ids'] = _refs(item, 'entry_ids', errors)
+    if fields is None or {'latitude', 'longitude'} & fields:
+        # The two coordinates are only ever set together.
+        values['latitude'], values['longitude'] = _coordinates(item, errors)
+    return values
+
+def list_values(item, errors, fields=None):
+    values = {}
+    if fields is None or 'name' in fields:
+        values['name'] = _text(item, 'name', errors)
+    if fields is None or 'description' in fields:
+        values['description'] = _text(item, 'description', errors,
+            min=0, max=10000, required=False)
+    return values
+
+def entry_values(item, errors, fields=None):
+    values = {}
+    if fields is None or 'name' in fields:
+        values['name'] = _text(item, 'name', errors, max=700)
+    return values
+
+###########################
+# Locations
+###########################
+
+@api.route('/locations')
+@read_only
+def get_locations():
+    names = selected_fields(LOCATION_FIELDS, extra=['entry_ids'])
+    rows, next_after = read_page(Location, LOCATION_FIELDS, names)
+    extra = {}
+    if 'entry_ids' in names:
+        extra['entry_ids'] = entry_ids_for([row.id for row in rows])
+    return jsonify(items=serialize(rows, names, extra), next_after=next_after)
+
+def _link_entries(links):
+    if links:
+        db.session.execute(location_entry_table.insert(), links)
+
+@api.route('/locations', methods=['POST'])
+def create_locations():
+    values = validate_items(read_items(), location_values, partial=False)
+    check_refs(values, 'list_id', List, 'No such list.')
+    check_refs(values, 'entry_ids', Entry, 'No such entry.')
+
+    locations = [Location(title=item['title'],
+            visited_date=item['visited_date'], list_id=item['list_id'],
+            landscape=item['landscape'], latitude=item['latitude'],
+            longitude=item['longitude'],
+            geohash=position_hash(item['latitude'], item['longitude']))
+        for item in values]
+    db.session.add_all(locations)
+    db.session.flush()
+    _link_entries([{'location_id': location.id, 'entry_id': entry_id}
+        for location, item in zip(locations, values)
+        for entry_id in item['entry_ids']])
+    index_later('location', [location.id for location in locations])
+    adjust_counts(Counter(key for location in locations
+        for key in facet_values(location.landscape, location.list_id)))
+    # Read the ids before committing expires the objects.
+    created = [{'id': location.id} for location in locations]
+    db.session.commit()
+    return jsonify(items=created), 201
+
+@api.route('/locations', methods=['PATCH'])
+def update_locations():
+    values = validate_items(read_items(), location_values, partial=True)
+    existing = load_existing(Location, values)
+    check_refs(values, 'list_id', List, 'No such list.')
+    check_refs(values, 'entry_ids', Entry, 'No such entry.')
+
+    facet_deltas = Counter()
+    for item in values:
+        location = existing[item['id']]
+        facet_deltas.subtract(Counter(
+            facet_values(location.landscape, location.list_id)))
+        before_stats = (location.landscape, location.visited_date)
+        for name in ('title', 'visited_date', 'list_id', 'landscape'):
+            if name in item:
+                setattr(location, name, item[name])
+        if 'latitude' in item:
+            set_position(location, item['latitude'], item['longitude'])
+        facet_deltas.update(facet_values(location.landscape, location.list_id))
+        favorited_location_changed(before_stats, location)
+        bump_location_version(location)
+
+    replaced = [item for item in values if 'entry_ids' in item]
+    if replaced:
+        db.session.execute(location_entry_table.delete().where(
+            location_entry_table.c.location_id.in_(
+                [item['id'] for item in replaced])))
+        _link_entries([{'location_id': item['id'], 'entry_id': entry_id}
+            for item in replaced for entry_id in item['entry_ids']])
+    index_later('location', [item['id'] for item in values if 'title' in item])
+    refresh_later([item['id'] for item in values
+        if 'landscape' in item or 'entry_ids' in item])
+    adjust_counts(facet_deltas)
+    db.session.commit()
+
+    return jsonify(items=[{'id': item['id']} for item in values])
+
+###########################
+# Lists & entries
+###########################
+
+@api.route('/lists')
+@read_only
+def get_lists():
+    names = selected_fields(LIST_FIELDS)
+    rows, next_after = read_page(List, LIST_FIELDS, names)
+    return jsonify(items=serialize(rows, names), next_after=next_after)
+
+@api.route('/lists', methods=['POST'])
+def create_lists():
+    values = validate_items(read_items(), list_values, partial=False)
+    lists = [List(**item) for item in values]
+    db.session.add_all(lists)
+    db.session.flush()
+    created = [{'id': list.id} for list in lists]
+    db.session.commit()
+    list_choices.invalidate()
+    return jsonify(items=created), 201
+
+@api.route('/lists', methods=['PATCH'])
+def update_lists():
+    values = validate_items(read_items(), list_values, partial=True)
+    existing = load_existing(List, values)
+    for item in values:
+        for name in ('name', 'description'):
+            if name in item:
+                setattr(existing[item['id']], name, item[name])
+    # List names and descriptions are shown on the location pages.
+    bump_list_locations([item['id'] for item in values])
+    db.session.commit()
+    list_choices.invalidate()
+    return jsonify(items=[{'id': item['id']} for item in values])
+
+@api.route('/entries')
+@read_only
+def get_entries():
+    names = selected_fields(ENTRY_FIELDS)
+    rows, next_after = read_page(Entry, ENTRY_FIELDS, names)
+    return jsonify(items=serialize(rows, names), next_after=next_after)
+
+@api.route('/entries', methods=['POST'])
+def create_entries():
+    values = validate_items(read_items(), entry_values, partial=False)
+    entries = [Entry(**item) for item in values]
+    db.session.add_all(entries)
+    db.session.flush()
+    index_later('entry', [entry.id for entry in entries])
+    created = [{'id': entry.id} for entry in entries]
+    db.session.commit()
+    entry_choices.invalidate()
+    return jsonify(items=created), 201
+
+@api.route('/entries', methods=['PATCH'])
+def update_entries():
+    values = validate_items(read_items(), entry_values, partial=True)
+    existing = load_existing(Entry, values)
+    renamed = [item for item in values if 'name' in item]
+    for item in renamed:
+        existing[item['id']].name = item['name']
+    index_later('entry', [item['id'] for item in renamed])
+    bump_entry_locations([item['id'] for item in renamed])
+    db.session.commit()
+    entry_choices.invalidate()
+    return jsonify(items=[{'id': item['id']} for item in values])
+
+###########################
+# Favorites & visitlist
+###########################
+
+def _collection(name):
+    table = COLLECTIONS.get(name)
+    if table is None:
+        raise APIError(404, f'Unknown collection {name!r}.')
+    return table
+
+def _location_ids():
+    body = request.get_json(silent=True)
+    ids = _id_list(body.get('location_ids') if isinstance(body, dict)
+        else None, 'location_ids')
+    ids = list(dict.fromkeys(ids))
+    found = {id for (id,) in
+        db.session.query(Location.id).filter(Location.id.in_(ids))}
+    unknown = [id for id in ids if id not in found]
+    if unknown:
+        raise APIError(404, 'Unknown locations.', {'location_ids': unknown})
+    return ids
+
+def _present(table, location_ids):
+    return {id for (id,) in db.session.query(table.c.location_id).filter(
+        table.c.user_id == current_user.id,
+        table.c.location_id.in_(location_ids))}
+
+@api.route('/<collection>', methods=['POST'])
+def add_to_collection(collection):
+    """Add many locations to one of the current user's collections.
+    Locations already in it are left alone."""
+    table = _collection(collection)
+    ids = _location_ids()
+    present = _present(table, ids)
+    links = [{'user_id': current_user.id, 'location_id': id}
+        for id in ids if id not in present]
+    try:
+        if links:
+            # The unique constraint fails here, at the INSERT, if another
+            # request added some of them since _present() looked.
+            db.session.execute(table.insert(), links)
+            links_changed(table, links, 1)
+            if table is favorite_locations_table:
+                refresh_later([link['location_id'] for link in links],
+                    current_user.id)
+        db.session.commit()
+    except IntegrityError:
+        # Nothing was written.
+        db.session.rollback()
+        raise APIError(409, 'The collection changed concurrently, retry.')
+    return jsonify(added=[link['location_id'] for link in links])
+
+@api.route('/<collection>', methods=['DELETE'])
+def remove_from_collection(collection):
+    """Remove many locations from one of the current user's collections."""
+    table = _collection(collection)
+    ids = _location_ids()
+    present = sorted(_present(table, ids))
+    if present:
+        result = db.session.execute(table.delete().where(
+            (table.c.user_id == current_user.id) &
+            table.c.location_id.in_(present)))
+        if result.rowcount != len(present):
+            # Another request removed some of them; don't miscount.
+            db.session.rollback()
+            raise APIError(409, 'The collection changed concurrently, retry.')
+        links_changed(table, [{'user_id': current_user.id, 'location_id': id}
+            for id in present], -1)
+        if table is favorite_locations_table:
+            refresh_later(present, current_user.id)
+    db.session.commit()
+    return jsonify(removed=present)
@@ -0,0 +1,195 @@
+import unittest
+import app
+
+from datetime import date
+from scenery_app.extensions import app, db
+from scenery_app.models import Location, User, Landscape, Entry, List
+from scenery_app.instrumentation import count_queries
+from scenery_app.ratelimit import limiter
+from scenery_app.testing import login, create_user
+from scenery_app.user_stats import user_stats
+
+"""
+Run these tests with the command:
+python -m unittest scenery_app.api.tests
+"""
+
+#################################################
+# Setup
+#################################################
+
+def create_lists():
+    db.session.add_all([List(name='Chile'), List(name='Seychelles')])
+    db.session.commit()
+
+#################################################
+# Tests
+#################################################
+
+class APITests(unittest.TestCase):
+
+    def setUp(self):
+        """Executed prior to each test."""
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['DEBUG'] = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['JOBS_EXECUTOR'] = 'inline'
+        self.app = app.test_client()
+        db.drop_all()
+        db.create_all()
+        limiter.reset()
+        create_user()
+        create_lists()
+
+    def test_batch_create_and_read(self):
+        """Test creating many locations in one call and reading fields."""
+        response = self.app.post('/api/v1/locations', json={'items': []})
+        self.assertEqual(response.status_code, 401)
+
+        login(self.app, 'me1', 'password')
+        response = self.app.post('/api/v1/entries', json={'items': [
+            {'name': 'Hiking'}, {'name': 'Camping'}]})
+        self.assertEqual(response.status_code, 201)
+
+        with count_queries() as counter:
+            response = self.app.post('/api/v1/locations', json={'items': [
+                {'title': f'Park {i}', 'visited_date': '2016-05-17',
+                    'list_id': 1, 'landscape': 'MOUNTAINS',
+                    'entry_ids': [1, 2]}
+                for i in range(20)]})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.get_json()['items']), 20)
+        # One INSERT per location for its id, everything else batched.
+        batched = [statement for statement in counter.statements
+            if not statement.startswith('INSERT INTO location ')]
+        self.assertLess(len(batched), 15)
+        self.assertEqual(Location.query.count(), 20)
+        self.assertEqual(len(Location.query.get(20).entries), 2)
+
+        response = self.app.get(
+            '/api/v1/locations?fields=id,title,entry_ids&per_page=2')
+        data = response.get_json()
+        self.assertEqual(data['items'], [
+            {'id': 1, 'title': 'Park 0', 'entry_ids': [1, 2]},
+            {'id': 2, 'title': 'Park 1', 'entry_ids': [1, 2]},
+        ])
+        self.assertEqual(data['next_after'], 2)
+
+        response = self.app.get('/api/v1/locations?ids=3,4&fields=landscape')
+        self.assertEqual(response.get_json()['items'],
+            [{'landscape': 'MOUNTAINS'}, {'landscape': 'MOUNTAINS'}])
+        response = self.app.get('/api/v1/locations?fields=secret')
+        self.assertEqual(response.status_code, 400)
+
+    def test_batch_validation(self):
+        """Test that one bad item rejects the whole batch."""
+        login(self.app, 'me1', 'password')
+        response = self.app.post('/api/v1/locations', json={'items': [
+            {'title': 'Torres del Paine', 'visited_date': '2016-05-17',
+                'list_id': 1, 'landscape': 'MOUNTAINS'},
+            {'title': 'No', 'visited_date': 'soon', 'list_id': 1,
+                'landscape': 'MOUNTAINS'},
+        ]})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.get_json()['errors'][0]['index'], 1)
+        self.assertEqual(set(response.get_json()['errors'][0]['errors']),
+            {'title', 'visited_date'})
+
+        response = self.app.post('/api/v1/locations', json={'items': [
+            {'title': 'Torres del Paine', 'visited_date': '2016-05-17',
+                'list_id': 99, 'landscape': 'MOUNTAINS'}]})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Location.query.count(), 0)
+
+        response = self.app.post('/api/v1/lists', data='name=Peru')
+        self.assertEqual(response.status_code, 415)
+
+    def test_batch_update(self):
+        """Test updating many rows and keeping derived data in step."""
+        login(self.app, 'me1', 'password')
+        self.app.post('/api/v1/locations', json={'items': [
+            {'title': 'Torres del Paine', 'visited_date': '2016-05-17',
+                'list_id': 1, 'landscape': 'MOUNTAINS'},
+            {'title': 'Anse Source', 'visited_date': '2018-01-02',
+                'list_id': 2, 'landscape': 'COAST'},
+        ]})
+
+        response = self.app.patch('/api/v1/locations', json={'items': [
+            {'id': 1, 'title': 'Grey Glacier', 'landscape': 'GLACIER'},
+            {'id': 2, 'list_id': 1},
+        ]})
+        self.assertEqual(response.status_code, 200)
+        location = Location.query.get(1)
+        self.assertEqual(location.title, 'Grey Glacier')
+        self.assertEqual(location.landscape, Landscape.GLACIER)
+        self.assertEqual(location.visited_date, date(2016, 5, 17))
+        self.assertEqual(location.version, 2)
+        self.assertEqual(Location.query.get(2).list_id, 1)
+
+        facets = self.app.get('/browse.json').get_json()['facets']
+        self.assertEqual(facets['list'], {'1': 2})
+        self.assertEqual(facets['landscape'], {'GLACIER': 1, 'COAST': 1})
+
+        response = self.app.patch('/api/v1/locations', json={'items': [
+            {'id': 2, 'latitude': -4.37, 'longitude': 55.82},
+            {'id': 1, 'latitude': -50.94}]})
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(response.get_json()['errors'][0]['index'], 1)
+        response = self.app.patch('/api/v1/locations', json={'items': [
+            {'id': 2, 'latitude': -4.37, 'longitude': 55.82}]})
+        self.assertEqual(Location.query.get(2).geohash[:5], 'mppxn')
+
+        response = self.app.patch('/api/v1/lists', json={'items': [
+            {'id': 1, 'name': 'Patagonia'}]})
+        self.assertEqual(List.query.get(1).name, 'Patagonia')
+        self.assertEqual(Location.query.get(1).version, 3)
+
+        response = self.app.patch('/api/v1/locations', json={'items': [
+            {'id': 1, 'title': 'Grey Glacier'}, {'id': 99, 'title': 'Nowhere'}]})
+        self.assertEqual(response.status_code, 404)
+
+    def test_batch_favorites(self):
+        """Test adding and removing many favorites at once."""
+        login(self.app, 'me1', 'password')
+        self.app.post('/api/v1/locations', json={'items': [
+            {'title': f'Park {i}', 'visited_date': '2016-05-17',
+                'list_id': 1, 'landscape': 'MOUNTAINS'}
+            for i in range(5)]})
+
+        response = self.app.post('/api/v1/favorites',
+            json={'location_ids': [1, 2, 3]})
+        self.assertEqual(response.get_json(), {'added': [1, 2, 3]})
+        response = self.app.post('/api/v1/favorites',
+            json={'location_ids': [3, 4]})
+        self.assertEqual(response.get_json(), {'added': [4]})
+
+        response = self.app.delete('/api/v1/favorites',
+            json={'location_ids': [1, 5]})
+        self.assertEqual(response.get_json(), {'removed': [1]})
+
+        user = User.query.filter_by(username='me1').one()
+        self.assertEqual([location.id for location in user.favorite_locations],
+            [2, 3, 4])
+        self.assertEqual(user_stats(user.id)['favorites'], 3)
+        self.assertEqual(user_stats(user.id)['landscapes'], {'MOUNTAINS': 3})
+
+        # A favorite added by another request since the check is a
+        # conflict, and nothing is written.
+        from unittest import mock
+        with mock.patch('scenery_app.api.routes._present',
+                return_value=set()):
+            response = self.app.post('/api/v1/favorites',
+                json={'location_ids': [2, 5]})
+        self.assertEqual(response.status_code, 409)
+        user = User.query.filter_by(username='me1').one()
+        self.assertEqual([location.id for location in user.favorite_locations],
+            [2, 3, 4])
+        self.assertEqual(user_stats(user.id)['favorites'], 3)
+
+        response = self.app.post('/api/v1/favorites',
+            json={'location_ids': [42]})
+        self.assertEqual(response.status_code, 404)
+        response = self.app.post('/api/v1/wishlist',
+            json={'location_ids': [1]})
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,227 @@
+"""
+Fingerprinted static assets.
+
+`flask assets build` copies everything under scenery_app/static into
+ASSETS_ROOT with the content's hash in the name (bootstrap-2.css becomes
+bootstrap-2.1f0c9e2ab34d.css), minifying CSS and JavaScript on the way
+and writing .gz (and .br, if the brotli package is installed) next to
+each text file. manifest.json maps the original names to the built ones.
+
+Templates link to assets with `asset_url('bootstrap-2.css')`. Files in
+the manifest are served from /assets/, picking the smallest encoding the
+client accepts, with Cache-Control: immutable: a changed file gets a new
+name, so nothing ever needs revalidating. Without a manifest (e.g. in
+development) asset_url falls back to /static.
+
+Builds only add files, so pages cached before a deploy can still load
+the assets they name.
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import re
+import tempfile
+import threading
+
+import click
+from flask import abort, current_app, request, send_file, url_for
+from flask.cli import AppGroup
+
+try:
+    import brotli
+except ImportError:  # optional: only .gz variants are built without it
+    brotli = None
+
+HASH_LENGTH = 12
+
+MANIFEST = 'manifest.json'
+
+# Types worth precompressing; images and fonts already are.
+COMPRESSIBLE = ('.css', '.js', '.json', '.map', '.svg', '.txt', '.xml')
+
+###########################
+# Minifying
+###########################
+
+_CSS_STRINGS_AND_COMMENTS = re.compile(
+    r'''("(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*')|(/\*.*?\*/)''', re.S)
+_CSS_PUNCTUATION = re.compile(r'\s*([{};,])\s*')
+
+def _squeeze(css):
+    css = _CSS_PUNCTUATION.sub(r'\1', re.sub(r'\s+', ' ', css))
+    return css.replace(';}', '}')
+
+def minify_css(text):
+    """Drop comments (except /*! licences */) and needless whitespace,
+    leaving strings alone."""
+    parts = []
+    pending = ''
+    position = 0
+    for match in _CSS_STRINGS_AND_COMMENTS.finditer(text):
+        pending += text[position:match.start()]
+        position = match.end()
+        string, comment = match.groups()
+        if string or comment.startswith('/*!'):
+            parts += [_squeeze(pending), match.group()]
+            pending = ''
+    parts.append(_squeeze(pending + text[position:]))
+    return ''.join(parts).strip()
+
+def minify_js(text):
+    """
+    Remove indentation, blank lines and whole-line // comments. Lines are
+    kept, so semicolon insertion is unaffected; files with template
+    literals or continued strings, whose lines may be inside a string,
+    are left as they are.
+    """
+    if '`' in text or re.search(r'\\\n', text):
+        return text
+    lines = (line.strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines
+        if line and not line.startswith('//')) + '\n'
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+###########################
+# Building
+###########################
+
+def _compressors():
+    yield 'gzip', '.gz', lambda data: gzip.compress(data, 9, mtime=0)
+    if brotli is not None:
+        yield 'br', '.br', lambda data: brotli.compress(data, quality=11)
+
+def _write(path, data):
+    """Write `path` atomically, so a running server never reads half."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(path))
+    with os.fdopen(handle, 'wb') as file:
+        file.write(data)
+    # mkstemp's files are private; the front-end server may serve these.
+    os.chmod(temporary, 0o644)
+    os.replace(temporary, path)
+
+def build(source, target):
+    """Build every file under `source` into `target`; returns the manifest."""
+    files = {}
+    for directory, subdirectories, names in os.walk(source):
+        subdirectories.sort()
+        for name in sorted(names):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(directory, name)
+            logical = os.path.relpath(path, source).replace(os.sep, '/')
+            stem, extension = os.path.splitext(logical)
+            with open(path, 'rb') as file:
+                data = file.read()
+            minify = MINIFIERS.get(extension.lower())
+            if minify is not None:
+                data = minify(data.decode('utf-8')).encode('utf-8')
+            digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+            built = f'{stem}.{digest}{extension}'
+            _write(os.path.join(target, built), data)
+
+            encodings = []
+            if extension.lower() in COMPRESSIBLE:
+                for encoding, suffix, compress in _compressors():
+                    compressed = compress(data)
+                    if len(compressed) < len(data):
+                        _write(os.path.join(target, built + suffix), compressed)
+                        encodings.append(encoding)
+            files[logical] = {'path': built, 'encodings': encodings}
+
+    version = hashlib.sha256(json.dumps(files, sort_keys=True).encode()
+        ).hexdigest()[:HASH_LENGTH]
+    manifest = {'version': version, 'files': files}
+    _write(os.path.join(target, MANIFEST),
+        json.dumps(manifest, indent=2, sort_keys=True).encode())
+    return manifest
+
+###########################
+# Manifest
+###########################
+
+_manifests = {}
+_lock = threading.Lock()
+
+def load_manifest():
+    """The manifest in ASSETS_ROOT, or None if nothing has been built.
+    Read once per process, or on every call in debug mode."""
+    root = current_app.config['ASSETS_ROOT']
+    if root in _manifests and not current_app.debug:
+        return _manifests[root]
+    try:
+        with open(os.path.join(root, MANIFEST)) as file:
+            manifest = json.load(file)
+    except FileNotFoundError:
+        manifest = None
+    else:
+        manifest['built'] = {entry['path']: entry
+            for entry in manifest['files'].values()}
+    with _lock:
+        _manifests[root] = manifest
+    return manifest
+
+def asset_url(filename):
+    """The URL of a file under static/, fingerprinted once built."""
+    manifest = load_manifest()
+    entry = manifest and manifest['files'].get(filename)
+    if entry is None:
+        return url_for('static', filename=filename)
+    return url_for('asset', filename=entry['path'])
+
+def asset_version():
+    """Changes with every build that changed a file, e.g. for ETags of
+    pages that link to them."""
+    manifest = load_manifest()
+    return manifest['version'] if manifest else ''
+
+###########################
+# Serving
+###########################
+
+# Preferred first
+ENCODINGS = [('br', '.br'), ('gzip', '.gz')]
+
+def send_asset(filename):
+    manifest = load_manifest()
+    entry = manifest and manifest['built'].get(filename)
+    if entry is None:
+        abort(404)
+    path = os.path.join(current_app.config['ASSETS_ROOT'], filename)
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    encoding = next((encoding for encoding, suffix in ENCODINGS
+        if encoding in entry['encodings'] and
+            request.accept_encodings[encoding]), None)
+    if encoding is not None:
+        path += dict(ENCODINGS)[encoding]
+    response = send_file(path, mimetype=mimetype, conditional=True)
+    if encoding is not None:
+        response.headers['Content-Encoding'] = encoding
+    if entry['encodings']:
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = (
+        f'public, max-age={current_app.config["ASSETS_MAX_AGE"]}, immutable')
+    return response
+
+def init_assets(app):
+    app.add_url_rule('/assets/<path:filename>', 'asset', send_asset)
+    app.add_template_global(asset_url)
+
+###########################
+# Commands
+###########################
+
+assets_cli = AppGroup('assets', help='Build the static assets.')
+
+@assets_cli.command('build')
+def build_command():
+    """Fingerprint, minify and precompress static/ into ASSETS_ROOT."""
+    manifest = build(current_app.static_folder,
+        current_app.config['ASSETS_ROOT'])
+    click.echo(f'Built {len(manifest["files"])} assets '
+        f'(version {manifest["version"]}).')
+    if brotli is None:
+        click.echo('Install the brotli package to build .br files too.')
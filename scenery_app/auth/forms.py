@@ -4,7 +4,7 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired, Length, ValidationError
 from scenery_app.models import User
-from scenery_app.extensions import bcrypt
+from scenery_app.auth.hashing import check_password
 
 class SignUpForm(FlaskForm):
     username = StringField('User Name',
@@ -24,13 +24,17 @@ class LoginForm(FlaskForm):
     password = PasswordField('Password', validators=[DataRequired()])
     submit = SubmitField('Log In')
 
+    @property
+    def user(self):
+        """The user being logged in, looked up once for all validators."""
+        if not hasattr(self, '_user'):
+            self._user = User.query.filter_by(username=self.username.data).first()
+        return self._user
+
     def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if not user:
+        if not self.user:
             raise ValidationError('No user with that username. Please try again.')
 
     def validate_password(self, password):
-        user = User.query.filter_by(username=self.username.data).first()
-        if user and not bcrypt.check_password_hash(
-                user.password, password.data):
+        if self.user and not check_password(self.user.password, password.data):
             raise ValidationError('Password doesn\'t match. Please try again.')
\ No newline at end of file
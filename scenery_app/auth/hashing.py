@@ -0,0 +1,89 @@
+"""
+Password hashing off the request thread.
+
+bcrypt is deliberately slow, so hashing and checking run on a bounded pool
+(threads by default, or processes with PASSWORD_HASH_EXECUTOR='process')
+sized by PASSWORD_HASH_WORKERS. That caps how many CPU-bound hashes run at
+once, no matter how many requests arrive together. The cost factor comes
+from BCRYPT_LOG_ROUNDS, and hashes made at a different cost can be
+upgraded on the next successful login.
+
+The pool only helps workers that serve several requests at once
+(gunicorn --threads, gevent): the request waits for its hash either way,
+and a sync worker has nothing else to do meanwhile, so for it the pool
+is just overhead and PASSWORD_HASH_EXECUTOR='inline' is the better
+choice. A hash still queued after PASSWORD_HASH_TIMEOUT seconds, e.g.
+during a login storm, is dropped and the request answered with 503 and
+Retry-After.
+"""
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+    TimeoutError)
+import threading
+
+import bcrypt as _bcrypt
+from flask import current_app
+from werkzeug.exceptions import ServiceUnavailable
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def _hash(password, rounds):
+    return _bcrypt.hashpw(password, _bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _check(pw_hash, password):
+    return _bcrypt.checkpw(password, pw_hash)
+
+def get_executor():
+    """The process-wide hashing pool, created on first use."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                config = current_app.config
+                pool = (ProcessPoolExecutor
+                    if config['PASSWORD_HASH_EXECUTOR'] == 'process'
+                    else ThreadPoolExecutor)
+                _executor = pool(max_workers=config['PASSWORD_HASH_WORKERS'])
+    return _executor
+
+def shutdown():
+    """Stop the pool, e.g. in a gunicorn worker_exit hook."""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+def _run(fn, *args):
+    config = current_app.config
+    if config['PASSWORD_HASH_EXECUTOR'] == 'inline':
+        return fn(*args)
+    future = get_executor().submit(fn, *args)
+    timeout = config['PASSWORD_HASH_TIMEOUT']
+    try:
+        return future.result(timeout=timeout)
+    except TimeoutError:
+        # Don't leave the work queued for a client that has been answered.
+        future.cancel()
+        raise ServiceUnavailable('Too busy to check passwords right now. '
+            'Please try again shortly.', retry_after=max(1, timeout))
+
+def hash_password(password):
+    """Hash `password` at the configured cost."""
+    return _run(_hash, password.encode('utf-8'),
+        current_app.config['BCRYPT_LOG_ROUNDS'])
+
+def check_password(pw_hash, password):
+    """Whether `password` matches the stored hash."""
+    return _run(_check, pw_hash.encode('utf-8'), password.encode('utf-8'))
+
+def hash_rounds(pw_hash):
+    """The cost factor a bcrypt hash was made with ('$2b$12$...' -> 12)."""
+    try:
+        return int(pw_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+def needs_rehash(pw_hash):
+    """Whether the hash was made at a different cost than configured."""
+    return hash_rounds(pw_hash) != current_app.config['BCRYPT_LOG_ROUNDS']
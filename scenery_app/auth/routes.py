@@ -6,6 +6,8 @@ from flask_login import login_user, logout_user, login_required, current_user
 from scenery_app.models import Location, List, Entry, User
 from scenery_app.auth.forms import SignUpForm, LoginForm
 from scenery_app.extensions import app, db, bcrypt
+from scenery_app.auth.hashing import hash_password, needs_rehash
+from scenery_app.identity import identity_cache
 
 auth = Blueprint('auth', __name__)
 
@@ -13,7 +15,7 @@ auth = Blueprint('auth', __name__)
 def signup():
     form = SignUpForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
+        hashed_password = hash_password(form.password.data)
         user = User(
             username=form.username.data,
             password=hashed_password
@@ -29,7 +31,12 @@ def signup():
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.query.filter_by(username=form.username.data).first()
+        user = form.user
+        if needs_rehash(user.password):
+            # Upgrade hashes made at an old cost while we have the password.
+            user.password = hash_password(form.password.data)
+            db.session.commit()
+            identity_cache.invalidate(user.id)
         login_user(user, remember=True)
         next_page = request.args.get('next')
         return redirect(next_page if next_page else url_for('main.homepage'))
@@ -38,5 +45,6 @@ def login():
 @auth.route('/logout')
 @login_required
 def logout():
+    identity_cache.invalidate(current_user.id)
     logout_user()
     return redirect(url_for('main.homepage'))
\ No newline at end of file
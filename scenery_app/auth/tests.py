@@ -1,11 +1,17 @@
 # Create your tests here.
 import os
+import tempfile
 from unittest import TestCase
 
 from datetime import date
 
 from scenery_app.extensions import app, db, bcrypt
-from scenery_app.models import Country, User, Location
+from scenery_app.models import List, User, Location
+from scenery_app.auth.hashing import hash_rounds
+from scenery_app.instrumentation import count_queries
+from scenery_app.identity import identity_cache
+from scenery_app.kvstore import SQLiteStore
+from scenery_app.ratelimit import limiter
 
 """
 Run these tests with the command:
@@ -17,16 +23,16 @@ python3 -m unittest scenery_app.main.tests
 #################################################
 
 def create_locations():
-    a1 = Country(name='Chile')
+    a1 = List(name='Chile')
     b1 = Location(
         title='Torres del Paine National Park',
-        watched_date=date(2016, 5, 17),
-        country=a1
+        visited_date=date(2016, 5, 17),
+        list=a1
     )
     db.session.add(b1)
 
-    a2 = Country(name='Seychelles')
-    b2 = Location(title='Anse Soucr d\'Argent', country=a2)
+    a2 = List(name='Seychelles')
+    b2 = Location(title='Anse Soucr d\'Argent', list=a2)
     db.session.add(b2)
     db.session.commit()
 
@@ -52,6 +58,7 @@ class AuthTests(TestCase):
         self.app = app.test_client()
         db.drop_all()
         db.create_all()
+        limiter.reset()
 
     def test_signup(self):
         # TODO: Write a test for the signup route. It should:
@@ -147,4 +154,149 @@ class AuthTests(TestCase):
         self.app.get('/logout')
         response = self.app.get('/')
         response_text = response.get_data(as_text=True)
-        self.assertIn('login', response_text)
\ No newline at end of file
+        self.assertIn('login', response_text)
+
+    def test_login_single_user_lookup(self):
+        # The login form's validators share one User lookup.
+        create_user()
+        post_data = {
+            'username': 'me1',
+            'password': 'password',
+        }
+
+        with count_queries() as counter:
+            self.app.post('/login', data=post_data)
+        user_queries = [statement for statement in counter.statements
+            if 'FROM user' in statement]
+        self.assertEqual(len(user_queries), 1)
+
+    def test_login_hashing_timeout(self):
+        # A hash that can't be checked in time is a 503, not a 500.
+        create_user()
+        saved = {name: app.config[name] for name in
+            ('PASSWORD_HASH_EXECUTOR', 'PASSWORD_HASH_TIMEOUT')}
+        app.config['PASSWORD_HASH_EXECUTOR'] = 'thread'
+        app.config['PASSWORD_HASH_TIMEOUT'] = 0
+        try:
+            response = self.app.post('/login', data={
+                'username': 'me1',
+                'password': 'password',
+            })
+        finally:
+            app.config.update(saved)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+    def test_login_rehashes_password(self):
+        # Hashes made at an old cost are upgraded on the next login.
+        password_hash = bcrypt.generate_password_hash(
+            'password', rounds=4).decode('utf-8')
+        db.session.add(User(username='me1', password=password_hash))
+        db.session.commit()
+        rounds = app.config['BCRYPT_LOG_ROUNDS']
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        try:
+            post_data = {
+                'username': 'me1',
+                'password': 'password',
+            }
+            response = self.app.post('/login', data=post_data)
+            self.assertEqual(response.status_code, 302)
+        finally:
+            app.config['BCRYPT_LOG_ROUNDS'] = rounds
+
+        user = User.query.filter_by(username='me1').one()
+        self.assertEqual(hash_rounds(user.password), 5)
+        self.assertTrue(bcrypt.check_password_hash(user.password, 'password'))
+
+    def test_cached_user_loader(self):
+        # Authenticated pages identify the user without querying for them.
+        identity_cache.clear()
+        create_user()
+        post_data = {
+            'username': 'me1',
+            'password': 'password',
+        }
+        self.app.post('/login', data=post_data)
+        self.app.get('/')
+
+        with count_queries() as counter:
+            response = self.app.get('/')
+        self.assertIn('You are logged in as me1', response.get_data(as_text=True))
+        self.assertFalse(any('WHERE user.id = ' in statement
+            for statement in counter.statements))
+        self.assertGreater(identity_cache.stats()['local_hits'], 0)
+
+        self.app.get('/logout')
+        self.assertIsNone(identity_cache.local.get('1'))
+
+    def test_shared_identity_store(self):
+        # A shared store lets another process skip the database lookup.
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SQLiteStore(os.path.join(tmp, 'cache.db'))
+            store.set('identity:1', [1, 'me1'], ttl=60)
+            self.assertEqual(SQLiteStore(store.path).get('identity:1'),
+                [1, 'me1'])
+            store.delete('identity:1')
+            self.assertIsNone(store.get('identity:1'))
+
+            # Stores sharing the file only clear their own namespace.
+            identities = SQLiteStore(store.path, 'identity')
+            limits = SQLiteStore(store.path, 'ratelimit')
+            identities.set('1', [1, 'me1'])
+            limits.consume('1', 1 / 60, 2)
+            store.set('other', 1)
+            self.assertEqual(store.get('identity:1'), [1, 'me1'])
+            identities.clear()
+            self.assertIsNone(identities.get('1'))
+            self.assertIsNotNone(limits.get('1'))
+            limits.clear()
+            self.assertIsNone(limits.get('1'))
+            self.assertEqual(store.get('other'), 1)
+
+    def test_login_rate_limit(self):
+        # Repeated attempts on one account are turned away before any
+        # database or bcrypt work, however many addresses they come from.
+        create_user()
+        post_data = {
+            'username': 'me1',
+            'password': 'wrong',
+        }
+        for n in range(5):
+            response = self.app.post('/login', data=post_data,
+                environ_base={'REMOTE_ADDR': f'10.0.0.{n}'})
+            self.assertEqual(response.status_code, 200)
+
+        with count_queries() as counter:
+            response = self.app.post('/login', data=dict(post_data,
+                username=' ME1'), environ_base={'REMOTE_ADDR': '10.0.0.9'})
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response.headers['Retry-After']), 0)
+        self.assertEqual(counter.statements, [])
+        self.assertEqual(limiter.stats()['rejected'],
+            {'auth.login:username': 1})
+
+        # Other accounts and plain page views aren't affected.
+        response = self.app.post('/login', data=dict(post_data,
+            username='me2'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.app.get('/login').status_code, 200)
+
+        app.config['RATELIMIT_ENABLED'] = False
+        try:
+            response = self.app.post('/login', data=post_data)
+            self.assertEqual(response.status_code, 200)
+        finally:
+            app.config['RATELIMIT_ENABLED'] = True
+
+    def test_shared_rate_limit_store(self):
+        # Workers sharing a SQLite store draw from the same buckets.
+        with tempfile.TemporaryDirectory() as tmp:
+            store = SQLiteStore(os.path.join(tmp, 'limits.db'))
+            other = SQLiteStore(store.path)
+            self.assertEqual(store.consume('ip', 1 / 60, 2), (True, 0.0))
+            self.assertEqual(other.consume('ip', 1 / 60, 2), (True, 0.0))
+            allowed, retry_after = store.consume('ip', 1 / 60, 2)
+            self.assertFalse(allowed)
+            self.assertAlmostEqual(retry_after, 60, delta=1)
+
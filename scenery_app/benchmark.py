@@ -0,0 +1,366 @@
+"""
+Reproducible benchmarks for the main and auth blueprints.
+
+    flask bench run                        # Flask test client
+    flask bench run --driver gunicorn -w 4 # real workers over HTTP
+    flask bench run --save-baseline        # record new baseline numbers
+
+Each run seeds a fresh SQLite database with a synthetic dataset, drives
+every scenario, prints p50/p95/p99 latency, throughput and queries per
+request, and exits non-zero if a scenario runs more queries per request
+than the baseline. Latencies depend on the machine, so they are only
+compared when asked to with --tolerance, against a baseline saved on the
+same host:
+
+    flask bench run --save-baseline --baseline /tmp/before.json
+    flask bench run --baseline /tmp/before.json --tolerance 0.25
+"""
+from concurrent.futures import ThreadPoolExecutor
+import http.cookiejar
+import json
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+import click
+from flask.cli import AppGroup
+
+from scenery_app.extensions import app, db, bcrypt
+from scenery_app.models import Landscape
+from scenery_app.bulk import import_rows, sync_sequence
+from scenery_app.instrumentation import count_queries
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_PATH = os.path.join(ROOT, 'benchmark_baseline.json')
+
+PASSWORD = 'password'
+
+###########################
+# Dataset
+###########################
+
+def seed(users=50, lists=20, entries=50, locations=2000, favorites=5000,
+        rng_seed=0):
+    """Fill the (empty) database with a deterministic synthetic dataset."""
+    rng = random.Random(rng_seed)
+    # Every user shares one hash so seeding isn't dominated by bcrypt.
+    password = bcrypt.generate_password_hash(PASSWORD).decode('utf-8')
+    landscapes = [landscape.name for landscape in Landscape]
+    entry_names = [f'entry-{i}' for i in range(entries)]
+
+    db.session.execute(db.metadata.tables['user'].insert(), [
+        {'id': i, 'username': f'user{i}', 'password': password}
+        for i in range(1, users + 1)])
+    db.session.commit()
+    sync_sequence(db.metadata.tables['user'])
+    import_rows('lists', ({'name': f'List {i}', 'description': 'Synthetic'}
+        for i in range(lists)))
+    import_rows('entries', ({'name': name} for name in entry_names))
+    import_rows('locations', ({
+        'title': f'Location {i}',
+        'list_id': rng.randint(1, lists),
+        'landscape': rng.choice(landscapes),
+        'entries': rng.sample(entry_names, min(3, entries)),
+    } for i in range(locations)))
+
+    pairs = set()
+    while len(pairs) < min(favorites, users * locations):
+        pairs.add((rng.randint(1, users), rng.randint(1, locations)))
+    import_rows('favorites', ({'user_id': user_id, 'location_id': location_id}
+        for user_id, location_id in sorted(pairs)))
+    return {'users': users, 'lists': lists, 'entries': entries,
+        'locations': locations, 'favorites': len(pairs)}
+
+###########################
+# Scenarios
+###########################
+
+class Scenario(object):
+    """One endpoint to drive: how to build each request and whether the
+    client must be logged in first."""
+    def __init__(self, name, method, path, data=None, login=False,
+            form=None):
+        self.name = name
+        self.method = method
+        self.path = path
+        self.data = data
+        self.login = login
+        # Page to GET first for a CSRF token (only used over real HTTP)
+        self.form = form
+
+def scenarios(dataset):
+    locations = dataset['locations']
+    users = dataset['users']
+    counter = iter(range(10 ** 9))
+    return [
+        Scenario('homepage', 'GET', lambda rng: '/'),
+        Scenario('location_detail', 'GET',
+            lambda rng: f'/location/{rng.randint(1, locations)}'),
+        Scenario('location_detail_auth', 'GET',
+            lambda rng: f'/location/{rng.randint(1, locations)}', login=True),
+        Scenario('profile', 'GET',
+            lambda rng: f'/profile/user{rng.randint(1, users)}'),
+        Scenario('favorite_location', 'POST',
+            lambda rng: f'/favorite/{rng.randint(1, locations)}', login=True),
+        Scenario('login', 'POST', lambda rng: '/login',
+            data=lambda rng: {'username': f'user{rng.randint(1, users)}',
+                'password': PASSWORD}, form='/login'),
+        Scenario('signup', 'POST', lambda rng: '/signup',
+            data=lambda rng: {'username': f'bench{next(counter)}',
+                'password': PASSWORD}, form='/signup'),
+    ]
+
+def percentile(samples, pct):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(samples)
+    index = max(0, min(len(ordered) - 1,
+        int(round(pct / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def summarize(latencies, elapsed, queries):
+    return {
+        'requests': len(latencies),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1),
+        'queries_per_request': (round(sum(queries) / len(queries), 2)
+            if queries else None),
+    }
+
+###########################
+# Drivers
+###########################
+
+def run_client(dataset, requests_per_scenario, rng_seed=0):
+    """Drive each scenario sequentially through the Flask test client."""
+    app.config['WTF_CSRF_ENABLED'] = False
+    results = {}
+    for scenario in scenarios(dataset):
+        rng = random.Random(rng_seed)
+        client = app.test_client()
+        if scenario.login:
+            client.post('/login', data={'username': 'user1',
+                'password': PASSWORD})
+        latencies, queries = [], []
+        started = time.perf_counter()
+        for _ in range(requests_per_scenario):
+            path = scenario.path(rng)
+            data = scenario.data(rng) if scenario.data else None
+            with count_queries() as counter:
+                request_started = time.perf_counter()
+                response = client.open(path, method=scenario.method, data=data)
+                latencies.append(time.perf_counter() - request_started)
+            if response.status_code >= 400:
+                raise click.ClickException(
+                    f'{scenario.name}: {path} returned {response.status}')
+            queries.append(counter.count)
+        results[scenario.name] = summarize(
+            latencies, time.perf_counter() - started, queries)
+    return results
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class HttpSession(object):
+    """Minimal cookie-keeping HTTP client for the gunicorn driver."""
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()),
+            _NoRedirect())
+
+    def open(self, method, path, data=None):
+        body = urllib.parse.urlencode(data).encode() if data else None
+        request = urllib.request.Request(
+            self.base_url + path, data=body, method=method)
+        try:
+            with self.opener.open(request) as response:
+                return response.status, response.headers, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.headers, error.read()
+
+    def csrf_token(self, path):
+        _, _, body = self.open('GET', path)
+        match = re.search(rb'name="csrf_token" type="hidden" value="([^"]+)"',
+            body)
+        return match.group(1).decode() if match else None
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+def run_gunicorn(dataset, requests_per_scenario, workers, concurrency,
+        database_uri, rng_seed=0):
+    """Drive each scenario over HTTP against `workers` gunicorn workers."""
+    port = _free_port()
+    env = dict(os.environ, DATABASE_URL=database_uri,
+        INSTRUMENTATION_ENABLED='1', INSTRUMENTATION_HEADERS='1',
+        RATELIMIT_ENABLED='0', JOBS_EXECUTOR='external')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn',
+        '-w', str(workers), '-b', f'127.0.0.1:{port}', '--log-level',
+        'warning', 'app:app'], cwd=ROOT, env=env)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        _wait_for(base_url)
+        results = {}
+        for scenario in scenarios(dataset):
+            rng = random.Random(rng_seed)
+            sessions = [HttpSession(base_url) for _ in range(concurrency)]
+            for session in sessions:
+                if scenario.login:
+                    session.open('POST', '/login', {'username': 'user1',
+                        'password': PASSWORD,
+                        'csrf_token': session.csrf_token('/login')})
+
+            def one_request(i):
+                session = sessions[i % concurrency]
+                path = scenario.path(rng)
+                data = scenario.data(rng) if scenario.data else None
+                if scenario.form:
+                    data['csrf_token'] = session.csrf_token(scenario.form)
+                request_started = time.perf_counter()
+                status, headers, _ = session.open(scenario.method, path, data)
+                latency = time.perf_counter() - request_started
+                if status >= 400:
+                    raise click.ClickException(
+                        f'{scenario.name}: {path} returned {status}')
+                return latency, int(headers.get('X-SQL-Queries', 0))
+
+            started = time.perf_counter()
+            with ThreadPoolExecutor(concurrency) as pool:
+                samples = list(pool.map(one_request,
+                    range(requests_per_scenario)))
+            results[scenario.name] = summarize(
+                [latency for latency, _ in samples],
+                time.perf_counter() - started,
+                [queries for _, queries in samples])
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+def _wait_for(base_url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(base_url + '/login').close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise click.ClickException('gunicorn did not start')
+
+###########################
+# Baselines
+###########################
+
+def compare(results, baseline, tolerance=None):
+    """
+    Return a list of regression messages: a scenario runs more queries per
+    request than the baseline or, if a `tolerance` is given, is slower at
+    p95 than it allows.
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        allowed = base['p95_ms'] * (1 + (tolerance or 0))
+        if tolerance is not None and result['p95_ms'] > allowed:
+            regressions.append(f'{name}: p95 {result["p95_ms"]}ms > '
+                f'{allowed:.3f}ms allowed (baseline {base["p95_ms"]}ms)')
+        if (base.get('queries_per_request') is not None and
+                result['queries_per_request'] is not None and
+                result['queries_per_request'] > base['queries_per_request']):
+            regressions.append(f'{name}: {result["queries_per_request"]} '
+                f'queries/request > baseline {base["queries_per_request"]}')
+    return regressions
+
+def format_table(results):
+    columns = ('requests', 'p50_ms', 'p95_ms', 'p99_ms', 'throughput_rps',
+        'queries_per_request')
+    lines = ['scenario'.ljust(22) + ''.join(c.rjust(20) for c in columns)]
+    for name, result in results.items():
+        lines.append(name.ljust(22) + ''.join(
+            str(result[c]).rjust(20) for c in columns))
+    return '\n'.join(lines)
+
+###########################
+# Commands
+###########################
+
+bench_cli = AppGroup('bench', help='Benchmark the main and auth blueprints.')
+
+@bench_cli.command('run')
+@click.option('--driver', type=click.Choice(['client', 'gunicorn']),
+    default='client', show_default=True)
+@click.option('--requests', 'requests_per_scenario', default=200,
+    show_default=True, help='Requests per scenario.')
+@click.option('--users', default=50, show_default=True)
+@click.option('--lists', default=20, show_default=True)
+@click.option('--entries', default=50, show_default=True)
+@click.option('--locations', default=2000, show_default=True)
+@click.option('--favorites', default=5000, show_default=True)
+@click.option('-w', '--workers', default=4, show_default=True,
+    help='gunicorn workers.')
+@click.option('-c', '--concurrency', default=8, show_default=True,
+    help='Concurrent HTTP clients for the gunicorn driver.')
+@click.option('--baseline', 'baseline_path', default=BASELINE_PATH,
+    show_default=True)
+@click.option('--tolerance', type=float, default=None,
+    help='Also fail on a p95 slowdown over the baseline of more than this '
+        'fraction. Only meaningful with a baseline saved on this host.')
+@click.option('--save-baseline', is_flag=True,
+    help='Store these results as the new baseline.')
+def run_command(driver, requests_per_scenario, users, lists, entries,
+        locations, favorites, workers, concurrency, baseline_path, tolerance,
+        save_baseline):
+    """Seed a synthetic dataset and benchmark every scenario."""
+    # Every request comes from one client; measure the pages, not the
+    # rate limits. Jobs stay queued, so their queries don't land on
+    # whichever request is being counted when they run.
+    app.config['RATELIMIT_ENABLED'] = False
+    app.config['JOBS_EXECUTOR'] = 'external'
+    with tempfile.TemporaryDirectory() as tmp:
+        database_uri = f'sqlite:///{os.path.join(tmp, "bench.db")}'
+        app.config['SQLALCHEMY_DATABASE_URI'] = database_uri
+        db.create_all()
+        dataset = seed(users, lists, entries, locations, favorites)
+        click.echo(f'Seeded {dataset}')
+
+        if driver == 'client':
+            results = run_client(dataset, requests_per_scenario)
+        else:
+            db.session.remove()
+            results = run_gunicorn(dataset, requests_per_scenario, workers,
+                concurrency, database_uri)
+        click.echo(format_table(results))
+
+    baselines = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baselines = json.load(f)
+
+    if save_baseline:
+        baselines[driver] = results
+        with open(baseline_path, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+        click.echo(f'Saved baseline to {baseline_path}')
+        return
+
+    regressions = compare(results, baselines.get(driver, {}), tolerance)
+    for regression in regressions:
+        click.echo(f'REGRESSION {regression}', err=True)
+    if regressions:
+        sys.exit(1)
@@ -0,0 +1,441 @@
+"""
+Bulk import/export of locations, lists, entries and their associations.
+
+    flask data import locations locations.csv
+    flask data export locations locations.jsonl
+
+Files are CSV or JSON Lines (picked by extension, `-` for stdin/stdout).
+Rows are streamed in and inserted with executemany in batches, one commit
+per batch, so memory stays flat no matter how big the file is.
+"""
+import csv
+import itertools
+import json
+import sys
+from collections import Counter
+from contextlib import nullcontext
+from datetime import date
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func, text
+
+from scenery_app.extensions import db
+from scenery_app.search import index_documents
+from scenery_app.facets import adjust_counts, facet_values
+from scenery_app.fragment_cache import bump_locations
+from scenery_app.geo import position_hash
+from scenery_app.user_stats import links_changed
+from scenery_app.models import (Location, List, Entry, User, Landscape,
+    location_entry_table, favorite_locations_table)
+
+data_cli = AppGroup('data', help='Bulk import and export data.')
+
+TABLES = ('lists', 'entries', 'locations', 'location_entries', 'favorites')
+
+###########################
+# Reading & writing files
+###########################
+
+def _is_csv(path):
+    return path.lower().endswith('.csv')
+
+def open_path(path, mode):
+    """Open `path`, or wrap stdin/stdout (without closing it) for `-`."""
+    if path == '-':
+        return nullcontext(sys.stdin if 'r' in mode else sys.stdout)
+    return open(path, mode, newline='')
+
+def read_rows(stream, as_csv):
+    """Yield one dict per CSV row or JSON line."""
+    if as_csv:
+        yield from csv.DictReader(stream)
+    else:
+        for line in stream:
+            if line.strip():
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Reported by import_rows as a row that isn't an object
+                    yield None
+
+def write_rows(stream, rows, fieldnames, as_csv):
+    """Write dicts out as CSV or JSON lines, returning how many."""
+    count = 0
+    writer = csv.DictWriter(stream, fieldnames) if as_csv else None
+    if writer:
+        writer.writeheader()
+    for row in rows:
+        if writer:
+            writer.writerow(row)
+        else:
+            stream.write(json.dumps(row, default=str) + '\n')
+        count += 1
+    return count
+
+def batched(rows, size):
+    """Split an iterable into lists of at most `size` items."""
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+###########################
+# Lookup maps
+###########################
+
+def landscape_lookup():
+    """Map both enum names ('COAST') and values ('Coast') to members."""
+    lookup = {}
+    for landscape in Landscape:
+        lookup[landscape.name.lower()] = landscape
+        lookup[landscape.value.lower()] = landscape
+    return lookup
+
+def entry_lookup():
+    """Map entry names to ids."""
+    return dict(db.session.query(Entry.name, Entry.id))
+
+def user_lookup():
+    """Map usernames to ids."""
+    return dict(db.session.query(User.username, User.id))
+
+def _split_names(value):
+    if isinstance(value, list):
+        return value
+    return [name for name in (value or '').split('|') if name]
+
+class IdAllocator(object):
+    """
+    Hands out primary keys for rows that don't bring their own, so that
+    association rows can be written without reading inserted ids back.
+    Assumes nothing else is inserting into the table during the import.
+    """
+    def __init__(self, column):
+        self.next_id = (db.session.query(func.max(column)).scalar() or 0) + 1
+
+    def __call__(self, value):
+        if value not in (None, ''):
+            value = _int(value, 'id')
+            self.next_id = max(self.next_id, value + 1)
+            return value
+        value = self.next_id
+        self.next_id += 1
+        return value
+
+def sync_sequence(table):
+    """
+    Move a PostgreSQL table's id sequence past the ids written explicitly
+    (by IdAllocator or in the file), so ordinary INSERTs don't reuse them.
+    Other databases pick the next id from the table itself.
+    """
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+    quoted = db.session.get_bind().dialect.identifier_preparer.quote(
+        table.name)
+    db.session.execute(text(
+        f"SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+        f"COALESCE(MAX(id), 1), MAX(id) IS NOT NULL) FROM {quoted}"),
+        {'table': quoted})
+    db.session.commit()
+
+###########################
+# Validation
+###########################
+
+class RowError(ValueError):
+    """A row that can't be imported; the message says why."""
+
+def _required(row, name):
+    value = row.get(name)
+    if value in (None, ''):
+        raise RowError(f'missing {name}')
+    return value
+
+def _int(value, name):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RowError(f'{name} is not a whole number: {value!r}') from None
+
+def _lookup(mapping, key, what):
+    try:
+        return mapping[key]
+    except KeyError:
+        raise RowError(f'unknown {what} {key!r}') from None
+
+def _existing(columns, keys):
+    """The tuples among `keys` that are already values of `columns`."""
+    keys = set(keys)
+    found = set()
+    for chunk in batched(sorted(keys), 500):
+        query = db.session.query(*columns)
+        for index, column in enumerate(columns):
+            query = query.filter(column.in_({key[index] for key in chunk}))
+        found.update(key for key in map(tuple, query) if key in keys)
+    return found
+
+def check_batch(batch, unique=(), refs=()):
+    """
+    Split a batch of (row number, values) into the ones that can be
+    inserted and (row number, message) for the rest: those repeating a
+    `unique` key that is in the table already or earlier in the batch
+    (earlier batches are committed, so in the table), and those whose
+    `refs` point at rows that don't exist. Both are lists of
+    (columns, key function, message function).
+    """
+    bad = {}
+    for columns, key, message in unique:
+        keys = [key(values) for _, values in batch]
+        taken = _existing(columns, keys)
+        for (number, _), value in zip(batch, keys):
+            if value in taken:
+                bad.setdefault(number, message(value))
+            taken.add(value)
+    for columns, key, message in refs:
+        keys = [key(values) for _, values in batch]
+        found = _existing(columns, keys)
+        for (number, _), value in zip(batch, keys):
+            if value not in found:
+                bad.setdefault(number, message(value))
+    return ([(number, values) for number, values in batch
+            if number not in bad], sorted(bad.items()))
+
+###########################
+# Row converters
+###########################
+
+def _optional_date(value):
+    try:
+        return date.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        raise RowError(f'visited_date is not a YYYY-MM-DD date: {value!r}'
+            ) from None
+
+def _optional_float(value, name):
+    try:
+        return float(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        raise RowError(f'{name} is not a number: {value!r}') from None
+
+def _position(row):
+    latitude = _optional_float(row.get('latitude'), 'latitude')
+    longitude = _optional_float(row.get('longitude'), 'longitude')
+    if (latitude is None) != (longitude is None):
+        raise RowError('latitude and longitude go together')
+    if latitude is not None and not (
+            -90 <= latitude <= 90 and -180 <= longitude <= 180):
+        raise RowError(f'no such position: {latitude}, {longitude}')
+    return {'latitude': latitude, 'longitude': longitude,
+        'geohash': position_hash(latitude, longitude)}
+
+def _entry_id(row, entries):
+    if row.get('entry_id'):
+        return _int(row['entry_id'], 'entry_id')
+    return _lookup(entries, _required(row, 'entry'), 'entry')
+
+def _user_id(row, users):
+    if row.get('user_id'):
+        return _int(row['user_id'], 'user_id')
+    return _lookup(users, _required(row, 'username'), 'user')
+
+def _id_taken(key):
+    return f'id {key[0]} already exists'
+
+def _unknown(what):
+    return lambda key: f'unknown {what} {key[0]}'
+
+def import_rows(table_name, rows, batch_size=5000, on_error=None):
+    """
+    Insert `rows` (dicts) into one of TABLES, committing every
+    `batch_size` rows. Returns the number of rows inserted.
+
+    Rows that can't be imported (missing fields, unknown names or ids,
+    duplicates) are passed to `on_error(row number, message)`, counting
+    from 1, and skipped. Without `on_error` the first one raises RowError;
+    batches before it stay committed.
+    """
+    unique, refs = [], []
+    if table_name == 'lists':
+        allocate = IdAllocator(List.id)
+        convert = lambda row: {
+            'id': allocate(row.get('id')),
+            'name': _required(row, 'name'),
+            'description': row.get('description') or None,
+        }
+        table = List.__table__
+        unique.append(((List.id,), lambda row: (row['id'],), _id_taken))
+    elif table_name == 'entries':
+        allocate = IdAllocator(Entry.id)
+        convert = lambda row: {
+            'id': allocate(row.get('id')),
+            'name': _required(row, 'name'),
+        }
+        table = Entry.__table__
+        unique += [((Entry.id,), lambda row: (row['id'],), _id_taken),
+            ((Entry.name,), lambda row: (row['name'],),
+                lambda key: f'entry {key[0]!r} already exists')]
+    elif table_name == 'locations':
+        allocate = IdAllocator(Location.id)
+        landscapes = landscape_lookup()
+        entries = entry_lookup()
+        convert = lambda row: {
+            'id': allocate(row.get('id')),
+            'title': _required(row, 'title'),
+            'visited_date': _optional_date(row.get('visited_date')),
+            'list_id': _int(_required(row, 'list_id'), 'list_id'),
+            'landscape': _lookup(landscapes,
+                (row.get('landscape') or Landscape.DESERTS.name).lower(),
+                'landscape'),
+            'entries': [_lookup(entries, name, 'entry')
+                for name in _split_names(row.get('entries'))],
+            **_position(row),
+        }
+        table = Location.__table__
+        unique.append(((Location.id,), lambda row: (row['id'],), _id_taken))
+        refs.append(((List.id,), lambda row: (row['list_id'],),
+            _unknown('list')))
+    elif table_name == 'location_entries':
+        entries = entry_lookup()
+        convert = lambda row: {
+            'location_id': _int(_required(row, 'location_id'), 'location_id'),
+            'entry_id': _entry_id(row, entries),
+        }
+        table = location_entry_table
+        unique.append(((table.c.location_id, table.c.entry_id),
+            lambda row: (row['location_id'], row['entry_id']),
+            lambda key: f'location {key[0]} already has entry {key[1]}'))
+        refs += [((Location.id,), lambda row: (row['location_id'],),
+                _unknown('location')),
+            ((Entry.id,), lambda row: (row['entry_id'],), _unknown('entry'))]
+    elif table_name == 'favorites':
+        users = user_lookup()
+        convert = lambda row: {
+            'location_id': _int(_required(row, 'location_id'), 'location_id'),
+            'user_id': _user_id(row, users),
+        }
+        table = favorite_locations_table
+        unique.append(((table.c.user_id, table.c.location_id),
+            lambda row: (row['user_id'], row['location_id']),
+            lambda key: f'location {key[1]} is already a favorite of '
+                f'user {key[0]}'))
+        refs += [((Location.id,), lambda row: (row['location_id'],),
+                _unknown('location')),
+            ((User.id,), lambda row: (row['user_id'],), _unknown('user'))]
+    else:
+        raise ValueError(f'Unknown table {table_name!r}')
+
+    def report(number, message):
+        if on_error is None:
+            raise RowError(f'row {number}: {message}')
+        on_error(number, message)
+
+    def converted():
+        for number, row in enumerate(rows, 1):
+            try:
+                if not isinstance(row, dict):
+                    raise RowError('not an object')
+                yield number, convert(row)
+            except RowError as error:
+                report(number, str(error))
+
+    count = 0
+    for batch in batched(converted(), batch_size):
+        batch, errors = check_batch(batch, unique, refs)
+        for number, message in errors:
+            report(number, message)
+        batch = [values for _, values in batch]
+        if not batch:
+            continue
+        links = [{'location_id': row['id'], 'entry_id': entry_id}
+            for row in batch
+            for entry_id in dict.fromkeys(row.pop('entries', ()))]
+        db.session.execute(table.insert(), batch)
+        if links:
+            db.session.execute(location_entry_table.insert(), links)
+        if table_name == 'locations':
+            index_documents('location',
+                [(row['id'], row['title']) for row in batch])
+            adjust_counts(Counter(key for row in batch
+                for key in facet_values(row['landscape'], row['list_id'])))
+        elif table_name == 'entries':
+            index_documents('entry', [(row['id'], row['name']) for row in batch])
+        elif table_name == 'location_entries':
+            bump_locations({row['location_id'] for row in batch})
+        elif table_name == 'favorites':
+            links_changed(favorite_locations_table, batch, 1)
+        db.session.commit()
+        count += len(batch)
+    if table_name in ('lists', 'entries', 'locations'):
+        sync_sequence(table)
+    return count
+
+def export_rows(table_name, batch_size=5000):
+    """Yield the rows of one of TABLES as dicts, streaming from the DB."""
+    if table_name == 'lists':
+        query = db.session.query(List.id, List.name, List.description)
+    elif table_name == 'entries':
+        query = db.session.query(Entry.id, Entry.name)
+    elif table_name == 'locations':
+        query = db.session.query(Location.id, Location.title,
+            Location.visited_date, Location.list_id, Location.landscape,
+            Location.latitude, Location.longitude)
+    elif table_name == 'location_entries':
+        query = (db.session.query(location_entry_table.c.location_id,
+                location_entry_table.c.entry_id, Entry.name.label('entry'))
+            .join(Entry, Entry.id == location_entry_table.c.entry_id))
+    elif table_name == 'favorites':
+        query = db.session.query(favorite_locations_table.c.location_id,
+            favorite_locations_table.c.user_id)
+    else:
+        raise ValueError(f'Unknown table {table_name!r}')
+
+    for row in query.yield_per(batch_size):
+        row = row._asdict()
+        if isinstance(row.get('landscape'), Landscape):
+            row['landscape'] = row['landscape'].name
+        if isinstance(row.get('visited_date'), date):
+            row['visited_date'] = row['visited_date'].isoformat()
+        yield row
+
+###########################
+# Commands
+###########################
+
+@data_cli.command('import')
+@click.argument('table', type=click.Choice(TABLES))
+@click.argument('path')
+@click.option('--batch-size', default=5000, show_default=True)
+def import_command(table, path, batch_size):
+    """Import rows into TABLE from a CSV or JSON Lines file."""
+    skipped = 0
+    def skip(number, message):
+        nonlocal skipped
+        skipped += 1
+        click.echo(f'{path}: row {number}: {message}', err=True)
+
+    with open_path(path, 'r') as stream:
+        count = import_rows(table, read_rows(stream, _is_csv(path)),
+            batch_size=batch_size, on_error=skip)
+    click.echo(f'Imported {count} {table}.')
+    if skipped:
+        click.echo(f'Skipped {skipped} rows with errors.', err=True)
+        sys.exit(1)
+
+@data_cli.command('export')
+@click.argument('table', type=click.Choice(TABLES))
+@click.argument('path')
+@click.option('--batch-size', default=5000, show_default=True)
+def export_command(table, path, batch_size):
+    """Export TABLE to a CSV or JSON Lines file."""
+    rows = export_rows(table, batch_size=batch_size)
+    first = next(rows, None)
+    if first is None:
+        click.echo(f'No {table} to export.', err=True)
+        return
+    with open_path(path, 'w') as stream:
+        count = write_rows(stream, itertools.chain([first], rows),
+            list(first), _is_csv(path))
+    click.echo(f'Exported {count} {table}.', err=True)
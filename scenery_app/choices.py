@@ -0,0 +1,94 @@
+"""Cached (id, label) choice lists for the select fields on our forms."""
+import time
+
+from flask import current_app
+from sqlalchemy import func
+
+from scenery_app.extensions import db
+from scenery_app.models import List, Entry
+
+
+def escape_like(text):
+    """Make `text` match itself literally in a LIKE pattern."""
+    return (text.replace('\\', '\\\\').replace('%', '\\%')
+        .replace('_', '\\_'))
+
+class ChoiceProvider(object):
+    """
+    Serves the (id, label) pairs for one model without hydrating ORM
+    objects. The row count and newest updated_at, and for tables small
+    enough to list in full the list itself, are cached per process for
+    CHOICES_CACHE_TTL seconds, and dropped early whenever `invalidate()`
+    is called after a write.
+    """
+    def __init__(self, model, label_column):
+        self.model = model
+        self.label_column = label_column
+        self._cache = None
+        self._summary = None
+
+    def invalidate(self):
+        self._cache = None
+        self._summary = None
+
+    @staticmethod
+    def _expires():
+        return time.monotonic() + current_app.config['CHOICES_CACHE_TTL']
+
+    def _load(self):
+        if self._cache is None or self._cache[0] < time.monotonic():
+            rows = (db.session.query(self.model.id, self.label_column)
+                .order_by(self.label_column).all())
+            self._cache = (self._expires(), [(row[0], row[1]) for row in rows])
+        return self._cache[1]
+
+    def _count_and_newest(self):
+        if self._summary is None or self._summary[0] < time.monotonic():
+            summary = db.session.query(func.count(self.model.id),
+                func.max(self.model.updated_at)).one()
+            self._summary = (self._expires(), tuple(summary))
+        return self._summary[1]
+
+    def choices(self):
+        """All (id, label) pairs, ordered by label."""
+        return self._load()
+
+    def version(self):
+        """Changes whenever a row is added, renamed or removed, and is the
+        same in every process that has read the same rows, so pages that
+        list the choices can use it in cache keys and ETags."""
+        return self._count_and_newest()
+
+    def is_large(self):
+        """Whether there are too many rows to list in a plain <select>."""
+        threshold = current_app.config['CHOICES_TYPEAHEAD_THRESHOLD']
+        return self._count_and_newest()[0] > threshold
+
+    def labels(self, ids):
+        """(id, label) pairs for just the given ids."""
+        if not ids:
+            return []
+        return (db.session.query(self.model.id, self.label_column)
+            .filter(self.model.id.in_(ids)).all())
+
+    def get_many(self, ids):
+        """Load the objects for the given ids with a single IN query."""
+        if not ids:
+            return []
+        return self.model.query.filter(self.model.id.in_(ids)).all()
+
+    def search(self, q, limit=20):
+        """(id, label) pairs whose label starts with `q`."""
+        return (db.session.query(self.model.id, self.label_column)
+            .filter(self.label_column.like(f'{escape_like(q)}%',
+                escape='\\'))
+            .order_by(self.label_column).limit(limit).all())
+
+
+list_choices = ChoiceProvider(List, List.name)
+entry_choices = ChoiceProvider(Entry, Entry.name)
+
+providers = {
+    'list': list_choices,
+    'entry': entry_choices,
+}
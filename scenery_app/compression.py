@@ -0,0 +1,60 @@
+"""
+Gzip for dynamic responses.
+
+Responses of COMPRESS_MIMETYPES are gzipped when the client accepts it:
+buffered ones if they are at least COMPRESS_MIN_BYTES, streamed ones
+always, chunk by chunk with a sync flush after each so the client still
+gets every chunk as soon as it is generated. Files (send_file) and
+responses that already have a Content-Encoding, such as the precompressed
+assets, are left alone.
+
+A gzipped body isn't byte-for-byte the page its ETag was made for, so
+the ETag becomes weak; If-None-Match uses the weak comparison anyway.
+"""
+import gzip
+import zlib
+
+from flask import current_app, request
+
+def gzip_stream(chunks, level):
+    """Gzip an iterable of bytes without holding more than a chunk."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def compress_response(response):
+    config = current_app.config
+    if (not config['COMPRESS_ENABLED'] or
+            response.mimetype not in config['COMPRESS_MIMETYPES'] or
+            response.direct_passthrough or
+            'Content-Encoding' in response.headers):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return response
+
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    if response.status_code in (204, 304) or response.status_code < 200:
+        return response
+
+    if response.is_streamed:
+        response.response = gzip_stream(response.iter_encoded(),
+            config['COMPRESS_LEVEL'])
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < config['COMPRESS_MIN_BYTES']:
+            return response
+        response.set_data(gzip.compress(data, config['COMPRESS_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def init_compression(app):
+    # Registered before the other after_request hooks, so it runs last,
+    # on the finished body.
+    app.after_request(compress_response)
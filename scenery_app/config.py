@@ -1,11 +1,197 @@
 """Initialize Config class to access environment variables."""
 from dotenv import load_dotenv
+import json
 import os
 
 load_dotenv()
 
+def engine_options(url):
+    """
+    SQLAlchemy engine options for a database URL, from the DB_POOL_*
+    environment variables. SQLite databases keep Flask-SQLAlchemy's own
+    pool choices, since their pools can't be sized.
+
+    DB_POOL_CLASS=null opens a fresh connection per checkout instead of
+    pooling, which is always safe across forks and suits an external
+    pooler such as PgBouncer.
+    """
+    if not url or url.startswith('sqlite'):
+        return {}
+    if os.getenv('DB_POOL_CLASS') == 'null':
+        from sqlalchemy.pool import NullPool
+        return {'poolclass': NullPool}
+    return {
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', '1') == '1',
+    }
+
 class Config(object):
     """Set environment variables."""
     SQLALCHEMY_DATABASE_URI = os.getenv("DATABASE_URL")
     SECRET_KEY = os.getenv('SECRET_KEY')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+
+    # Read replicas (comma separated URLs) for @read_only endpoints, and
+    # how long a client reads from the primary after writing
+    SQLALCHEMY_REPLICA_URIS = [url for url in
+        os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url]
+    REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS', 10))
+
+    # Password hashing: bcrypt cost, and the pool hashes run on
+    # ('thread', 'process' or 'inline'). The pool only helps threaded or
+    # gevent workers; use 'inline' with sync gunicorn workers.
+    BCRYPT_LOG_ROUNDS = int(os.getenv('BCRYPT_LOG_ROUNDS', 12))
+    PASSWORD_HASH_EXECUTOR = os.getenv('PASSWORD_HASH_EXECUTOR', 'thread')
+    PASSWORD_HASH_WORKERS = int(os.getenv('PASSWORD_HASH_WORKERS', 2))
+    PASSWORD_HASH_TIMEOUT = int(os.getenv('PASSWORD_HASH_TIMEOUT', 10))
+
+    # Flask-Login identity cache: per-process LRU, plus an optional
+    # shared store URL (memory://, sqlite:////path or redis://...)
+    IDENTITY_CACHE_TTL = int(os.getenv('IDENTITY_CACHE_TTL', 60))
+    IDENTITY_CACHE_SIZE = int(os.getenv('IDENTITY_CACHE_SIZE', 10000))
+    IDENTITY_CACHE_URL = os.getenv('IDENTITY_CACHE_URL')
+
+    # Rate limits per endpoint (see scenery_app/ratelimit.py). RATELIMITS
+    # is JSON merged over these defaults, e.g.
+    # {"auth.login": {"ip": "50/minute", "username": "10/minute"}}
+    RATELIMIT_ENABLED = os.getenv('RATELIMIT_ENABLED', '1') == '1'
+    RATELIMIT_STORAGE_URL = os.getenv('RATELIMIT_STORAGE_URL', 'memory://')
+    RATELIMITS = dict({
+        'auth.login': {'ip': '20/minute', 'username': '5/minute'},
+        'auth.signup': {'ip': '5/minute'},
+        'main.upload_photo': {'user': '60/hour'},
+        'main.create_location': {'user': '60/minute'},
+        # Anonymous and CPU-heavy on a cache miss
+        'main.list_itinerary': {'ip': '30/minute', 'methods': ['GET']},
+        'main.visitlist_itinerary': {'ip': '30/minute', 'methods': ['GET']},
+    }, **json.loads(os.getenv('RATELIMITS', '{}')))
+    # How many proxies (e.g. nginx) sit in front of gunicorn and set
+    # X-Forwarded-For; client addresses are read from that header.
+    PROXY_FIX_X_FOR = int(os.getenv('PROXY_FIX_X_FOR', 0))
+
+    # Pagination
+    PAGE_SIZE = int(os.getenv('PAGE_SIZE', 25))
+    MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', 100))
+    # Streamed list pages (see scenery_app/streaming.py): rows fetched per
+    # round trip, and the HTML collected before each chunk is sent (small
+    # enough that the page header goes out before the first list query)
+    STREAM_YIELD_PER = int(os.getenv('STREAM_YIELD_PER', 50))
+    STREAM_CHUNK_BYTES = int(os.getenv('STREAM_CHUNK_BYTES', 1024))
+
+    # Form choice lists: how long to cache them, and how many options to
+    # allow before switching the widget to type-ahead search
+    CHOICES_CACHE_TTL = int(os.getenv('CHOICES_CACHE_TTL', 60))
+    CHOICES_TYPEAHEAD_THRESHOLD = int(
+        os.getenv('CHOICES_TYPEAHEAD_THRESHOLD', 200))
+
+    # How many locations the nearby panel and /nearby.json return, and the
+    # largest ?km= radius it searches (larger ones scan more of the table)
+    NEARBY_COUNT = int(os.getenv('NEARBY_COUNT', 5))
+    NEARBY_MAX_KM = float(os.getenv('NEARBY_MAX_KM', 100))
+
+    # Itineraries (see scenery_app/itinerary.py): seconds spent improving
+    # a route, the most stops one may have, and how long routes are cached
+    # (per process, plus an optional shared store URL as for identities)
+    ITINERARY_TIME_BUDGET = float(os.getenv('ITINERARY_TIME_BUDGET', 0.5))
+    ITINERARY_MAX_STOPS = int(os.getenv('ITINERARY_MAX_STOPS', 1000))
+    ITINERARY_CACHE_TTL = int(os.getenv('ITINERARY_CACHE_TTL', 24 * 3600))
+    ITINERARY_CACHE_SIZE = int(os.getenv('ITINERARY_CACHE_SIZE', 1000))
+    ITINERARY_CACHE_URL = os.getenv('ITINERARY_CACHE_URL')
+    # Decimal places the ?lat=&lng= start is rounded to (2 is about 1 km),
+    # so nearby clients share cached routes
+    ITINERARY_START_DECIMALS = int(os.getenv('ITINERARY_START_DECIMALS', 2))
+    # Routes with at least ITINERARY_POOL_MIN_STOPS stops are planned on a
+    # pool of processes ('process') or always in the request ('inline')
+    ITINERARY_EXECUTOR = os.getenv('ITINERARY_EXECUTOR', 'process')
+    ITINERARY_WORKERS = int(os.getenv('ITINERARY_WORKERS', 2))
+    ITINERARY_POOL_MIN_STOPS = int(os.getenv('ITINERARY_POOL_MIN_STOPS', 200))
+
+    # Suggestions kept per location and per user, and how many of a
+    # user's other favorites to refresh when they favorite something
+    RECOMMENDATIONS_PER_OWNER = int(os.getenv('RECOMMENDATIONS_PER_OWNER', 10))
+    RECOMMENDATIONS_REFRESH_LIMIT = int(
+        os.getenv('RECOMMENDATIONS_REFRESH_LIMIT', 50))
+
+    # Text search configuration used for the PostgreSQL search index
+    SEARCH_LANGUAGE = os.getenv('SEARCH_LANGUAGE', 'english')
+
+    # Upper bound on the rendered location fragments kept per process
+    FRAGMENT_CACHE_MAX_BYTES = int(
+        os.getenv('FRAGMENT_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+
+    # Background jobs (see scenery_app/jobs.py): 'thread' runs them on a
+    # pool in each web process, 'external' leaves them to `flask jobs work`
+    # and 'inline' runs them straight away in the request
+    JOBS_EXECUTOR = os.getenv('JOBS_EXECUTOR', 'thread')
+    JOBS_WORKERS = int(os.getenv('JOBS_WORKERS', 2))
+    JOBS_POLL_INTERVAL = float(os.getenv('JOBS_POLL_INTERVAL', 1))
+    JOBS_MAX_ATTEMPTS = int(os.getenv('JOBS_MAX_ATTEMPTS', 5))
+    # Seconds before the first retry, doubling after each failure
+    JOBS_RETRY_DELAY = float(os.getenv('JOBS_RETRY_DELAY', 5))
+    # A job claimed this long ago is assumed lost and runs again
+    JOBS_TIMEOUT = int(os.getenv('JOBS_TIMEOUT', 300))
+
+    # Photo uploads (see scenery_app/media.py): where files are stored,
+    # the largest file accepted and the thumbnail sizes made for each
+    MEDIA_ROOT = os.getenv('MEDIA_ROOT', os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'media'))
+    MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', 20 * 1024 * 1024))
+    MEDIA_THUMBNAIL_SIZES = [int(size) for size in
+        os.getenv('MEDIA_THUMBNAIL_SIZES', '160,480,1200').split(',')]
+    # Thumbnails render on a pool of processes ('process') or in the job's
+    # own thread ('inline')
+    MEDIA_THUMBNAIL_EXECUTOR = os.getenv('MEDIA_THUMBNAIL_EXECUTOR', 'process')
+    MEDIA_THUMBNAIL_WORKERS = int(os.getenv('MEDIA_THUMBNAIL_WORKERS', 2))
+    MEDIA_THUMBNAIL_TIMEOUT = int(os.getenv('MEDIA_THUMBNAIL_TIMEOUT', 120))
+    # Let the front-end server send files: 'x-accel-redirect' (nginx, with
+    # an internal location at MEDIA_ACCEL_PREFIX aliased to MEDIA_ROOT) or
+    # 'x-sendfile' (Apache, lighttpd). Empty sends them from the app.
+    MEDIA_SENDFILE = os.getenv('MEDIA_SENDFILE', '')
+    MEDIA_ACCEL_PREFIX = os.getenv('MEDIA_ACCEL_PREFIX', '/_media/')
+    MEDIA_MAX_AGE = int(os.getenv('MEDIA_MAX_AGE', 365 * 24 * 3600))
+    USE_X_SENDFILE = MEDIA_SENDFILE == 'x-sendfile'
+    # Browser cache lifetime for /static, whose file names don't change
+    # when their contents do
+    SEND_FILE_MAX_AGE_DEFAULT = int(os.getenv('STATIC_MAX_AGE', 3600))
+    # `flask assets build` writes fingerprinted, minified and precompressed
+    # copies of static/ here (see scenery_app/assets.py); they are served
+    # from /assets/ and never change, so clients keep them for a year
+    ASSETS_ROOT = os.getenv('ASSETS_ROOT', os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'assets'))
+    ASSETS_MAX_AGE = int(os.getenv('ASSETS_MAX_AGE', 365 * 24 * 3600))
+
+    # Gzip dynamic responses of these types when the client accepts it
+    # and they are at least COMPRESS_MIN_BYTES (streamed ones always)
+    COMPRESS_ENABLED = os.getenv('COMPRESS_ENABLED', '1') == '1'
+    COMPRESS_MIMETYPES = os.getenv('COMPRESS_MIMETYPES',
+        'text/html,application/json').split(',')
+    COMPRESS_MIN_BYTES = int(os.getenv('COMPRESS_MIN_BYTES', 1024))
+    COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+
+    # Conditional GETs for pages (see scenery_app/http_cache.py). Change
+    # HTTP_CACHE_VERSION on deploys that change templates, so pages cached
+    # before them are re-sent. Anonymous pages may be kept by shared
+    # caches (CDNs) for HTTP_CACHE_SHARED_MAX_AGE seconds without asking.
+    HTTP_CACHE_VERSION = os.getenv('HTTP_CACHE_VERSION', '')
+    HTTP_CACHE_SHARED_MAX_AGE = int(os.getenv('HTTP_CACHE_SHARED_MAX_AGE', 0))
+
+    # Largest number of items accepted by one batch call to the JSON API
+    API_MAX_BATCH = int(os.getenv('API_MAX_BATCH', 500))
+
+    # Log a warning when a request runs more SQL statements than this
+    QUERY_LIMIT = int(os.getenv('QUERY_LIMIT', 0)) or None
+
+    # Request profiling (see scenery_app/instrumentation.py). /_metrics is
+    # only served with "Authorization: Bearer <INSTRUMENTATION_METRICS_TOKEN>"
+    INSTRUMENTATION_ENABLED = os.getenv('INSTRUMENTATION_ENABLED') == '1'
+    INSTRUMENTATION_HEADERS = os.getenv('INSTRUMENTATION_HEADERS', '1') == '1'
+    INSTRUMENTATION_METRICS_TOKEN = os.getenv('INSTRUMENTATION_METRICS_TOKEN')
+    INSTRUMENTATION_SLOW_QUERIES = int(
+        os.getenv('INSTRUMENTATION_SLOW_QUERIES', 5))
+    INSTRUMENTATION_SLOW_REQUEST_MS = int(
+        os.getenv('INSTRUMENTATION_SLOW_REQUEST_MS', 0))
+    N_PLUS_ONE_THRESHOLD = int(os.getenv('N_PLUS_ONE_THRESHOLD', 0))
@@ -0,0 +1,33 @@
+"""
+Tables of running totals, such as FacetCount and UserStat, that the
+requests changing what they count adjust in their own transaction.
+
+Adjustments are upserts (INSERT ... ON CONFLICT DO UPDATE, on SQLite
+3.24+ and PostgreSQL), so two requests that both add the first row for a
+key both count instead of one failing on the primary key.
+"""
+from sqlalchemy import text
+
+from scenery_app.extensions import db
+
+def add_counts(table, deltas):
+    """
+    Add a {key: delta} mapping to the `count` column of `table`, where
+    each key holds the values of its primary key columns in order. Rows
+    that don't exist yet are created with the delta.
+    """
+    rows = sorted((key, delta) for key, delta in deltas.items() if delta)
+    if not rows:
+        return
+    quote = db.session.get_bind().dialect.identifier_preparer.quote
+    name, count = quote(table.name), quote('count')
+    keys = [column.name for column in table.primary_key.columns]
+    columns = ', '.join(quote(key) for key in keys)
+    values = ', '.join(f':{key}' for key in keys)
+    # Rows are written in key order, so concurrent adjustments of the
+    # same rows take their locks in the same order.
+    db.session.execute(text(
+        f'INSERT INTO {name} ({columns}, {count}) VALUES ({values}, :delta) '
+        f'ON CONFLICT ({columns}) DO UPDATE '
+        f'SET {count} = {name}.{count} + excluded.{count}'),
+        [dict(zip(keys, key), delta=delta) for key, delta in rows])
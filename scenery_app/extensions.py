@@ -1,14 +1,30 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_bcrypt import Bcrypt
 from scenery_app.config import Config
+from scenery_app.instrumentation import init_instrumentation
+from scenery_app.routing import RoutingSQLAlchemy, init_routing
+from scenery_app.ratelimit import init_ratelimit
+from scenery_app.compression import init_compression
+from scenery_app.assets import init_assets, assets_cli
+from scenery_app.streaming import BufferedClient
+from werkzeug.middleware.proxy_fix import ProxyFix
 import os
 
 app = Flask(__name__)
 app.config.from_object(Config)
+app.test_client_class = BufferedClient
 
-db = SQLAlchemy(app)
+db = RoutingSQLAlchemy(app)
+
+init_compression(app)
+init_instrumentation(app)
+init_routing(app)
+init_ratelimit(app)
+init_assets(app)
+
+if app.config['PROXY_FIX_X_FOR']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
 
 ###########################
 # Authentication
@@ -19,9 +35,43 @@ login_manager.login_view = 'auth.login'
 login_manager.init_app(app)
 
 from .models import User
+from .identity import identity_cache
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(user_id)
+    return identity_cache.load(user_id)
+
+bcrypt = Bcrypt(app)
+
+###########################
+# Uploads
+###########################
+
+from .media import UploadRequest
+
+app.request_class = UploadRequest
+
+###########################
+# CLI
+###########################
+
+from .bulk import data_cli
+from .search import search_cli
+from .facets import facets_cli
+from .user_stats import stats_cli
+from .benchmark import bench_cli
+from .jobs import jobs_cli
+from .recommendations import recommend_cli
+from .media import media_cli
+from .migrations import db_cli
 
-bcrypt = Bcrypt(app)
\ No newline at end of file
+app.cli.add_command(data_cli)
+app.cli.add_command(search_cli)
+app.cli.add_command(facets_cli)
+app.cli.add_command(stats_cli)
+app.cli.add_command(bench_cli)
+app.cli.add_command(jobs_cli)
+app.cli.add_command(recommend_cli)
+app.cli.add_command(media_cli)
+app.cli.add_command(db_cli)
+app.cli.add_command(assets_cli)
@@ -0,0 +1,139 @@
+"""
+Faceted browsing of locations by landscape, list and visited date.
+
+Per-landscape and per-list totals live in the FacetCount table and are
+adjusted by the routes that write locations. A facet is only counted
+live when another facet's filter is active, and then only over the rows
+that filter selects through the composite indexes on Location.
+"""
+from collections import Counter
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import func
+
+from scenery_app.counters import add_counts
+from scenery_app.extensions import db
+from scenery_app.models import Location, List, Landscape, FacetCount
+
+FACETS = ('landscape', 'list')
+
+def landscape_name(value):
+    """Normalize an enum member, its name or its value to the name."""
+    if value is None:
+        return None
+    if isinstance(value, Landscape):
+        return value.name
+    if value in Landscape.__members__:
+        return value
+    return Landscape(value).name
+
+def facet_values(landscape, list_id):
+    """The FacetCount keys for a location with these attributes."""
+    values = []
+    if landscape is not None:
+        values.append(('landscape', landscape_name(landscape)))
+    if list_id is not None:
+        values.append(('list', str(list_id)))
+    return values
+
+###########################
+# Maintaining the counts
+###########################
+
+def adjust_counts(deltas):
+    """Apply a {(facet, value): delta} mapping in the current transaction."""
+    add_counts(FacetCount.__table__, deltas)
+
+def facet_key(location):
+    """The (landscape, list_id) pair a location is counted under. Reads
+    the relationship so that it is right before the session flushes."""
+    list_id = location.list.id if location.list is not None else location.list_id
+    return (location.landscape, list_id)
+
+def location_added(location):
+    """Count a new location; call after flushing it, before committing."""
+    adjust_counts(Counter(facet_values(*facet_key(location))))
+
+def location_changed(before, location):
+    """
+    Move a location between facet values. `before` is the facet_key()
+    captured before the form was applied.
+    """
+    deltas = Counter(facet_values(*facet_key(location)))
+    deltas.subtract(Counter(facet_values(*before)))
+    adjust_counts(deltas)
+
+def rebuild():
+    """Recount every facet from the Location table."""
+    FacetCount.query.delete()
+    deltas = Counter()
+    for landscape, count in (db.session.query(Location.landscape,
+            func.count()).group_by(Location.landscape)):
+        if landscape is not None:
+            deltas[('landscape', landscape.name)] = count
+    for list_id, count in (db.session.query(Location.list_id,
+            func.count()).group_by(Location.list_id)):
+        deltas[('list', str(list_id))] = count
+    adjust_counts(deltas)
+    db.session.commit()
+
+###########################
+# Browsing
+###########################
+
+def filter_locations(query, landscape=None, list_id=None,
+        date_from=None, date_to=None, skip=None):
+    """Apply the browse filters, leaving out the facet named `skip`."""
+    if landscape is not None and skip != 'landscape':
+        query = query.filter(Location.landscape == Landscape[landscape])
+    if list_id is not None and skip != 'list':
+        query = query.filter(Location.list_id == list_id)
+    if date_from is not None:
+        query = query.filter(Location.visited_date >= date_from)
+    if date_to is not None:
+        query = query.filter(Location.visited_date <= date_to)
+    return query
+
+def facet_counts(**filters):
+    """
+    Return {'landscape': {name: count}, 'list': {list_id: count}} for the
+    given filters. Each facet ignores its own filter, so users can see
+    what switching to another value would give them.
+    """
+    dates_filtered = (filters.get('date_from') is not None or
+        filters.get('date_to') is not None)
+    live = {
+        'landscape': dates_filtered or filters.get('list_id') is not None,
+        'list': dates_filtered or filters.get('landscape') is not None,
+    }
+    columns = {'landscape': Location.landscape, 'list': Location.list_id}
+    counts = {}
+    for facet in FACETS:
+        if live[facet]:
+            column = columns[facet]
+            rows = filter_locations(
+                db.session.query(column, func.count()),
+                skip=facet, **filters).group_by(column)
+            counts[facet] = {
+                (key.name if facet == 'landscape' else key): count
+                for key, count in rows if key is not None}
+        else:
+            counts[facet] = {
+                (row.value if facet == 'landscape' else int(row.value)):
+                    row.count
+                for row in FacetCount.query.filter_by(facet=facet)
+                if row.count}
+    return counts
+
+###########################
+# Commands
+###########################
+
+facets_cli = AppGroup('facets', help='Manage the browse facet counts.')
+
+@facets_cli.command('rebuild')
+def rebuild_command():
+    """Recount the landscape and list facets from scratch."""
+    rebuild()
+    click.echo('Facet counts rebuilt.')
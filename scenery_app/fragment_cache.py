@@ -0,0 +1,108 @@
+"""
+Cache of rendered page fragments, keyed by a row's id and version.
+
+A location's shared HTML only changes when its `version` column is bumped,
+so (id, version) keys never need explicit invalidation: writers bump the
+version and stale entries simply age out of the LRU. The edit form lists
+every List and Entry as well, so `location_key()` adds the versions of
+those choices to the key. The cache is capped
+by the total size of the fragments it holds (FRAGMENT_CACHE_MAX_BYTES).
+"""
+from collections import OrderedDict
+import threading
+
+from flask import current_app, get_template_attribute
+from sqlalchemy import select
+
+from scenery_app.choices import entry_choices, list_choices
+from scenery_app.instrumentation import metrics
+from scenery_app.models import Location, location_entry_table
+
+class FragmentCache(object):
+    """LRU of {name: html} dicts, bounded by total characters stored."""
+    def __init__(self):
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _sizeof(fragments):
+        return sum(len(html) for html in fragments.values())
+
+    def get(self, key):
+        with self._lock:
+            fragments = self._data.get(key)
+            if fragments is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return fragments
+
+    def set(self, key, fragments):
+        max_bytes = current_app.config['FRAGMENT_CACHE_MAX_BYTES']
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= self._sizeof(old)
+            self._data[key] = fragments
+            self.size += self._sizeof(fragments)
+            while self.size > max_bytes and self._data:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= self._sizeof(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._data), 'bytes': self.size,
+                'hits': self.hits, 'misses': self.misses}
+
+location_cache = FragmentCache()
+metrics.add_source('location_fragments', location_cache.stats)
+
+def location_key(location_id, version):
+    """The cache key of a location's fragments."""
+    return (location_id, version, list_choices.version(),
+        entry_choices.version())
+
+def render_location_fragments(location, form):
+    """Render the cacheable parts of the location page."""
+    macro = lambda name: get_template_attribute(
+        'location_fragments.html', name)
+    return {
+        'header': macro('header')(location),
+        'details': macro('details')(location),
+        'photos': macro('photos')(location),
+        'form': macro('form_fields')(form),
+    }
+
+###########################
+# Versions
+###########################
+
+def bump_location_version(location):
+    """Mark a location's cached fragments stale; commit with the change."""
+    location.version = Location.version + 1
+
+def bump_locations(location_ids):
+    """Mark several locations stale at once, e.g. after a bulk import."""
+    Location.query.filter(Location.id.in_(list(location_ids))).update(
+        {Location.version: Location.version + 1}, synchronize_session=False)
+
+def bump_list_locations(list_ids):
+    """Mark every location in these lists stale, e.g. after a rename."""
+    Location.query.filter(Location.list_id.in_(list(list_ids))).update(
+        {Location.version: Location.version + 1}, synchronize_session=False)
+
+def bump_entry_locations(entry_ids):
+    """Mark every location tagged with these entries stale."""
+    tagged = select([location_entry_table.c.location_id]).where(
+        location_entry_table.c.entry_id.in_(list(entry_ids)))
+    Location.query.filter(Location.id.in_(tagged)).update(
+        {Location.version: Location.version + 1}, synchronize_session=False)
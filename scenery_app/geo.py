@@ -0,0 +1,167 @@
+"""
+Coordinates and nearest-location queries.
+
+Each located row stores its latitude, longitude and geohash. A geohash
+prefix is a lat/lng cell, so the rows in a cell are a range scan on the
+plain B-tree index over `Location.geohash`. That works the same on SQLite
+and PostgreSQL with no extension. A k-nearest query reads the 3x3 block
+of cells around the point, ranks the candidates by haversine distance
+with NumPy, and moves to coarser cells until the k-th result is close
+enough that nothing outside the block could beat it.
+"""
+import math
+
+import numpy as np
+
+from scenery_app.extensions import db
+from scenery_app.models import Location
+
+EARTH_RADIUS_KM = 6371.0088
+GEOHASH_PRECISION = 12
+# Geohash cells at precision 6 are about 1.2km by 0.6km
+FINEST_SEARCH_PRECISION = 6
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+###########################
+# Geohashes
+###########################
+
+def geohash(latitude, longitude, precision=GEOHASH_PRECISION):
+    """Encode a point as a geohash of `precision` characters."""
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    chars, bits, value, even = [], 0, 0, True
+    while len(chars) < precision:
+        ranges, point = ((lng_range, longitude) if even
+            else (lat_range, latitude))
+        middle = (ranges[0] + ranges[1]) / 2
+        value <<= 1
+        if point >= middle:
+            value |= 1
+            ranges[0] = middle
+        else:
+            ranges[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[value])
+            bits, value = 0, 0
+    return ''.join(chars)
+
+def cell_size(precision):
+    """(lat_degrees, lng_degrees) spanned by a geohash cell."""
+    bits = 5 * precision
+    return 180.0 / 2 ** (bits // 2), 360.0 / 2 ** ((bits + 1) // 2)
+
+def neighborhood(latitude, longitude, precision):
+    """The geohash of the cell containing the point and its 8 neighbors."""
+    dlat, dlng = cell_size(precision)
+    cells = set()
+    for i in (-1, 0, 1):
+        lat = latitude + i * dlat
+        if not -90 <= lat <= 90:
+            continue
+        for j in (-1, 0, 1):
+            lng = (longitude + j * dlng + 180) % 360 - 180
+            cells.add(geohash(lat, lng, precision))
+    return sorted(cells)
+
+def set_position(location, latitude, longitude):
+    """Set a location's coordinates, keeping its geohash in step."""
+    location.latitude = latitude
+    location.longitude = longitude
+    location.geohash = position_hash(latitude, longitude)
+
+def position_hash(latitude, longitude):
+    if latitude is None or longitude is None:
+        return None
+    return geohash(latitude, longitude)
+
+###########################
+# Distances
+###########################
+
+def haversine_km(latitude, longitude, latitudes, longitudes):
+    """Great-circle distances from one point to arrays of points."""
+    lat1, lng1 = np.radians(latitude), np.radians(longitude)
+    lat2, lng2 = np.radians(latitudes), np.radians(longitudes)
+    a = (np.sin((lat2 - lat1) / 2) ** 2 +
+        np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+def _safe_radius_km(latitude, precision):
+    """
+    How far from the point the 3x3 block of cells is guaranteed to
+    reach: one cell in every direction, with the cell width measured
+    at the block edge nearest a pole.
+    """
+    dlat, dlng = cell_size(precision)
+    edge = min(abs(latitude) + 1.5 * dlat, 90.0)
+    km_per_degree = math.pi * EARTH_RADIUS_KM / 180
+    return min(dlat, dlng * math.cos(math.radians(edge))) * km_per_degree
+
+def _successor(prefix):
+    """The smallest geohash greater than every hash starting with
+    `prefix`, or None. Sticking to geohash characters keeps the range
+    valid under any collation that sorts digits before letters."""
+    prefix = prefix.rstrip(_BASE32[-1])
+    if not prefix:
+        return None
+    return prefix[:-1] + _BASE32[_BASE32.index(prefix[-1]) + 1]
+
+def _in_cell(cell):
+    upper = _successor(cell)
+    if upper is None:
+        return Location.geohash >= cell
+    return db.and_(Location.geohash >= cell, Location.geohash < upper)
+
+def _candidates(latitude, longitude, precision, max_km, exclude_id):
+    """Located rows in the 3x3 block of cells around the point (every
+    located row at precision 0), inside the `max_km` bounding box."""
+    query = (db.session.query(Location.id, Location.title,
+            Location.latitude, Location.longitude)
+        .filter(Location.geohash.isnot(None)))
+    if precision:
+        query = query.filter(db.or_(*[_in_cell(cell)
+            for cell in neighborhood(latitude, longitude, precision)]))
+    if max_km is not None:
+        dlat = max_km / (math.pi * EARTH_RADIUS_KM / 180)
+        query = query.filter(Location.latitude.between(
+            latitude - dlat, latitude + dlat))
+        edge = abs(latitude) + dlat
+        if edge < 90:
+            dlng = dlat / math.cos(math.radians(edge))
+            if -180 <= longitude - dlng and longitude + dlng <= 180:
+                query = query.filter(Location.longitude.between(
+                    longitude - dlng, longitude + dlng))
+    if exclude_id is not None:
+        query = query.filter(Location.id != exclude_id)
+    return query.all()
+
+def _rank(latitude, longitude, rows, k, max_km):
+    distances = haversine_km(latitude, longitude,
+        np.fromiter((row.latitude for row in rows), float, len(rows)),
+        np.fromiter((row.longitude for row in rows), float, len(rows)))
+    order = np.argsort(distances, kind='stable')
+    if max_km is not None:
+        order = order[distances[order] <= max_km]
+    return [(rows[i], float(distances[i])) for i in order[:k]]
+
+def nearest(latitude, longitude, k=10, max_km=None, exclude_id=None):
+    """
+    The `k` locations nearest to a point as (row, distance_km) pairs,
+    closest first, optionally only those within `max_km`.
+    """
+    for precision in range(FINEST_SEARCH_PRECISION, -1, -1):
+        safe_km = (_safe_radius_km(latitude, precision) if precision
+            else math.inf)
+        if max_km is not None and safe_km < max_km:
+            # The block wouldn't cover the whole radius.
+            continue
+        ranked = _rank(latitude, longitude, _candidates(latitude, longitude,
+            precision, max_km, exclude_id), k, max_km)
+        # Anything outside the block is further than safe_km, so the
+        # ranking is final once the k-th candidate is inside that radius.
+        if (max_km is not None or
+                (len(ranked) == k and ranked[-1][1] <= safe_km) or
+                precision == 0):
+            return ranked
@@ -0,0 +1,113 @@
+"""
+Conditional GETs for pages.
+
+A view decorated with `conditional(validators)` first calls
+`validators(**view_args)`, which returns (parts, last_modified) from a
+cheap query: `parts` is anything that changes whenever the page would,
+such as row versions or MAX(updated_at), and `last_modified` is when the
+page last changed, or None if that isn't known. The ETag hashes the
+parts together with the viewer, so when the client's copy is still
+current the answer is a 304 without running the view or rendering the
+template.
+
+Pages for anonymous viewers are the same for everyone: they may be kept
+by shared caches (`public`) and also carry Last-Modified, so clients
+that only send If-Modified-Since get 304s too. Pages for logged-in
+viewers are `private` and validated by ETag alone, as they depend on
+more than the rows' timestamps. Either way the client must revalidate
+(`no-cache`), and Vary: Cookie keeps the two apart.
+
+A CSRF token in a page expires WTF_CSRF_TIME_LIMIT after it was
+rendered, so validators of pages with forms include `csrf_period()` to
+have them rendered again before their copy's token runs out.
+"""
+from functools import wraps
+import hashlib
+import time
+
+from flask import current_app, make_response, request, session
+from flask_login import current_user
+
+from scenery_app.assets import asset_version
+
+def make_etag(parts, user_id=None):
+    """An ETag for `parts` as seen by `user_id`. It also changes with the
+    asset build, as the page links to the assets by their hashes."""
+    key = repr((current_app.config['HTTP_CACHE_VERSION'], asset_version(),
+        request.endpoint, user_id, parts))
+    return hashlib.sha1(key.encode()).hexdigest()[:24]
+
+def csrf_period():
+    """
+    The stretch of time, half WTF_CSRF_TIME_LIMIT long, that a page
+    rendered now falls in. A copy is only revalidated until its stretch
+    ends, so its token has at least half its lifetime left when a 304
+    keeps it.
+    """
+    limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    if not limit:
+        return None
+    return int(time.time() // (limit / 2))
+
+def not_modified(etag, last_modified=None):
+    """Whether the client's copy, by its conditional headers, is current."""
+    if request.if_none_match:
+        # Weak comparison, as compression.py weakens the ETags it gzips.
+        return request.if_none_match.contains_weak(etag)
+    # If-Modified-Since only counts when there is no If-None-Match.
+    since = request.if_modified_since
+    return bool(since and last_modified and
+        last_modified.replace(microsecond=0) <= since)
+
+def set_cache_headers(response, public):
+    shared_max_age = current_app.config['HTTP_CACHE_SHARED_MAX_AGE']
+    if public and shared_max_age:
+        response.headers['Cache-Control'] = (
+            f'public, max-age=0, s-maxage={shared_max_age}, must-revalidate')
+    else:
+        response.headers['Cache-Control'] = (
+            f'{"public" if public else "private"}, no-cache')
+    response.vary.add('Cookie')
+
+def conditional(validators, public=True):
+    """
+    Answer GET and HEAD requests for the view with a 304 when the
+    client's copy is current. Pass public=False for pages that are never
+    the same for two clients, e.g. ones with a CSRF token in a form.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
+            parts, last_modified = validators(**kwargs)
+            user_id = (current_user.get_id()
+                if current_user.is_authenticated else None)
+            if user_id is not None:
+                last_modified = None
+            etag = make_etag(parts, user_id)
+
+            # Flashed messages are shown once, so are never left unseen
+            # behind a 304.
+            if not session.get('_flashes') and not_modified(
+                    etag, last_modified):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # A page that set a cookie, e.g. a new session, is that
+            # client's alone.
+            set_cache_headers(response, public and user_id is None and
+                not session.modified)
+            return response
+        return wrapper
+    return decorator
+
+def newest(*times):
+    """The latest of some timestamps, ignoring Nones."""
+    times = [time for time in times if time is not None]
+    return max(times) if times else None
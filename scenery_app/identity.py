@@ -0,0 +1,100 @@
+"""
+Cache of logged-in users' identities for Flask-Login.
+
+`base.html` reads current_user on every page, so without a cache each
+authenticated request starts with a SELECT on the user table. Identities
+(only the columns needed to recognise the user) are kept in a per-process
+LRU for IDENTITY_CACHE_TTL seconds, backed by an optional shared store
+(IDENTITY_CACHE_URL, see kvstore.py) so other workers can reuse them.
+"""
+import threading
+
+from flask_login import UserMixin
+
+from scenery_app.extensions import app, db
+from scenery_app.instrumentation import metrics
+from scenery_app.kvstore import MemoryStore, store_from_url
+from scenery_app.models import User
+
+class CachedUser(UserMixin):
+    """What current_user is for authenticated requests: just the id and
+    username, without the ORM object or password hash."""
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+    def __repr__(self):
+        return f'<CachedUser: {self.username}>'
+
+class IdentityCache(object):
+    """Two-level (local, then shared) cache of user identities."""
+    def __init__(self):
+        self.local = None
+        self.shared = None
+        self._lock = threading.Lock()
+        self.counts = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+
+    def _stores(self):
+        if self.local is None:
+            self.local = MemoryStore(app.config['IDENTITY_CACHE_SIZE'])
+            url = app.config['IDENTITY_CACHE_URL']
+            self.shared = store_from_url(url, 'identity') if url else None
+        return self.local, self.shared
+
+    def _count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+
+    def load(self, user_id):
+        """The CachedUser for `user_id`, or None if there is no such user."""
+        key = str(user_id)
+        ttl = app.config['IDENTITY_CACHE_TTL']
+        local, shared = self._stores()
+
+        identity = local.get(key)
+        if identity is not None:
+            self._count('local_hits')
+            return CachedUser(*identity)
+
+        if shared is not None:
+            identity = shared.get(key)
+            if identity is not None:
+                self._count('shared_hits')
+                local.set(key, identity, ttl)
+                return CachedUser(*identity)
+
+        self._count('misses')
+        row = (db.session.query(User.id, User.username)
+            .filter(User.id == int(user_id)).first())
+        if row is None:
+            return None
+        identity = [row.id, row.username]
+        local.set(key, identity, ttl)
+        if shared is not None:
+            shared.set(key, identity, ttl)
+        return CachedUser(*identity)
+
+    def invalidate(self, user_id):
+        """Forget a user, e.g. on logout or when their profile changes."""
+        key = str(user_id)
+        local, shared = self._stores()
+        local.delete(key)
+        if shared is not None:
+            shared.delete(key)
+
+    def clear(self):
+        local, shared = self._stores()
+        local.clear()
+        if shared is not None:
+            shared.clear()
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self.counts)
+        lookups = sum(counts.values())
+        counts['hit_rate'] = round(
+            (lookups - counts['misses']) / lookups, 3) if lookups else None
+        return counts
+
+identity_cache = IdentityCache()
+metrics.add_source('identity_cache', identity_cache.stats)
@@ -0,0 +1,281 @@
+"""
+Opt-in per-request profiling: SQL statement counts and timings, template
+render time and wall time for every blueprint endpoint.
+
+Turn it on with INSTRUMENTATION_ENABLED. Each response then carries a
+Server-Timing header (and X-SQL-Queries), per-endpoint histograms are
+served as JSON from /_metrics to clients that send the
+INSTRUMENTATION_METRICS_TOKEN as a bearer token, and requests that repeat
+one statement more than N_PLUS_ONE_THRESHOLD times are logged as likely
+N+1 patterns. Streamed responses are recorded once their body has been
+sent, and get no headers, as those go out before most of the work is done.
+
+The same profile counts statements for QUERY_LIMIT, which logs requests
+that run more of them than it allows, and `count_queries()` counts them
+for a block of code, e.g. in tests.
+"""
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import heapq
+import hmac
+import logging
+import re
+import threading
+import time
+
+from flask import g, has_request_context, jsonify, request, abort, current_app
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (ms) of the latency histogram buckets; the last is +inf.
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_IN_LIST = re.compile(r'\((?:\s*\?\s*,)+\s*\?\s*\)|\((?:\s*%\(\w+\)s\s*,)+\s*%\(\w+\)s\s*\)')
+
+def statement_template(statement):
+    """Collapse IN lists so the same query with different sizes matches."""
+    return _IN_LIST.sub('(?)', ' '.join(statement.split()))
+
+class RequestProfile(object):
+    """Everything recorded about one request."""
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.query_count = 0
+        self.sql_time = 0.0
+        self.render_time = 0.0
+        self.slowest = []  # min-heap of (duration, statement)
+        self.templates = Counter()
+
+    def add_query(self, statement, duration, keep):
+        self.query_count += 1
+        self.sql_time += duration
+        self.templates[statement_template(statement)] += 1
+        item = (duration, statement)
+        if len(self.slowest) < keep:
+            heapq.heappush(self.slowest, item)
+        elif keep:
+            heapq.heappushpop(self.slowest, item)
+
+    def slowest_statements(self):
+        return sorted(self.slowest, reverse=True)
+
+class Histogram(object):
+    """Fixed-bucket latency histogram."""
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS_MS) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, ms):
+        self.counts[bisect_left(BUCKETS_MS, ms)] += 1
+        self.total += ms
+        self.count += 1
+
+    def to_dict(self):
+        bounds = [str(bound) for bound in BUCKETS_MS] + ['+Inf']
+        return {
+            'buckets': [list(pair) for pair in zip(bounds, self.counts)],
+            'count': self.count,
+            'sum_ms': round(self.total, 3),
+        }
+
+class EndpointMetrics(object):
+    """Aggregates for one endpoint across requests."""
+    def __init__(self):
+        self.wall = Histogram()
+        self.sql = Histogram()
+        self.render = Histogram()
+        self.queries = 0
+        self.slowest = []
+
+    def observe(self, profile, wall_ms, keep):
+        self.wall.observe(wall_ms)
+        self.sql.observe(profile.sql_time * 1000)
+        self.render.observe(profile.render_time * 1000)
+        self.queries += profile.query_count
+        for item in profile.slowest:
+            if len(self.slowest) < keep:
+                heapq.heappush(self.slowest, item)
+            elif keep:
+                heapq.heappushpop(self.slowest, item)
+
+    def to_dict(self):
+        return {
+            'wall': self.wall.to_dict(),
+            'sql': self.sql.to_dict(),
+            'render': self.render.to_dict(),
+            'queries_per_request': (
+                round(self.queries / self.wall.count, 2)
+                if self.wall.count else 0),
+            'slowest_statements': [
+                {'ms': round(duration * 1000, 3), 'statement': statement}
+                for duration, statement in sorted(self.slowest, reverse=True)],
+        }
+
+class Metrics(object):
+    """Process-wide per-endpoint metrics, plus any extra sources (e.g.
+    cache hit counters) registered with `add_source()`."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = defaultdict(EndpointMetrics)
+        self.sources = {}
+
+    def add_source(self, name, fn):
+        """Include `fn()` under `name` in the metrics output."""
+        self.sources[name] = fn
+
+    def observe(self, endpoint, profile, wall_ms, keep):
+        with self._lock:
+            self.endpoints[endpoint].observe(profile, wall_ms, keep)
+
+    def reset(self):
+        with self._lock:
+            self.endpoints.clear()
+
+    def to_dict(self):
+        with self._lock:
+            data = {endpoint: metrics.to_dict()
+                for endpoint, metrics in sorted(self.endpoints.items())}
+        for name, fn in self.sources.items():
+            data[name] = fn()
+        return data
+
+metrics = Metrics()
+
+def current_profile():
+    """The RequestProfile for the current request, if one is recording."""
+    if has_request_context():
+        return g.get('_profile')
+    return None
+
+class QueryCounter(object):
+    """Collects the statements executed while it is active."""
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+_active_counters = []
+
+@contextmanager
+def count_queries():
+    """
+    Count the SQL statements executed inside the block, e.g.
+
+        with count_queries() as counter:
+            client.get('/location/1')
+        assert counter.count <= 2
+    """
+    counter = QueryCounter()
+    _active_counters.append(counter)
+    try:
+        yield counter
+    finally:
+        _active_counters.remove(counter)
+
+###########################
+# Hooks
+###########################
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _query_started(conn, cursor, statement, parameters, context, executemany):
+    for counter in _active_counters:
+        counter.statements.append(statement)
+    conn.info.setdefault('_query_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _query_finished(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['_query_started'].pop()
+    profile = current_profile()
+    if profile is not None:
+        profile.add_query(statement, time.perf_counter() - started,
+            current_app.config['INSTRUMENTATION_SLOW_QUERIES'])
+
+class TimedTemplate(Template):
+    """Template that adds its render time to the request's profile."""
+    def render(self, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            profile = current_profile()
+            if profile is not None:
+                profile.render_time += time.perf_counter() - started
+
+def init_instrumentation(app):
+    """Install the request hooks on `app`. They do nothing unless
+    INSTRUMENTATION_ENABLED is set."""
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.before_request
+    def _start_profile():
+        if request.blueprint and (app.config['INSTRUMENTATION_ENABLED'] or
+                app.config['QUERY_LIMIT']):
+            g._profile = RequestProfile()
+
+    def _record(endpoint, profile):
+        wall_ms = (time.perf_counter() - profile.started) * 1000
+        limit = app.config['QUERY_LIMIT']
+        if limit and profile.query_count > limit:
+            logger.warning('%s ran %d queries (limit %d)',
+                endpoint, profile.query_count, limit)
+        if not app.config['INSTRUMENTATION_ENABLED']:
+            return wall_ms
+
+        metrics.observe(endpoint, profile, wall_ms,
+            app.config['INSTRUMENTATION_SLOW_QUERIES'])
+
+        threshold = app.config['N_PLUS_ONE_THRESHOLD']
+        if threshold:
+            for template, count in profile.templates.items():
+                if count > threshold:
+                    logger.warning('Possible N+1 in %s: %d x %s',
+                        endpoint, count, template)
+
+        slow_ms = app.config['INSTRUMENTATION_SLOW_REQUEST_MS']
+        if slow_ms and wall_ms > slow_ms:
+            logger.warning('Slow request %s: %.1fms, %d queries (%.1fms), '
+                'slowest: %s', endpoint, wall_ms, profile.query_count,
+                profile.sql_time * 1000, profile.slowest_statements()[:1])
+        return wall_ms
+
+    @app.after_request
+    def _finish_profile(response):
+        profile = g.get('_profile')
+        if profile is None:
+            return response
+        if response.is_streamed:
+            # The body, and the queries that feed it, come after the
+            # headers: record the request once it has all been sent.
+            endpoint = request.endpoint
+            response.call_on_close(lambda: _record(endpoint, profile))
+            return response
+        g.pop('_profile')
+        wall_ms = _record(request.endpoint, profile)
+
+        if (app.config['INSTRUMENTATION_ENABLED'] and
+                app.config['INSTRUMENTATION_HEADERS']):
+            response.headers['Server-Timing'] = (
+                f'db;dur={profile.sql_time * 1000:.2f}, '
+                f'render;dur={profile.render_time * 1000:.2f}, '
+                f'total;dur={wall_ms:.2f}')
+            response.headers['X-SQL-Queries'] = str(profile.query_count)
+        return response
+
+    @app.route('/_metrics')
+    def instrumentation_metrics():
+        # The metrics include SQL text, so they are only served to clients
+        # holding the token, and not at all without one.
+        token = app.config['INSTRUMENTATION_METRICS_TOKEN']
+        if not app.config['INSTRUMENTATION_ENABLED'] or not token:
+            abort(404)
+        if not hmac.compare_digest(
+                request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(403)
+        return jsonify(metrics.to_dict())
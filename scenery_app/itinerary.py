@@ -0,0 +1,342 @@
+"""
+Itineraries: the locations of a list, or of a user's visitlist, in the
+order that travels the least distance between them.
+
+The engine works on a NumPy matrix of great-circle distances. It builds a
+route by nearest neighbour, then improves it with 2-opt (reversing a
+stretch of the route) and Or-opt (moving one to three consecutive stops
+elsewhere, either way round) until neither finds a shorter route or
+ITINERARY_TIME_BUDGET runs out. Each move is scored against every
+position at once with array arithmetic, so a pass over a few hundred
+stops is a few thousand vector operations rather than millions of Python
+steps.
+
+Stops with a `visited_date` keep their date order: each date is a window
+that has to come after the earlier ones, while stops on the same date,
+and stops without one, go wherever is shortest. The route is open: it
+starts at the client's position (?lat=&lng=) if given, otherwise at
+whichever end suits it, and doesn't return. Locations without
+coordinates are listed separately.
+
+Routes are cached under a hash of the stops' ids, positions and dates, so
+the same list is only optimized again once one of those changes. Large
+lists are optimized on a pool of processes, keeping the web thread's GIL
+free for other requests.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import threading
+import time
+
+import numpy as np
+from flask import current_app
+
+from scenery_app.geo import haversine_km
+from scenery_app.kvstore import MemoryStore, store_from_url
+
+# Change when the engine changes, so cached routes are planned again.
+ENGINE_VERSION = 1
+# Longest run of stops Or-opt moves at once
+OR_OPT_LENGTH = 3
+# Ignore improvements smaller than this (km), which are rounding noise
+EPSILON = 1e-9
+
+###########################
+# Engine
+###########################
+
+def distance_matrix(latitudes, longitudes):
+    """Great-circle distances (km) between every pair of points."""
+    latitudes = np.asarray(latitudes, dtype=float)
+    longitudes = np.asarray(longitudes, dtype=float)
+    return haversine_km(latitudes[:, None], longitudes[:, None],
+        latitudes[None, :], longitudes[None, :])
+
+def date_ranks(dates):
+    """Each date's position among the distinct dates, or -1 for None."""
+    ordered = sorted(set(date for date in dates if date is not None))
+    position = {date: rank for rank, date in enumerate(ordered)}
+    return np.array([position.get(date, -1) for date in dates], dtype=int)
+
+def _with_start(dist, start):
+    """
+    Add a stop that the route begins and ends at: distances from it are
+    those from the start (or nothing, without one) and going back to it
+    is free, which turns the open route into a closed tour.
+    """
+    n = len(dist)
+    full = np.zeros((n + 1, n + 1))
+    full[:n, :n] = dist
+    if start is not None:
+        full[n, :n] = start
+    return full
+
+def nearest_neighbour(dist, ranks, start=None):
+    """
+    A first route: from the start, always go to the closest stop allowed
+    next. Without a start, begin with the most remote allowed stop, as
+    the ends of a short open route tend to be its outliers.
+    """
+    n = len(ranks)
+    dated = ranks >= 0
+    left = np.bincount(ranks[dated], minlength=1)
+    next_rank = int(np.argmax(left > 0)) if dated.any() else -1
+    unvisited = np.ones(n, dtype=bool)
+    scores = start if start is not None else -dist.sum(axis=1)
+    order = np.empty(n, dtype=int)
+    for step in range(n):
+        allowed = unvisited & (~dated | (ranks == next_rank))
+        stop = int(np.argmin(np.where(allowed, scores, np.inf)))
+        order[step] = stop
+        unvisited[stop] = False
+        if dated[stop]:
+            left[ranks[stop]] -= 1
+            while next_rank < len(left) and left[next_rank] == 0:
+                next_rank += 1
+        scores = dist[stop]
+    return order
+
+def _bounds(route, ranks):
+    """Per position, the stop's date rank as a lower and an upper bound:
+    undated stops (and the start) bound nothing."""
+    ranks = np.append(ranks, -1)[route]
+    low = np.where(ranks >= 0, ranks, np.iinfo(int).max)
+    high = np.where(ranks >= 0, ranks, -1)
+    return low, high
+
+def two_opt(route, dist, ranks, deadline):
+    """
+    One pass of 2-opt over a tour starting and ending at the start stop.
+    For each position i, reverse the stretch route[i:j+1] for the j that
+    shortens the tour most. Only stretches whose dated stops all share a
+    date may be reversed. Returns whether anything improved.
+    """
+    improved = False
+    m = len(route)
+    for i in range(1, m - 2):
+        if time.perf_counter() > deadline:
+            break
+        a, b = route[i - 1], route[i]
+        c, e = route[i + 1:m - 1], route[i + 2:m]
+        delta = dist[a, c] + dist[b, e] - dist[a, b] - dist[c, e]
+        low, high = _bounds(route[i:m - 1], ranks)
+        same_date = (np.maximum.accumulate(high) <=
+            np.minimum.accumulate(low))[1:]
+        delta[~same_date] = 0
+        k = int(np.argmin(delta))
+        if delta[k] < -EPSILON:
+            j = i + 1 + k
+            route[i:j + 1] = route[i:j + 1][::-1]
+            improved = True
+    return improved
+
+def or_opt(route, dist, ranks, deadline):
+    """
+    One pass of Or-opt: for each run of one to OR_OPT_LENGTH stops, move
+    it (reversed, if that is shorter and its stops share a date) between
+    the two stops where that shortens the tour most, provided its dates
+    still fit between those of the stops it passes. Returns whether
+    anything improved.
+    """
+    improved = False
+    m = len(route)
+    i = 1
+    while i < m - 1:
+        if time.perf_counter() > deadline:
+            break
+        moved = False
+        u, v = route[:-1], route[1:]
+        base = dist[u, v]
+        low, high = _bounds(route, ranks)
+        for length in range(1, min(OR_OPT_LENGTH, m - 1 - i) + 1):
+            end = i + length
+            p, s0, s1, q = route[i - 1], route[i], route[end - 1], route[end]
+            removed = dist[p, s0] + dist[s1, q] - dist[p, q]
+            forward = dist[u, s0] + dist[s1, v] - base
+            backward = dist[u, s1] + dist[s0, v] - base
+
+            first, last = low[i:end].min(), high[i:end].max()
+            feasible = np.zeros(m - 1, dtype=bool)
+            if last < 0:
+                # No dated stops in the run: it can go anywhere.
+                feasible[:i - 1] = True
+                feasible[end:] = True
+            else:
+                # Moving it earlier passes route[k+1:i], later route[end:k+1].
+                feasible[:i - 1] = np.minimum.accumulate(
+                    low[1:i][::-1])[::-1] >= last
+                feasible[end:] = np.maximum.accumulate(high[end:m - 1]) <= first
+            reversible = feasible & (last < 0 or first == last)
+
+            forward = np.where(feasible, forward, np.inf)
+            backward = np.where(reversible, backward, np.inf)
+            k_forward, k_backward = np.argmin(forward), np.argmin(backward)
+            if forward[k_forward] <= backward[k_backward]:
+                k, cost, run = k_forward, forward[k_forward], route[i:end]
+            else:
+                k, cost, run = (k_backward, backward[k_backward],
+                    route[i:end][::-1])
+            if cost - removed < -EPSILON:
+                rest = np.concatenate([route[:i], route[end:]])
+                at = k + 1 if k < i else k + 1 - length
+                route[:] = np.concatenate([rest[:at], run, rest[at:]])
+                improved = moved = True
+                break
+        if not moved:
+            i += 1
+    return improved
+
+def optimize(latitudes, longitudes, dates, start=None, time_budget=0.5):
+    """
+    The order (indexes into the arguments) to visit the points in, given
+    the date of each (or None) and optionally a (latitude, longitude) to
+    start from. Stops improving once `time_budget` seconds have passed.
+    """
+    deadline = time.perf_counter() + time_budget
+    n = len(latitudes)
+    if n < 2:
+        return list(range(n))
+    dist = distance_matrix(latitudes, longitudes)
+    ranks = date_ranks(dates)
+    start_km = None if start is None else haversine_km(start[0], start[1],
+        np.asarray(latitudes, dtype=float), np.asarray(longitudes, dtype=float))
+
+    order = nearest_neighbour(dist, ranks, start_km)
+    full = _with_start(dist, start_km)
+    route = np.concatenate([[n], order, [n]])
+    while time.perf_counter() < deadline:
+        improved = two_opt(route, full, ranks, deadline)
+        improved = or_opt(route, full, ranks, deadline) or improved
+        if not improved:
+            break
+    return [int(stop) for stop in route[1:-1]]
+
+###########################
+# Pool
+###########################
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """The process-wide itinerary pool, created on first use."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ProcessPoolExecutor(
+                    max_workers=current_app.config['ITINERARY_WORKERS'])
+    return _executor
+
+def shutdown():
+    """Stop the pool, e.g. in a gunicorn post_fork hook."""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+def _solve(latitudes, longitudes, dates, start):
+    config = current_app.config
+    budget = config['ITINERARY_TIME_BUDGET']
+    if (config['ITINERARY_EXECUTOR'] == 'inline' or
+            len(latitudes) < config['ITINERARY_POOL_MIN_STOPS']):
+        return optimize(latitudes, longitudes, dates, start, budget)
+    # Leave the worker time to start and build its matrix.
+    return get_executor().submit(optimize, latitudes, longitudes, dates,
+        start, budget).result(timeout=budget + 10)
+
+###########################
+# Cache
+###########################
+
+_stores = None
+_stores_lock = threading.Lock()
+
+def cache_stores():
+    """The per-process LRU of routes and the optional shared store."""
+    global _stores
+    if _stores is None:
+        with _stores_lock:
+            if _stores is None:
+                config = current_app.config
+                url = config['ITINERARY_CACHE_URL']
+                _stores = (MemoryStore(config['ITINERARY_CACHE_SIZE']),
+                    store_from_url(url, 'itinerary') if url else None)
+    return _stores
+
+def content_hash(stops, start=None):
+    """A key for the route through `stops`: only their ids, positions and
+    dates (and the start) matter to it, not e.g. their titles."""
+    content = [ENGINE_VERSION, start, [[stop.id, stop.latitude,
+            stop.longitude, stop.visited_date and stop.visited_date.isoformat()]
+        for stop in stops]]
+    return hashlib.sha256(json.dumps(content).encode()).hexdigest()
+
+def route_ids(stops, start=None):
+    """The ids of `stops` (rows with id, latitude, longitude and
+    visited_date, all located) in itinerary order, cached."""
+    stops = sorted(stops, key=lambda stop: stop.id)
+    key = content_hash(stops, start)
+    ttl = current_app.config['ITINERARY_CACHE_TTL']
+    local, shared = cache_stores()
+    ids = local.get(key)
+    if ids is None and shared is not None:
+        ids = shared.get(key)
+        if ids is not None:
+            local.set(key, ids, ttl)
+    if ids is None:
+        order = _solve([stop.latitude for stop in stops],
+            [stop.longitude for stop in stops],
+            [stop.visited_date for stop in stops], start)
+        ids = [stops[index].id for index in order]
+        local.set(key, ids, ttl)
+        if shared is not None:
+            shared.set(key, ids, ttl)
+    return ids
+
+def clear_cache():
+    if _stores is None:
+        return
+    local, shared = _stores
+    local.clear()
+    if shared is not None:
+        shared.clear()
+
+###########################
+# Itineraries
+###########################
+
+def itinerary(rows, start=None):
+    """
+    The itinerary through `rows` (id, title, latitude, longitude and
+    visited_date) as JSON-ready data: the located stops in order with the
+    distance to each from the one before, and the rest unordered.
+    """
+    located = [row for row in rows
+        if row.latitude is not None and row.longitude is not None]
+    by_id = {row.id: row for row in located}
+    stops = [by_id[id] for id in route_ids(located, start)]
+
+    legs = []
+    if stops:
+        latitudes = np.array([stop.latitude for stop in stops])
+        longitudes = np.array([stop.longitude for stop in stops])
+        legs = haversine_km(latitudes[:-1], longitudes[:-1],
+            latitudes[1:], longitudes[1:]).tolist()
+        first = (haversine_km(start[0], start[1], latitudes[0], longitudes[0])
+            if start is not None else 0.0)
+        legs = [float(first)] + legs
+
+    def describe(row):
+        return {'id': row.id, 'title': row.title,
+            'latitude': row.latitude, 'longitude': row.longitude,
+            'visited_date': row.visited_date and row.visited_date.isoformat()}
+
+    return {
+        'stops': [dict(describe(stop), leg_km=round(leg, 3))
+            for stop, leg in zip(stops, legs)],
+        'total_km': round(sum(legs), 3),
+        'unlocated': [describe(row) for row in rows if row.id not in by_id],
+    }
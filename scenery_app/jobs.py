@@ -0,0 +1,298 @@
+"""
+Background jobs stored in the application database.
+
+Routes call `enqueue(name, **payload)` instead of doing slow side effects
+inline. The job row is added to the request's session, so it is committed
+(or rolled back) together with the write that caused it. Workers claim
+jobs with a conditional UPDATE, which works the same on SQLite and
+PostgreSQL without a separate broker.
+
+JOBS_EXECUTOR picks who runs them:
+
+    'thread'    a pool of JOBS_WORKERS threads in each web process
+    'external'  only `flask jobs work` processes
+    'inline'    run the handler immediately, in the caller's transaction
+
+Failed jobs are retried with exponential backoff, and after
+JOBS_MAX_ATTEMPTS they move to the DeadJob table. Handlers run inside a
+transaction the worker commits, so they must not commit themselves.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+import json
+import os
+import socket
+import threading
+import time
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import and_, func, or_
+
+from scenery_app.extensions import db
+from scenery_app.instrumentation import Histogram, metrics
+from scenery_app.models import Job, DeadJob
+
+_handlers = {}
+
+def job(name):
+    """Register the decorated function as the handler for `name`."""
+    def register(fn):
+        _handlers[name] = fn
+        return fn
+    return register
+
+def enqueue(name, max_attempts=None, delay=0, **payload):
+    """
+    Queue `name` to run with `payload` (JSON-serializable keyword
+    arguments) once the current transaction commits.
+    """
+    if name not in _handlers:
+        raise LookupError(f'No job handler registered for {name!r}')
+    config = current_app.config
+    if config['JOBS_EXECUTOR'] == 'inline':
+        _handlers[name](**payload)
+        return None
+    queued = Job(name=name, payload=json.dumps(payload),
+        max_attempts=max_attempts or config['JOBS_MAX_ATTEMPTS'],
+        run_at=datetime.utcnow() + timedelta(seconds=delay))
+    db.session.add(queued)
+    if config['JOBS_EXECUTOR'] == 'thread':
+        get_pool().wake()
+    return queued
+
+###########################
+# Running jobs
+###########################
+
+class JobStats(object):
+    """Per-job-name timings and outcomes for this process."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.timings = defaultdict(Histogram)
+        self.outcomes = defaultdict(lambda: {'ok': 0, 'retried': 0, 'dead': 0})
+
+    def observe(self, name, ms, outcome):
+        with self._lock:
+            self.timings[name].observe(ms)
+            self.outcomes[name][outcome] += 1
+
+    def reset(self):
+        with self._lock:
+            self.timings.clear()
+            self.outcomes.clear()
+
+    def to_dict(self):
+        with self._lock:
+            return {name: dict(self.outcomes[name], **timing.to_dict())
+                for name, timing in sorted(self.timings.items())}
+
+stats = JobStats()
+
+def queue_depth():
+    """{'queued': n, 'running': n, 'dead': n} across all processes."""
+    depth = {'queued': 0, 'running': 0}
+    depth.update(db.session.query(Job.status, func.count())
+        .group_by(Job.status))
+    depth['dead'] = db.session.query(func.count(DeadJob.id)).scalar()
+    return depth
+
+def _metrics():
+    return dict(queue_depth(), jobs=stats.to_dict())
+
+metrics.add_source('jobs', _metrics)
+
+def claim(worker_id):
+    """
+    Atomically take the oldest runnable job, or one whose worker has held
+    it longer than JOBS_TIMEOUT, and commit the claim. Returns the job's
+    id or None.
+    """
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=current_app.config['JOBS_TIMEOUT'])
+    runnable = or_(
+        and_(Job.status == 'queued', Job.run_at <= now),
+        and_(Job.status == 'running', Job.locked_at < stale))
+    candidates = [id for (id,) in db.session.query(Job.id)
+        .filter(runnable).order_by(Job.run_at).limit(5)]
+    for id in candidates:
+        # Another worker may claim the same candidate first; the WHERE
+        # clause makes only one of the UPDATEs match.
+        claimed = (Job.query.filter(Job.id == id, runnable)
+            .update({Job.status: 'running', Job.locked_by: worker_id,
+                Job.locked_at: now, Job.attempts: Job.attempts + 1},
+                synchronize_session=False))
+        db.session.commit()
+        if claimed:
+            return id
+    return None
+
+def run_job(id):
+    """Run a claimed job, then delete it, reschedule it or bury it."""
+    claimed = Job.query.get(id)
+    name = claimed.name
+    start = time.perf_counter()
+    try:
+        handler = _handlers.get(name)
+        if handler is None:
+            raise LookupError(f'No job handler registered for {name!r}')
+        handler(**json.loads(claimed.payload))
+        db.session.delete(claimed)
+        db.session.commit()
+    except Exception as error:
+        db.session.rollback()
+        current_app.logger.exception('Job %s #%s failed', name, id)
+        claimed = Job.query.get(id)
+        if claimed.attempts >= claimed.max_attempts:
+            db.session.add(DeadJob(name=claimed.name,
+                payload=claimed.payload, attempts=claimed.attempts,
+                error=repr(error), created_at=claimed.created_at))
+            db.session.delete(claimed)
+            outcome = 'dead'
+        else:
+            delay = current_app.config['JOBS_RETRY_DELAY'] * 2 ** (
+                claimed.attempts - 1)
+            claimed.status = 'queued'
+            claimed.run_at = datetime.utcnow() + timedelta(seconds=delay)
+            claimed.last_error = repr(error)
+            outcome = 'retried'
+        db.session.commit()
+    else:
+        outcome = 'ok'
+    stats.observe(name, (time.perf_counter() - start) * 1000, outcome)
+    return outcome
+
+def work(worker_id=None, burst=False, stop=None, wakeup=None):
+    """
+    Claim and run jobs until `stop` is set, or, with `burst`, until the
+    queue has nothing runnable. Returns the number of jobs run. Must be
+    called inside an app context.
+    """
+    worker_id = worker_id or f'{socket.gethostname()}:{os.getpid()}'
+    interval = current_app.config['JOBS_POLL_INTERVAL']
+    done = 0
+    while stop is None or not stop.is_set():
+        try:
+            id = claim(worker_id)
+        except Exception:
+            # e.g. SQLite's "database is locked"; back off and try again.
+            db.session.rollback()
+            current_app.logger.exception('Could not claim a job')
+            time.sleep(interval)
+            continue
+        if id is not None:
+            try:
+                run_job(id)
+            except Exception:
+                # Couldn't even record the outcome; the claim goes stale
+                # and the job runs again after JOBS_TIMEOUT.
+                db.session.rollback()
+                current_app.logger.exception('Could not finish job #%s', id)
+            done += 1
+            # Start each job with an empty identity map.
+            db.session.remove()
+        elif burst:
+            break
+        elif wakeup is not None:
+            wakeup.wait(interval)
+            wakeup.clear()
+        else:
+            time.sleep(interval)
+    return done
+
+class WorkerPool(object):
+    """JOBS_WORKERS daemon threads polling the queue in this process."""
+    def __init__(self, app, size):
+        self.app = app
+        self.pid = os.getpid()
+        self.stop = threading.Event()
+        self.wakeup = threading.Event()
+        self.threads = [threading.Thread(target=self._run, args=(n,),
+                name=f'jobs-{n}', daemon=True)
+            for n in range(size)]
+        for thread in self.threads:
+            thread.start()
+
+    def _run(self, n):
+        with self.app.app_context():
+            work(f'{socket.gethostname()}:{self.pid}:{n}',
+                stop=self.stop, wakeup=self.wakeup)
+
+    def wake(self):
+        self.wakeup.set()
+
+    def shutdown(self, timeout=None):
+        self.stop.set()
+        self.wakeup.set()
+        for thread in self.threads:
+            thread.join(timeout)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_pool():
+    """This process's worker pool, started on first use (and again in a
+    forked child, which doesn't inherit the parent's threads)."""
+    global _pool
+    if _pool is None or _pool.pid != os.getpid():
+        with _pool_lock:
+            if _pool is None or _pool.pid != os.getpid():
+                _pool = WorkerPool(current_app._get_current_object(),
+                    current_app.config['JOBS_WORKERS'])
+    return _pool
+
+def shutdown():
+    """Stop this process's worker pool, if it was started."""
+    global _pool
+    with _pool_lock:
+        if _pool is not None and _pool.pid == os.getpid():
+            _pool.shutdown(timeout=current_app.config['JOBS_POLL_INTERVAL'])
+        _pool = None
+
+###########################
+# Commands
+###########################
+
+jobs_cli = AppGroup('jobs', help='Run and inspect background jobs.')
+
+@jobs_cli.command('work')
+@click.option('--threads', '-t', default=1, show_default=True)
+@click.option('--burst', is_flag=True,
+    help='Exit once there is nothing left to run.')
+def work_command(threads, burst):
+    """Run a dedicated worker process."""
+    if threads == 1:
+        done = work(burst=burst)
+        click.echo(f'Ran {done} jobs.')
+        return
+    app = current_app._get_current_object()
+    def run(n):
+        with app.app_context():
+            work(f'{socket.gethostname()}:{os.getpid()}:{n}', burst=burst)
+    workers = [threading.Thread(target=run, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+@jobs_cli.command('status')
+def status_command():
+    """Show the queue depth and dead-letter count."""
+    for status, count in queue_depth().items():
+        click.echo(f'{status}: {count}')
+
+@jobs_cli.command('retry')
+@click.option('--name', help='Only retry dead jobs with this name.')
+def retry_command(name):
+    """Move dead jobs back onto the queue."""
+    query = DeadJob.query
+    if name:
+        query = query.filter_by(name=name)
+    dead = query.all()
+    for buried in dead:
+        db.session.add(Job(name=buried.name, payload=buried.payload,
+            max_attempts=current_app.config['JOBS_MAX_ATTEMPTS']))
+        db.session.delete(buried)
+    db.session.commit()
+    click.echo(f'Requeued {len(dead)} jobs.')
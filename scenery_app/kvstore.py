@@ -0,0 +1,241 @@
+"""
+Small key/value stores with expiry, used for caches and counters.
+
+`store_from_url()` picks a backend:
+
+    memory://          per-process LRU (the default)
+    sqlite:////path    a SQLite file shared by every worker on the host, a
+                       stand-in for Redis when one isn't available
+    redis://host:port  Redis, if the redis package is installed
+
+Values must be JSON serializable for the shared backends. Several stores
+can share one database or Redis server: each gets a `namespace` that its
+keys are stored under, and `clear()` only removes that namespace's keys.
+
+Every backend also has `consume()`, an atomic token bucket used for rate
+limiting; on the shared backends all workers draw from the same buckets.
+"""
+from collections import OrderedDict
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+
+def refill(tokens, updated, now, rate, capacity, cost):
+    """
+    One token bucket step: top the bucket up at `rate` tokens a second
+    since `updated`, then try to take `cost`. Returns (tokens left,
+    allowed, seconds until `cost` tokens are available).
+    """
+    tokens = min(capacity, tokens + max(0.0, now - updated) * rate)
+    if tokens >= cost:
+        return tokens - cost, True, 0.0
+    return tokens, False, (cost - tokens) / rate
+
+class MemoryStore(object):
+    """Thread-safe LRU dict with per-key expiry."""
+    def __init__(self, maxsize=10000):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def consume(self, key, rate, capacity, cost=1):
+        """Take `cost` tokens from a bucket holding up to `capacity` and
+        refilling at `rate` a second. Returns (allowed, retry_after)."""
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            tokens, updated = item[0] if item else (capacity, now)
+            tokens, allowed, retry_after = refill(
+                tokens, updated, now, rate, capacity, cost)
+            # A bucket left alone this long is full again anyway.
+            self._data[key] = ((tokens, now), now + capacity / rate)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return allowed, retry_after
+
+class SQLiteStore(object):
+    """Key/value table in a SQLite file, safe across processes."""
+    def __init__(self, path, namespace=None):
+        self.path = path
+        self.namespace = namespace
+        self._local = threading.local()
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS kv ('
+                'key TEXT PRIMARY KEY, value TEXT, expires REAL)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or getattr(self._local, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5,
+                isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def _key(self, key):
+        return f'{self.namespace}:{key}' if self.namespace else key
+
+    def get(self, key):
+        row = self._connect().execute('SELECT value, expires FROM kv '
+            'WHERE key = ?', (self._key(key),)).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return None
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        self._connect().execute(
+            'INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)',
+            (self._key(key), json.dumps(value), expires))
+
+    def delete(self, key):
+        self._connect().execute('DELETE FROM kv WHERE key = ?',
+            (self._key(key),))
+
+    def clear(self):
+        """Remove this namespace's keys, or every key without one."""
+        if not self.namespace:
+            self._connect().execute('DELETE FROM kv')
+            return
+        # ';' sorts right after ':', so this is the range of keys starting
+        # with '<namespace>:', which the primary key index can serve.
+        self._connect().execute('DELETE FROM kv WHERE key >= ? AND key < ?',
+            (f'{self.namespace}:', f'{self.namespace};'))
+
+    def consume(self, key, rate, capacity, cost=1):
+        """Token bucket step in an immediate transaction, so workers on
+        the same host take turns on the bucket."""
+        conn = self._connect()
+        key = self._key(key)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            now = time.time()
+            row = conn.execute('SELECT value, expires FROM kv WHERE key = ?',
+                (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                tokens, updated = capacity, now
+            else:
+                tokens, updated = json.loads(row[0])
+            tokens, allowed, retry_after = refill(
+                tokens, updated, now, rate, capacity, cost)
+            conn.execute('INSERT OR REPLACE INTO kv (key, value, expires) '
+                'VALUES (?, ?, ?)',
+                (key, json.dumps([tokens, now]), now + capacity / rate))
+            self._writes += 1
+            if self._writes % 1000 == 0:
+                # Buckets are written per client; drop the idle ones.
+                conn.execute('DELETE FROM kv WHERE expires < ?', (now,))
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        return allowed, retry_after
+
+class RedisStore(object):
+    """JSON values in Redis."""
+    # The token bucket step as a script, so it is atomic, timed by the
+    # Redis server's clock rather than each host's.
+    CONSUME = """
+        local rate, capacity, cost = tonumber(ARGV[1]), tonumber(ARGV[2]),
+            tonumber(ARGV[3])
+        local time = redis.call('TIME')
+        local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+        local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+        local tokens = tonumber(bucket[1]) or capacity
+        local updated = tonumber(bucket[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+        local allowed, retry_after = 0, (cost - tokens) / rate
+        if tokens >= cost then
+            tokens, allowed, retry_after = tokens - cost, 1, 0
+        end
+        redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate))
+        return {allowed, tostring(retry_after)}
+    """
+
+    def __init__(self, url, namespace=None):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.namespace = namespace
+        self._consume = self.client.register_script(self.CONSUME)
+
+    def _key(self, key):
+        return f'{self.namespace}:{key}' if self.namespace else key
+
+    def get(self, key):
+        value = self.client.get(self._key(key))
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self._key(key), json.dumps(value),
+            ex=int(ttl) if ttl else None)
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        """Remove this namespace's keys, or the whole database without
+        one."""
+        if not self.namespace:
+            self.client.flushdb()
+            return
+        pattern = re.sub(r'([*?\[\]\\])', r'\\\1', self.namespace) + ':*'
+        keys = []
+        for key in self.client.scan_iter(match=pattern, count=1000):
+            keys.append(key)
+            if len(keys) == 1000:
+                self.client.delete(*keys)
+                keys = []
+        if keys:
+            self.client.delete(*keys)
+
+    def consume(self, key, rate, capacity, cost=1):
+        allowed, retry_after = self._consume(keys=[self._key(key)],
+            args=[rate, capacity, cost])
+        return bool(allowed), float(retry_after)
+
+def store_from_url(url, namespace, maxsize=10000):
+    """Build the store a config URL describes, keeping its keys under
+    `namespace` (a memory store is private to its owner anyway)."""
+    if not url or url.startswith('memory://'):
+        return MemoryStore(maxsize)
+    if url.startswith('sqlite:///'):
+        return SQLiteStore(url[len('sqlite:///'):], namespace)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStore(url, namespace)
+    raise ValueError(f'Unsupported store URL: {url}')
@@ -1,11 +1,114 @@
 # Create your forms here.
 
+from flask import url_for
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, DateField, SelectField, SubmitField, TextAreaField
-from wtforms.ext.sqlalchemy.fields import QuerySelectField, QuerySelectMultipleField
-# from wtforms_sqlalchemy.fields import QuerySelectField, QuerySelectMultipleField
-from wtforms.validators import DataRequired, Length
-from scenery_app.models import Landscape, List, Entry
+from flask_wtf.file import FileField, FileRequired
+from wtforms import StringField, PasswordField, DateField, SelectField, SubmitField, TextAreaField, FloatField
+from wtforms.fields import Field
+from wtforms.widgets import Select
+from wtforms.validators import DataRequired, Length, NumberRange, Optional, ValidationError
+from scenery_app.models import Landscape
+from scenery_app.choices import providers
+
+def _coerce_ids(values):
+    """Turn submitted option values into ids, or None if any is bogus."""
+    try:
+        return [int(value) for value in values]
+    except (TypeError, ValueError):
+        return None
+
+class ChoiceSelectWidget(Select):
+    """
+    A <select> fed by a ChoiceProvider. When the table is too large to list
+    in full, only the selected options are rendered and static/typeahead.js
+    searches for the rest.
+    """
+    def __call__(self, field, **kwargs):
+        if field.provider.is_large():
+            kwargs['data-typeahead'] = url_for(
+                'main.search_choices', kind=field.kind)
+        return super().__call__(field, **kwargs)
+
+class ChoiceSelectField(Field):
+    """
+    Select one object from a cached choice list. Like QuerySelectField,
+    `data` is the ORM object, but it is only loaded for the submitted id.
+    """
+    widget = ChoiceSelectWidget()
+
+    def __init__(self, label=None, validators=None, kind=None, **kwargs):
+        super().__init__(label, validators, **kwargs)
+        self.kind = kind
+        self.provider = providers[kind]
+        self._formdata = None
+
+    def _get_data(self):
+        if self._formdata is not None:
+            found = self.provider.get_many(self._formdata)
+            self._set_data(found[0] if found else None)
+        return self._data
+
+    def _set_data(self, data):
+        self._data = data
+        self._formdata = None
+
+    data = property(_get_data, _set_data)
+
+    def _selected_ids(self):
+        if self._formdata is not None:
+            return set(self._formdata)
+        return {self._data.id} if self._data is not None else set()
+
+    def iter_choices(self):
+        selected = self._selected_ids()
+        if self.provider.is_large():
+            choices = self.provider.labels(list(selected))
+        else:
+            choices = self.provider.choices()
+        for id, label in choices:
+            yield (id, label, id in selected)
+
+    def process_formdata(self, valuelist):
+        if valuelist:
+            self._data = None
+            self._formdata = _coerce_ids(valuelist[:1]) or []
+
+    def pre_validate(self, form):
+        if self.data is None:
+            raise ValidationError(self.gettext('Not a valid choice'))
+
+class ChoiceSelectMultipleField(ChoiceSelectField):
+    """Select any number of objects; `data` is a list of ORM objects."""
+    widget = ChoiceSelectWidget(multiple=True)
+
+    def __init__(self, label=None, validators=None, default=None, **kwargs):
+        super().__init__(label, validators, default=default or [], **kwargs)
+        self._invalid = False
+
+    def _get_data(self):
+        if self._formdata is not None:
+            requested = set(self._formdata)
+            found = self.provider.get_many(list(requested))
+            self._invalid = self._invalid or len(found) != len(requested)
+            self._set_data(found)
+        return self._data
+
+    data = property(_get_data, ChoiceSelectField._set_data)
+
+    def _selected_ids(self):
+        if self._formdata is not None:
+            return set(self._formdata)
+        return {obj.id for obj in self._data or []}
+
+    def process_formdata(self, valuelist):
+        ids = _coerce_ids(valuelist)
+        self._invalid = ids is None
+        self._data = []
+        self._formdata = ids or []
+
+    def pre_validate(self, form):
+        if self.data is not None and self._invalid:
+            raise ValidationError(self.gettext('Not a valid choice'))
 
 class LocationForm(FlaskForm):
     """
@@ -14,13 +117,19 @@ class LocationForm(FlaskForm):
     title = StringField('Location Title',
         validators=[DataRequired(), Length(min=3, max=80)])
     visited_date = DateField('Location Visited or When Will Visit:')
-    list = QuerySelectField('List',
-        query_factory=lambda: List.query, allow_blank=False)
+    list = ChoiceSelectField('List', kind='list')
     landscape = SelectField('Landscape', choices=Landscape.choices())
-    entries = QuerySelectMultipleField('Entries',
-        query_factory=lambda: Entry.query)
+    entries = ChoiceSelectMultipleField('Entries', kind='entry')
+    latitude = FloatField('Latitude',
+        validators=[Optional(), NumberRange(min=-90, max=90)])
+    longitude = FloatField('Longitude',
+        validators=[Optional(), NumberRange(min=-180, max=180)])
     submit = SubmitField('Submit')
 
+    def validate_longitude(self, field):
+        if (field.data is None) != (self.latitude.data is None):
+            raise ValidationError('Give both coordinates or neither.')
+
 class ListForm(FlaskForm):
     """
     Form to create a list to create location.
@@ -37,4 +146,12 @@ class EntryForm(FlaskForm):
     """
     name = StringField('Entry:',
         validators=[DataRequired(), Length(min=3, max=700)])
-    submit = SubmitField('Submit')
\ No newline at end of file
+    submit = SubmitField('Submit')
+
+
+class PhotoForm(FlaskForm):
+    """
+    Form to upload a photo of a location.
+    """
+    photo = FileField('Photo', validators=[FileRequired()])
+    submit = SubmitField('Upload')
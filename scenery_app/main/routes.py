@@ -1,20 +1,74 @@
-from flask import Blueprint, request, render_template, redirect, url_for, flash
+from flask import Blueprint, request, render_template, redirect, url_for, flash, abort, jsonify, g
 from flask_login import login_user, logout_user, login_required, current_user
 from datetime import date, datetime
-from scenery_app.models import Location, List, Entry, User
-from scenery_app.main.forms import LocationForm, ListForm, EntryForm
+import math
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+from scenery_app.models import (Location, List, Entry, User, Landscape,
+    favorite_locations_table, visitlist_locations_table)
+from scenery_app.main.forms import LocationForm, ListForm, EntryForm, PhotoForm
 from scenery_app.extensions import app, db, bcrypt
+from scenery_app.pagination import keyset_page, KeysetStream, page_size
+from scenery_app.streaming import stream_template
+from scenery_app.routing import read_only
+from scenery_app.http_cache import conditional, csrf_period, newest
+from scenery_app.choices import providers, list_choices, entry_choices
+from scenery_app.search import index_location, index_entry, search
+from scenery_app.facets import (facet_counts, filter_locations, facet_key,
+    location_added, location_changed)
+from scenery_app.queries import (get_location_detail, get_location_state,
+    has_location, add_location, remove_location)
+from scenery_app.geo import set_position, nearest
+from scenery_app.itinerary import itinerary
+from scenery_app.recommendations import recommended_locations, refresh_later
+from scenery_app.user_stats import (user_stats, collection_changed,
+    favorited_location_changed)
+from scenery_app.fragment_cache import (location_cache, location_key,
+    render_location_fragments, bump_location_version, bump_locations)
+from scenery_app.media import (FORMATS, UnsupportedMedia, attach_photo,
+    send_media, original_path, thumbnail_path, valid_digest)
 
 main = Blueprint('main', __name__)
 
 # Create your routes here.
 
+def newest_changes():
+    """MAX(updated_at) of the locations and of the users, read from
+    their indexes in one statement."""
+    return db.session.query(
+        select([func.max(Location.updated_at)]).label('locations'),
+        select([func.max(User.updated_at)]).label('users')).one()
+
+def homepage_validators():
+    user_id = current_user.id if current_user.is_authenticated else None
+    g.recommendations = recommended_locations(user_id)
+    # Recommendations are refreshed without timestamps, so the page has
+    # no Last-Modified; the ETag covers them by content.
+    return (tuple(newest_changes()),
+        [row.id for row in g.recommendations]), None
+
 @main.route('/')
+@read_only
+@conditional(homepage_validators)
 def homepage():
-    all_locations = Location.query.all()
-    all_users = User.query.all()
-    return render_template('home.html',
-        all_locations=all_locations, all_users=all_users)
+    per_page = page_size()
+    locations_after = request.args.get('locations_after', type=int)
+    users_after = request.args.get('users_after', type=int)
+
+    # Only the columns the template needs, one bounded page per section,
+    # each read as the page is streamed.
+    all_locations = KeysetStream(
+        db.session.query(Location.id, Location.title),
+        Location.id, after=locations_after, limit=per_page)
+    all_users = KeysetStream(
+        db.session.query(User.id, User.username),
+        User.id, after=users_after, limit=per_page)
+
+    return stream_template('home.html',
+        recommendations=g.recommendations,
+        all_locations=all_locations, all_users=all_users,
+        locations_after=locations_after, users_after=users_after,
+        per_page=per_page)
 
 @main.route('/create_location', methods=['GET', 'POST'])
 @login_required
@@ -29,7 +83,12 @@ def create_location():
             landscape=form.landscape.data,
             entries=form.entries.data
         )
+        set_position(new_location, form.latitude.data, form.longitude.data)
         db.session.add(new_location)
+        db.session.flush()
+        index_location(new_location)
+        location_added(new_location)
+        refresh_later([new_location.id])
         db.session.commit()
 
         flash('New location was created successfully.')
@@ -47,6 +106,7 @@ def create_list():
         )
         db.session.add(new_list)
         db.session.commit()
+        list_choices.invalidate()
 
         flash('New list created successfully.')
         return redirect(url_for('main.homepage'))
@@ -62,85 +122,373 @@ def create_entry():
             name=form.name.data
         )
         db.session.add(new_entry)
+        db.session.flush()
+        index_entry(new_entry)
         db.session.commit()
+        entry_choices.invalidate()
 
         flash('New entry created successfully.')
         return redirect(url_for('main.homepage'))
     
     return render_template('create_entry.html', form=form)
 
-@main.route('/location/<location_id>', methods=['GET', 'POST'])
+@main.route('/choices/<kind>')
+def search_choices(kind):
+    """Type-ahead search for the list/entry select fields."""
+    provider = providers.get(kind)
+    if provider is None:
+        abort(404)
+    q = request.args.get('q', '').strip()
+    results = provider.search(q) if q else []
+    return jsonify(results=[
+        {'id': id, 'label': label} for id, label in results])
+
+@main.route('/search')
+def search_page():
+    q = request.args.get('q', '')
+    page = max(1, request.args.get('page', 1, type=int))
+    results, has_next = search(q, page=page, per_page=page_size())
+    return render_template('search.html',
+        q=q, results=results, page=page, has_next=has_next)
+
+@main.route('/search.json')
+def search_json():
+    q = request.args.get('q', '')
+    page = max(1, request.args.get('page', 1, type=int))
+    results, has_next = search(q, page=page, per_page=page_size())
+    return jsonify(results=results, page=page, has_next=has_next)
+
+def browse_filters():
+    """Read the browse filters from the query string, dropping bad ones."""
+    landscape = request.args.get('landscape')
+    return {
+        'landscape': landscape if landscape in Landscape.__members__ else None,
+        'list_id': request.args.get('list', type=int),
+        'date_from': request.args.get('from', type=date.fromisoformat),
+        'date_to': request.args.get('to', type=date.fromisoformat),
+    }
+
+def browse_query(filters):
+    return filter_locations(db.session.query(
+        Location.id, Location.title, Location.visited_date, Location.landscape),
+        **filters)
+
+@main.route('/browse')
+def browse():
+    filters = browse_filters()
+    locations = KeysetStream(browse_query(filters), Location.id,
+        after=request.args.get('after', type=int), limit=page_size())
+    counts = facet_counts(**filters)
+    list_names = dict(list_choices.labels(list(counts['list'])))
+    return stream_template('browse.html', locations=locations,
+        counts=counts, list_names=list_names,
+        filters=filters, landscapes=Landscape)
+
+@main.route('/browse.json')
+def browse_json():
+    filters = browse_filters()
+    locations, next_after = keyset_page(browse_query(filters), Location.id,
+        after=request.args.get('after', type=int), limit=page_size())
+    return jsonify(
+        locations=[{
+            'id': location.id,
+            'title': location.title,
+            'visited_date': location.visited_date and
+                location.visited_date.isoformat(),
+            'landscape': location.landscape and location.landscape.name,
+        } for location in locations],
+        next_after=next_after,
+        facets=facet_counts(**filters))
+
+def location_validators(location_id):
+    user_id = current_user.id if current_user.is_authenticated else None
+    state = get_location_state(location_id, user_id)
+    if state is None:
+        abort(404)
+    g.location_state = state
+    version, updated_at, is_favorite, in_visitlist = state
+    g.location_key = location_key(location_id, version)
+    # Everything on the page, down to how old its CSRF tokens are.
+    return (g.location_key + (is_favorite, in_visitlist, csrf_period()),
+        updated_at)
+
+@main.route('/location/<int:location_id>', methods=['GET', 'POST'])
+@read_only
+@conditional(location_validators, public=False)
 def location_detail(location_id):
-    location = Location.query.get(location_id)
-    form = LocationForm(obj=location)
-    
-    if form.validate_on_submit():
-        location.title = form.title.data
-        location.visited_date = form.visited_date.data
-        location.list = form.list.data
-        location.landscape = form.landscape.data
-        location.entries = form.entries.data
+    user_id = current_user.id if current_user.is_authenticated else None
 
-        db.session.commit()
+    if request.method == 'POST':
+        location, is_favorite, in_visitlist = get_location_detail(
+            location_id, user_id)
+        if location is None:
+            abort(404)
+        form = LocationForm(obj=location)
+
+        if form.validate_on_submit():
+            before = facet_key(location)
+            before_stats = (location.landscape, location.visited_date)
+            location.title = form.title.data
+            location.visited_date = form.visited_date.data
+            location.list = form.list.data
+            location.landscape = form.landscape.data
+            location.entries = form.entries.data
+            set_position(location, form.latitude.data, form.longitude.data)
+            index_location(location)
+            location_changed(before, location)
+            favorited_location_changed(before_stats, location)
+            bump_location_version(location)
+            refresh_later([location.id])
+
+            db.session.commit()
+
+            flash('Location was updated successfully.')
+            return redirect(url_for('main.location_detail', location_id=location_id))
+
+        # Re-show the submitted values; nothing here is cacheable.
+        return render_template('location_detail.html',
+            location_id=location_id, is_favorite=is_favorite,
+            in_visitlist=in_visitlist, form=form,
+            photo_form=PhotoForm(formdata=None),
+            fragments=render_location_fragments(location, form))
 
-        flash('Location was updated successfully.')
+    _, _, is_favorite, in_visitlist = g.location_state
+    fragments = location_cache.get(g.location_key)
+    if fragments is None:
+        location, _, _ = get_location_detail(location_id)
+        key = location_key(location_id, location.version)
+        fragments = render_location_fragments(
+            location, LocationForm(obj=location, formdata=None))
+        location_cache.set(key, fragments)
+    return render_template('location_detail.html',
+        location_id=location_id, is_favorite=is_favorite,
+        in_visitlist=in_visitlist, form=LocationForm(formdata=None),
+        photo_form=PhotoForm(formdata=None), fragments=fragments)
+
+@main.route('/location/<int:location_id>/photos', methods=['POST'])
+@login_required
+def upload_photo(location_id):
+    if not db.session.query(Location.id).filter(
+            Location.id == location_id).first():
+        abort(404)
+    form = PhotoForm()
+    if not form.validate_on_submit():
+        flash('Choose a photo to upload.')
         return redirect(url_for('main.location_detail', location_id=location_id))
+    try:
+        photo, created = attach_photo(location_id, form.photo.data)
+        if created:
+            bump_locations([location_id])
+        db.session.commit()
+    except UnsupportedMedia as error:
+        flash(str(error))
+    except IntegrityError:
+        # Lost a race with another request attaching the same file.
+        db.session.rollback()
+        flash('That photo is already on this location.')
+    else:
+        flash('Photo was uploaded successfully.' if created
+            else 'That photo is already on this location.')
+    return redirect(url_for('main.location_detail', location_id=location_id))
+
+@main.route('/media/<digest>.<extension>')
+def media_original(digest, extension):
+    if not valid_digest(digest) or extension not in FORMATS:
+        abort(404)
+    return send_media(original_path(digest, extension), FORMATS[extension])
 
-    return render_template('location_detail.html', location=location, form=form)
+@main.route('/media/<digest>/<int:size>.jpg')
+def media_thumbnail(digest, size):
+    if (not valid_digest(digest) or
+            size not in app.config['MEDIA_THUMBNAIL_SIZES']):
+        abort(404)
+    return send_media(thumbnail_path(digest, size), 'image/jpeg')
+
+def nearby_results(ranked):
+    return [{'id': row.id, 'title': row.title,
+            'latitude': row.latitude, 'longitude': row.longitude,
+            'distance_km': round(distance, 3)}
+        for row, distance in ranked]
+
+@main.route('/nearby.json')
+@read_only
+def nearby():
+    """The locations nearest to ?lat=&lng=, e.g. the browser's position,
+    optionally only those within ?km= (at most NEARBY_MAX_KM)."""
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    if lat is None or lng is None or not (
+            -90 <= lat <= 90 and -180 <= lng <= 180):
+        abort(400)
+    max_km = request.args.get('km', type=float)
+    if max_km is not None:
+        if not 0 <= max_km < math.inf:
+            abort(400)
+        max_km = min(max_km, app.config['NEARBY_MAX_KM'])
+    ranked = nearest(lat, lng, k=page_size('k', 'NEARBY_COUNT'),
+        max_km=max_km)
+    return jsonify(results=nearby_results(ranked))
+
+@main.route('/location/<int:location_id>/nearby.json')
+@read_only
+def location_nearby(location_id):
+    """The locations nearest to a location, for the panel on its page."""
+    position = (db.session.query(Location.latitude, Location.longitude)
+        .filter(Location.id == location_id)
+        .first())
+    if position is None:
+        abort(404)
+    if position.latitude is None or position.longitude is None:
+        return jsonify(results=[])
+    ranked = nearest(position.latitude, position.longitude,
+        k=page_size('k', 'NEARBY_COUNT'), exclude_id=location_id)
+    return jsonify(results=nearby_results(ranked))
+
+def itinerary_start():
+    """The optional ?lat=&lng= to start an itinerary from, rounded to
+    ITINERARY_START_DECIMALS so it doesn't make every route unique."""
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    if lat is None and lng is None:
+        return None
+    if lat is None or lng is None or not (
+            -90 <= lat <= 90 and -180 <= lng <= 180):
+        abort(400)
+    decimals = app.config['ITINERARY_START_DECIMALS']
+    return (round(lat, decimals), round(lng, decimals))
+
+def itinerary_response(query, start):
+    limit = app.config['ITINERARY_MAX_STOPS']
+    rows = (query.with_entities(Location.id, Location.title,
+            Location.latitude, Location.longitude, Location.visited_date)
+        .limit(limit + 1)
+        .all())
+    if len(rows) > limit:
+        abort(422, f'Itineraries are limited to {limit} locations.')
+    return jsonify(itinerary(rows, start))
+
+@main.route('/list/<int:list_id>/itinerary.json')
+@read_only
+def list_itinerary(list_id):
+    """The list's locations in the order that travels the least."""
+    start = itinerary_start()
+    if db.session.query(List.id).filter(List.id == list_id).first() is None:
+        abort(404)
+    return itinerary_response(
+        Location.query.filter(Location.list_id == list_id), start)
+
+@main.route('/profile/<username>/itinerary.json')
+@read_only
+def visitlist_itinerary(username):
+    """A user's visitlist in the order that travels the least."""
+    start = itinerary_start()
+    user = (db.session.query(User.id)
+        .filter(User.username == username)
+        .first())
+    if user is None:
+        abort(404)
+    return itinerary_response(Location.query
+        .join(visitlist_locations_table,
+            visitlist_locations_table.c.location_id == Location.id)
+        .filter(visitlist_locations_table.c.user_id == user.id), start)
+
+def profile_validators(username):
+    g.profile_user = user = (db.session.query(User.id, User.username,
+            User.updated_at)
+        .filter(User.username == username)
+        .first())
+    if user is None:
+        abort(404)
+    # The user's row changes with their collections, and any location in
+    # them may have been renamed or edited since.
+    locations_changed = newest_changes().locations
+    return ((user.id, user.updated_at, locations_changed),
+        newest(user.updated_at, locations_changed))
 
 @main.route('/profile/<username>')
+@read_only
+@conditional(profile_validators)
 def profile(username):
-    user = User.query.filter_by(username=username).one()
-    return render_template('profile.html', user=user)
+    user = g.profile_user
+    per_page = page_size()
+    favorites_after = request.args.get('favorites_after', type=int)
+    planned_after = request.args.get('planned_after', type=int)
 
-@main.route('/favorite/<location_id>', methods=['POST'])
-@login_required
-def favorite_location(location_id):
-    location = Location.query.get(location_id)
-    if location in current_user.favorite_locations:
-        flash('Location already in favorites.')
+    # Both collections are read as index range scans on
+    # (user_id, location_id), one bounded page at a time, as the page is
+    # streamed.
+    favorites = KeysetStream(
+        db.session.query(Location.id, Location.title)
+            .join(favorite_locations_table,
+                favorite_locations_table.c.location_id == Location.id)
+            .filter(favorite_locations_table.c.user_id == user.id),
+        Location.id, after=favorites_after, limit=per_page)
+    planned = KeysetStream(
+        db.session.query(Location.id, Location.title)
+            .join(visitlist_locations_table,
+                visitlist_locations_table.c.location_id == Location.id)
+            .filter(visitlist_locations_table.c.user_id == user.id),
+        Location.id, after=planned_after, limit=per_page)
+
+    return stream_template('profile.html', user=user,
+        stats=user_stats(user.id),
+        favorites=favorites, favorites_after=favorites_after,
+        planned=planned, planned_after=planned_after, per_page=per_page)
+
+def toggle_location(table, location_id, add, label):
+    """
+    Add or remove a location from one of the current user's collections,
+    using indexed existence checks rather than loading the collection.
+    """
+    Location.query.get_or_404(location_id)
+    present = has_location(table, current_user.id, location_id)
+    if add and present:
+        flash(f'Location already in {label}.')
+    elif not add and not present:
+        flash(f'Location not in {label}.')
+    elif add:
+        try:
+            add_location(table, current_user.id, location_id)
+            collection_changed(table, current_user.id, location_id, 1)
+            if table is favorite_locations_table:
+                refresh_later([int(location_id)], current_user.id)
+            db.session.commit()
+        except IntegrityError:
+            # Lost a race with another request adding the same row.
+            db.session.rollback()
+            flash(f'Location already in {label}.')
+        else:
+            flash(f'Location added to {label}.')
     else:
-        current_user.favorite_locations.append(location)
-        db.session.add(current_user)
+        # Only count rows this request actually removed.
+        if remove_location(table, current_user.id, location_id):
+            collection_changed(table, current_user.id, location_id, -1)
+            if table is favorite_locations_table:
+                refresh_later([int(location_id)], current_user.id)
         db.session.commit()
-        flash('Location added to favorites.')
+        flash(f'Location removed from {label}.')
     return redirect(url_for('main.location_detail', location_id=location_id))
 
+@main.route('/favorite/<location_id>', methods=['POST'])
+@login_required
+def favorite_location(location_id):
+    return toggle_location(
+        favorite_locations_table, location_id, True, 'favorites')
+
 @main.route('/unfavorite/<location_id>', methods=['POST'])
 @login_required
 def unfavorite_location(location_id):
-    location = Location.query.get(location_id)
-    if location not in current_user.favorite_locations:
-        flash('Location not in favorites.')
-    else:
-        current_user.favorite_locations.remove(location)
-        db.session.add(current_user)
-        db.session.commit()
-        flash('Location removed from favorites.')
-    return redirect(url_for('main.location_detail', location_id=location_id))
+    return toggle_location(
+        favorite_locations_table, location_id, False, 'favorites')
 
 @main.route('/visitlist/<location_id>', methods=['POST'])
 @login_required
 def visit_location(location_id):
-    location = Location.query.get(location_id)
-    if location in current_user.visitlist_locations:
-        flash('Location already in visitlist.')
-    else:
-        current_user.visitlist_locations.append(location)
-        db.session.add(current_user)
-        db.session.commit()
-        flash('Location added to visitlist.')
-    return redirect(url_for('main.location_detail', location_id=location_id))
+    return toggle_location(
+        visitlist_locations_table, location_id, True, 'visitlist')
 
 @main.route('/unvisitlist/<location_id>', methods=['POST'])
 @login_required
 def unvisitlist_location(location_id):
-    location = Location.query.get(location_id)
-    if location not in current_user.visitlist_locations:
-        flash('Location not in visitlist')
-    else:
-        current_user.visitlist_locations.remove(location)
-        db.session.add(current_user)
-        db.session.commit()
-        flash('Location removed from visitlist.')
-    return redirect(url_for('main.location_detail', location_id=location_id))
\ No newline at end of file
+    return toggle_location(
+        visitlist_locations_table, location_id, False, 'visitlist')
@@ -1,12 +1,39 @@
 # Create your tests here.
 
+import gzip
 import os
+import tempfile
 import unittest
 import app
 
-from datetime import date
-from scenery_app.extensions import app, db, bcrypt
-from scenery_app.models import Location, Country, User, Landscape, Entry
+from datetime import date, datetime
+from io import BytesIO
+import shutil
+import sqlite3
+from PIL import Image
+from scenery_app.extensions import app, db
+from scenery_app.models import (Location, User, Landscape, Entry, List,
+    FacetCount, Job, DeadJob, Photo, visitlist_locations_table)
+from scenery_app.queries import get_location_detail
+from scenery_app.choices import list_choices, entry_choices
+from scenery_app.instrumentation import metrics, count_queries
+from scenery_app.benchmark import compare, percentile
+from scenery_app.fragment_cache import location_cache
+from scenery_app.ratelimit import limiter
+from scenery_app.testing import login, logout, create_user
+from scenery_app.assets import build as build_assets, minify_css
+from scenery_app.compression import compress_response
+from scenery_app import jobs
+from scenery_app.bulk import import_rows
+from scenery_app.facets import adjust_counts
+from scenery_app.geo import nearest, haversine_km, geohash
+from scenery_app import itinerary
+from scenery_app.recommendations import (recommended_locations,
+    rebuild as rebuild_recommendations)
+from scenery_app.user_stats import (user_stats, adjust_stats,
+    rebuild as rebuild_user_stats)
+from scenery_app.migrations import (upgrade, migrations, applied_versions,
+    has_index)
 
 """
 Run these tests with the command:
@@ -17,36 +44,20 @@ python -m unittest scenery_app.main.tests
 # Setup
 #################################################
 
-def login(client, username, password):
-    return client.post('/login', data=dict(
-        username=username,
-        password=password
-    ), follow_redirects=True)
-
-def logout(client):
-    return client.get('/logout', follow_redirects=True)
-
 def create_locations():
-    a1 = Country(name='Chile')
+    a1 = List(name='Chile')
     b1 = Location(
         title='Torres del Paine National Park',
         visited_date=date(2016, 5, 17),
-        country=a1
+        list=a1
     )
     db.session.add(b1)
 
-    a2 = Country(name='Seychelles')
-    b2 = Location(title='Anse Soucr d\'Argent', country=a2)
+    a2 = List(name='Seychelles')
+    b2 = Location(title='Anse Soucr d\'Argent', list=a2)
     db.session.add(b2)
     db.session.commit()
 
-def create_user():
-    # Creates a user with username 'me1' and password of 'password'
-    password_hash = bcrypt.generate_password_hash('password').decode('utf-8')
-    user = User(username='me1', password=password_hash)
-    db.session.add(user)
-    db.session.commit()
-
 #################################################
 # Tests
 #################################################
@@ -59,9 +70,16 @@ class MainTests(unittest.TestCase):
         app.config['WTF_CSRF_ENABLED'] = False
         app.config['DEBUG'] = False
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
+        app.config['JOBS_EXECUTOR'] = 'inline'
+        app.config['MEDIA_THUMBNAIL_EXECUTOR'] = 'inline'
+        app.config['MEDIA_SENDFILE'] = ''
+        app.config['ITINERARY_EXECUTOR'] = 'inline'
         self.app = app.test_client()
         db.drop_all()
         db.create_all()
+        limiter.reset()
+        location_cache.clear()
+        itinerary.clear_cache()
  
     def test_homepage_logged_out(self):
         """Test that the locations show up on the homepage."""
@@ -112,6 +130,55 @@ class MainTests(unittest.TestCase):
         self.assertNotIn('Log In', response_text)
         self.assertNotIn('Sign Up', response_text)
 
+    def test_homepage_pagination(self):
+        """Test that the homepage only renders one page of locations."""
+        a1 = List(name='Iceland')
+        for i in range(1, 4):
+            db.session.add(Location(title=f'Waterfall {i}', list=a1))
+        db.session.commit()
+
+        response = self.app.get('/?per_page=2')
+        response_text = response.get_data(as_text=True)
+        self.assertIn('Waterfall 2', response_text)
+        self.assertNotIn('Waterfall 3', response_text)
+        self.assertIn('locations_after=2', response_text)
+
+        response = self.app.get('/?per_page=2&locations_after=2')
+        response_text = response.get_data(as_text=True)
+        self.assertIn('Waterfall 3', response_text)
+        self.assertNotIn('Waterfall 1', response_text)
+        self.assertNotIn('More locations', response_text)
+
+    def test_streamed_pages(self):
+        """Test that list pages send their header before the list queries."""
+        create_user()
+        create_locations()
+        login(self.app, 'me1', 'password')
+
+        with count_queries() as counter:
+            response = self.app.get('/?per_page=1', buffered=False)
+            chunks = iter(response.response)
+            first = next(chunks)
+            before_body = counter.count
+            page = (first + b''.join(chunks)).decode()
+            response.close()
+        self.assertIn('<nav', first.decode())
+        self.assertNotIn('Torres del Paine', first.decode())
+        # The suggestions and MAX(updated_at)s come first, the two
+        # sections' pages as they are rendered.
+        self.assertEqual(before_body, 2)
+        self.assertEqual(counter.count, 4)
+        self.assertIn('Torres del Paine', page)
+        self.assertIn('locations_after=1', page)
+
+        # Flashed messages are taken before the headers go out, so they
+        # are shown once.
+        self.app.post('/create_list', data={'name': 'Peru'})
+        self.assertIn('New list created successfully.',
+            self.app.get('/profile/me1').get_data(as_text=True))
+        self.assertNotIn('New list created successfully.',
+            self.app.get('/browse').get_data(as_text=True))
+
     def test_location_detail_logged_out(self):
         """Test that the location appears on its detail page."""
         # TODO: Use helper functions to create locations, Country, user
@@ -152,6 +219,276 @@ class MainTests(unittest.TestCase):
         # TODO: Check that the response contains the 'Favorite' button
         self.assertIn("Favorite This Location", response_text)
 
+    def test_location_detail_query_count(self):
+        """Test that the detail loader doesn't lazy load relationships."""
+        a1 = List(name='Zambia')
+        b1 = Location(title='Victoria Falls', list=a1, entries=[
+            Entry(name='Devil\'s Pool'), Entry(name='Rainbow')])
+        db.session.add(b1)
+        db.session.commit()
+        db.session.expunge_all()
+
+        with count_queries() as counter:
+            location, is_favorite, in_visitlist = get_location_detail(
+                1, user_id=1)
+            self.assertEqual(location.list.name, 'Zambia')
+            self.assertEqual(len(location.entries), 2)
+            self.assertEqual(location.photos, [])
+            self.assertFalse(is_favorite)
+            self.assertFalse(in_visitlist)
+        self.assertLessEqual(counter.count, 3)
+
+    def test_location_form_choices_cached(self):
+        """Test that the form's list/entry options come from the cache."""
+        create_user()
+        login(self.app, 'me1', 'password')
+        list_choices.invalidate()
+        entry_choices.invalidate()
+
+        self.app.post('/create_list', data={'name': 'Norway'})
+        self.app.get('/create_location')
+        with count_queries() as counter:
+            response = self.app.get('/create_location')
+        self.assertIn('Norway', response.get_data(as_text=True))
+        self.assertFalse(any('FROM list' in statement
+            for statement in counter.statements))
+
+        # Creating a list drops the cached choices
+        self.app.post('/create_list', data={'name': 'Sweden'})
+        response = self.app.get('/create_location')
+        self.assertIn('Sweden', response.get_data(as_text=True))
+
+        # Type-ahead search matches wildcards literally
+        self.app.post('/create_list', data={'name': '100% Sweden'})
+        results = lambda q: [result['label'] for result in
+            self.app.get('/choices/list', query_string={'q': q})
+                .get_json()['results']]
+        self.assertEqual(results('Nor'), ['Norway'])
+        self.assertEqual(results('%'), [])
+        self.assertEqual(results('_orway'), [])
+        self.assertEqual(results('100%'), ['100% Sweden'])
+
+        # Past the threshold only the selected options are read.
+        threshold = app.config['CHOICES_TYPEAHEAD_THRESHOLD']
+        app.config['CHOICES_TYPEAHEAD_THRESHOLD'] = 2
+        try:
+            list_choices.invalidate()
+            with count_queries() as counter:
+                response = self.app.get('/create_location')
+        finally:
+            app.config['CHOICES_TYPEAHEAD_THRESHOLD'] = threshold
+        self.assertIn('data-typeahead', response.get_data(as_text=True))
+        self.assertFalse(any('ORDER BY list.name' in statement
+            for statement in counter.statements))
+
+    def test_bulk_import_locations(self):
+        """Test importing locations with entry names from a CSV file."""
+        db.session.add(List(name='Peru'))
+        db.session.add(Entry(name='Hiking'))
+        db.session.commit()
+
+        with tempfile.NamedTemporaryFile('w', suffix='.csv') as f:
+            f.write('title,visited_date,list_id,landscape,entries\n')
+            f.write('Machu Picchu,2019-05-01,1,Mountain,Hiking\n')
+            f.write('Lake Titicaca,,1,WETLAND,\n')
+            f.flush()
+            result = app.test_cli_runner().invoke(
+                args=['data', 'import', 'locations', f.name])
+
+        self.assertIn('Imported 2 locations.', result.output)
+        location = Location.query.filter_by(title='Machu Picchu').one()
+        self.assertEqual(location.landscape, Landscape.MOUNTAINS)
+        self.assertEqual(location.visited_date, date(2019, 5, 1))
+        self.assertEqual([entry.name for entry in location.entries],
+            ['Hiking'])
+
+        # Bad rows are reported by number and skipped, the rest imported
+        create_user()
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl') as f:
+            f.write('{"location_id": 1, "username": "me1"}\n')
+            f.write('{"location_id": 1, "username": "me1"}\n')
+            f.write('{"location_id": 2, "username": "nobody"}\n')
+            f.write('{"location_id": 99, "user_id": 1}\n')
+            f.write('not json\n')
+            f.write('{"location_id": 2, "username": "me1"}\n')
+            f.flush()
+            result = app.test_cli_runner().invoke(
+                args=['data', 'import', 'favorites', f.name])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('Imported 2 favorites.', result.output)
+        self.assertIn(f'{f.name}: row 2: location 1 is already a favorite',
+            result.output)
+        self.assertIn("row 3: unknown user 'nobody'", result.output)
+        self.assertIn('row 4: unknown location 99', result.output)
+        self.assertIn('row 5: not an object', result.output)
+        self.assertIn('Skipped 4 rows', result.output)
+        self.assertEqual(user_stats(1)['favorites'], 2)
+
+    def test_search(self):
+        """Test that created and updated locations are searchable."""
+        db.session.add(List(name='Chile'))
+        db.session.commit()
+        create_user()
+        login(self.app, 'me1', 'password')
+
+        self.app.post('/create_location', data={
+            'title': 'Torres del Paine',
+            'visited_date': '2016-05-17',
+            'list': 1,
+            'landscape': 'MOUNTAINS',
+        })
+        response = self.app.get('/search.json?q=pain')
+        self.assertEqual(response.get_json()['results'],
+            [{'kind': 'location', 'id': 1, 'text': 'Torres del Paine'}])
+
+        self.app.post('/location/1', data={
+            'title': 'Grey Glacier',
+            'visited_date': '2016-05-17',
+            'list': 1,
+            'landscape': 'GLACIER',
+        })
+        response = self.app.get('/search.json?q=paine')
+        self.assertEqual(response.get_json()['results'], [])
+        response = self.app.get('/search?q=glacier')
+        self.assertIn('Grey Glacier', response.get_data(as_text=True))
+
+    def test_browse_facets(self):
+        """Test filtering locations and the maintained facet counts."""
+        db.session.add(List(name='Chile'))
+        db.session.add(List(name='Iceland'))
+        db.session.commit()
+        create_user()
+        login(self.app, 'me1', 'password')
+
+        for title, list_id, landscape in [
+                ('Torres del Paine', 1, 'MOUNTAINS'),
+                ('Atacama', 1, 'DESERTS'),
+                ('Skogafoss', 2, 'WATERFALL')]:
+            self.app.post('/create_location', data={
+                'title': title,
+                'visited_date': '2016-05-17',
+                'list': list_id,
+                'landscape': landscape,
+            })
+        self.app.post('/location/2', data={
+            'title': 'Atacama',
+            'visited_date': '2016-05-17',
+            'list': 2,
+            'landscape': 'DESERTS',
+        })
+
+        response = self.app.get('/browse.json?landscape=DESERTS')
+        data = response.get_json()
+        self.assertEqual([location['title'] for location in data['locations']],
+            ['Atacama'])
+        self.assertEqual(data['facets']['landscape'],
+            {'MOUNTAINS': 1, 'DESERTS': 1, 'WATERFALL': 1})
+        self.assertEqual(data['facets']['list'], {'2': 1})
+
+        counts = {(row.facet, row.value): row.count
+            for row in FacetCount.query.all()}
+        self.assertEqual(counts[('list', '1')], 1)
+        self.assertEqual(counts[('list', '2')], 2)
+
+        # Adjustments are upserts: a row that another request created in
+        # the meantime is added to rather than inserted again.
+        adjust_counts({('landscape', 'GLACIER'): 1})
+        adjust_counts({('landscape', 'GLACIER'): 1, ('list', '1'): -1,
+            ('list', '2'): 0})
+        db.session.commit()
+        counts = {(row.facet, row.value): row.count
+            for row in FacetCount.query.all()}
+        self.assertEqual(counts[('landscape', 'GLACIER')], 2)
+        self.assertEqual(counts[('list', '1')], 0)
+        self.assertEqual(counts[('list', '2')], 2)
+
+    def test_instrumentation(self):
+        """Test the opt-in profiling headers and metrics endpoint."""
+        create_user()
+        app.config['INSTRUMENTATION_ENABLED'] = True
+        metrics.reset()
+        try:
+            response = self.app.get('/browse.json')
+            self.assertIn('db;dur=', response.headers['Server-Timing'])
+            # The page and the facet counts
+            self.assertEqual(response.headers['X-SQL-Queries'], '3')
+
+            # Streamed pages are recorded once sent, without headers.
+            response = self.app.get('/')
+            self.assertNotIn('Server-Timing', response.headers)
+
+            # The metrics hold SQL text: only served with the token.
+            self.assertEqual(self.app.get('/_metrics').status_code, 404)
+            app.config['INSTRUMENTATION_METRICS_TOKEN'] = 'secret'
+            self.assertEqual(self.app.get('/_metrics').status_code, 403)
+            data = self.app.get('/_metrics',
+                headers={'Authorization': 'Bearer secret'}).get_json()
+            self.assertEqual(data['main.homepage']['wall']['count'], 1)
+            # Two pages, the suggestions and the ETag's MAX(updated_at)s
+            self.assertEqual(data['main.homepage']['queries_per_request'], 4)
+        finally:
+            app.config['INSTRUMENTATION_ENABLED'] = False
+            app.config['INSTRUMENTATION_METRICS_TOKEN'] = None
+
+        response = self.app.get('/')
+        self.assertNotIn('Server-Timing', response.headers)
+        self.assertEqual(self.app.get('/_metrics').status_code, 404)
+
+        # QUERY_LIMIT counts with the same profile, without the metrics.
+        app.config['QUERY_LIMIT'] = 3
+        try:
+            with self.assertLogs('scenery_app.instrumentation') as logs:
+                response = self.app.get('/')
+        finally:
+            app.config['QUERY_LIMIT'] = None
+        self.assertIn('main.homepage ran 4 queries (limit 3)', logs.output[0])
+        self.assertNotIn('Server-Timing', response.headers)
+
+    def test_benchmark_regressions(self):
+        """Test that the benchmark flags slower or chattier scenarios."""
+        baseline = {'homepage': {'p95_ms': 10.0, 'queries_per_request': 2}}
+        self.assertEqual(compare(
+            {'homepage': {'p95_ms': 12.0, 'queries_per_request': 2}},
+            baseline, tolerance=0.25), [])
+        regressions = compare(
+            {'homepage': {'p95_ms': 13.0, 'queries_per_request': 3}},
+            baseline, tolerance=0.25)
+        self.assertEqual(len(regressions), 2)
+        # Latency is only compared when a tolerance is given.
+        self.assertEqual(compare(
+            {'homepage': {'p95_ms': 50.0, 'queries_per_request': 2}},
+            baseline), [])
+        self.assertEqual(percentile([3, 1, 2, 4], 50), 2)
+
+    def test_read_replica_routing(self):
+        """Test that read-only pages use the replica until a write."""
+        with tempfile.TemporaryDirectory() as tmp:
+            app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{tmp}/primary.db'
+            app.config['SQLALCHEMY_REPLICA_URIS'] = [f'sqlite:///{tmp}/replica.db']
+            try:
+                db.create_all()
+                create_locations()
+                create_user()
+                replica = db.replica_engine(app)
+                db.metadata.create_all(replica)
+                replica.execute(List.__table__.insert(), name='Replica')
+                replica.execute(Location.__table__.insert(),
+                    title='Replica Falls', list_id=1)
+
+                response = self.app.get('/')
+                self.assertIn('Replica Falls', response.get_data(as_text=True))
+
+                # After writing, the client reads its own writes
+                login(self.app, 'me1', 'password')
+                self.app.post('/favorite/1')
+                response = self.app.get('/')
+                response_text = response.get_data(as_text=True)
+                self.assertNotIn('Replica Falls', response_text)
+                self.assertIn('Torres del Paine National Park', response_text)
+            finally:
+                app.config['SQLALCHEMY_REPLICA_URIS'] = []
+                db.dispose_engines(app)
+
     def test_update_location(self):
         """Test updating a location."""
         # Set up
@@ -287,4 +624,641 @@ class MainTests(unittest.TestCase):
         # favorites
         user = User.query.filter_by(username='me1').one()
         location = Location.query.get(1)
-        self.assertNotIn(location, user.favorite_locations)
\ No newline at end of file
+        self.assertNotIn(location, user.favorite_locations)
+    def test_visitlist_location(self):
+        create_user()
+        create_locations()
+        login(self.app, 'me1', 'password')
+
+        self.app.post('/visitlist/1')
+        response = self.app.post('/visitlist/1', follow_redirects=True)
+        self.assertIn('Location already in visitlist.',
+            response.get_data(as_text=True))
+
+        user = User.query.filter_by(username='me1').one()
+        location = Location.query.get(1)
+        self.assertEqual(user.visitlist_locations, [location])
+
+        self.app.post('/unvisitlist/1')
+        user = User.query.filter_by(username='me1').one()
+        self.assertEqual(user.visitlist_locations, [])
+
+    def test_location_fragment_cache(self):
+        """Test cached location fragments, conditional GETs and bumps."""
+        create_locations()
+
+        response = self.app.get('/location/1')
+        self.assertIn('Torres del Paine', response.get_data(as_text=True))
+        etag = response.headers['ETag']
+        self.assertEqual(location_cache.stats()['misses'], 1)
+
+        response = self.app.get('/location/1')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertEqual(location_cache.stats()['hits'], 1)
+
+        response = self.app.get('/location/1',
+            headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        self.app.post('/location/1', data={
+            'title': 'Grey Glacier',
+            'visited_date': '2016-05-17',
+            'list': 1,
+            'landscape': 'GLACIER',
+        })
+        self.assertEqual(Location.query.get(1).version, 2)
+        response = self.app.get('/location/1',
+            headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIn('Grey Glacier', response.get_data(as_text=True))
+
+        # A copy whose CSRF token may have expired is sent again.
+        import time
+        from unittest import mock
+        etag = response.headers['ETag']
+        later = time.time() + app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+        with mock.patch('scenery_app.http_cache.time') as clock:
+            clock.time.return_value = later
+            response = self.app.get('/location/1',
+                headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        # The form's options change with the lists and entries.
+        create_user()
+        login(self.app, 'me1', 'password')
+        etag = self.app.get('/location/1').headers['ETag']
+        self.app.post('/create_list', data={'name': 'Norway'})
+        response = self.app.get('/location/1',
+            headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Norway', response.get_data(as_text=True))
+
+        self.assertEqual(self.app.get('/location/99').status_code, 404)
+
+    def test_conditional_get(self):
+        """Test ETags, Last-Modified and cache headers on the pages."""
+        create_user()
+        create_locations()
+
+        response = self.app.get('/')
+        etag = response.headers['ETag']
+        self.assertEqual(response.headers['Cache-Control'], 'public, no-cache')
+        self.assertIn('Cookie', response.headers['Vary'])
+        self.assertNotIn('Last-Modified', response.headers)
+        with count_queries() as counter:
+            response = self.app.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+        # Only the recommendations and the MAX(updated_at)s
+        self.assertEqual(counter.count, 2)
+
+        response = self.app.get('/profile/me1')
+        modified = response.headers['Last-Modified']
+        profile_etag = response.headers['ETag']
+        response = self.app.get('/profile/me1',
+            headers={'If-Modified-Since': modified})
+        self.assertEqual(response.status_code, 304)
+
+        # Bulk version bumps move updated_at too.
+        Location.query.filter_by(id=1).update(
+            {Location.updated_at: datetime(2000, 1, 1)})
+        db.session.commit()
+        before = Location.query.get(1).updated_at
+        Location.query.filter_by(id=1).update(
+            {Location.version: Location.version + 1})
+        db.session.commit()
+        self.assertGreater(Location.query.get(1).updated_at, before)
+        self.assertEqual(self.app.get('/',
+            headers={'If-None-Match': etag}).status_code, 200)
+
+        # Logged-in pages are private, validated by ETag only, and change
+        # with the user's collections.
+        login(self.app, 'me1', 'password')
+        response = self.app.get('/profile/me1')
+        self.assertEqual(response.headers['Cache-Control'], 'private, no-cache')
+        self.assertNotIn('Last-Modified', response.headers)
+        self.assertNotEqual(response.headers['ETag'], profile_etag)
+        profile_etag = response.headers['ETag']
+        self.assertEqual(self.app.get('/profile/me1',
+            headers={'If-None-Match': profile_etag}).status_code, 304)
+        self.app.post('/favorite/1')
+        response = self.app.get('/profile/me1',
+            headers={'If-None-Match': profile_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Torres del Paine', response.get_data(as_text=True))
+
+        # A pending flash message is never hidden behind a 304.
+        etag = self.app.get('/location/1').headers['ETag']
+        self.app.post('/create_list', data={'name': 'Peru'})
+        response = self.app.get('/location/1',
+            headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+    def test_assets(self):
+        """Test building, linking and serving fingerprinted assets."""
+        self.assertEqual(minify_css('/*! MIT */\n/* x */ a , b {\n'
+            '  color: red;\n  content: "a ;  }";\n}\n'),
+            '/*! MIT */ a,b{color: red;content: "a ;  }"}')
+
+        page = self.app.get('/').get_data(as_text=True)
+        self.assertIn('/static/bootstrap-2.css', page)
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        root = app.config['ASSETS_ROOT']
+        self.addCleanup(app.config.__setitem__, 'ASSETS_ROOT', root)
+        app.config['ASSETS_ROOT'] = tmp.name
+        manifest = build_assets(app.static_folder, tmp.name)
+        built = manifest['files']['bootstrap-2.css']['path']
+        self.assertRegex(built, r'^bootstrap-2\.[0-9a-f]{12}\.css$')
+        self.assertEqual(build_assets(app.static_folder, tmp.name), manifest)
+
+        page = self.app.get('/').get_data(as_text=True)
+        self.assertIn(f'/assets/{built}', page)
+        self.assertNotIn('/static/', page)
+
+        response = self.app.get(f'/assets/{built}',
+            headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        css = gzip.decompress(response.get_data())
+        response.close()
+        response = self.app.get(f'/assets/{built}')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.get_data(), css)
+        self.assertEqual(response.mimetype, 'text/css')
+        response.close()
+        self.assertEqual(self.app.get('/assets/bootstrap-2.css').status_code,
+            404)
+
+    def test_response_compression(self):
+        """Test gzipping pages, including streamed ones."""
+        create_locations()
+        response = self.app.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertIn('Torres del Paine',
+            gzip.decompress(response.get_data()).decode())
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        response = self.app.get('/', headers={'Accept-Encoding': 'gzip',
+            'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+        # Small and unaccepted responses are sent as they are.
+        response = self.app.get('/search.json?q=x',
+            headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        response = self.app.get('/')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.status_code, 200)
+
+        chunks = [b'<p>%d</p>' % number for number in range(1000)]
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            response = compress_response(
+                app.response_class(iter(chunks), mimetype='text/html'))
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertNotIn('Content-Length', response.headers)
+            body = list(response.response)
+            self.assertGreater(len(body), 1)
+            self.assertEqual(gzip.decompress(b''.join(body)),
+                b''.join(chunks))
+
+    def test_profile_stats(self):
+        """Test the profile feed and its denormalized totals."""
+        create_user()
+        create_locations()
+        login(self.app, 'me1', 'password')
+
+        self.app.post('/favorite/1')
+        self.app.post('/favorite/2')
+        self.app.post('/favorite/2')
+        self.app.post('/visitlist/2')
+        self.app.post('/unfavorite/2')
+
+        with count_queries() as counter:
+            response = self.app.get('/profile/me1?per_page=1')
+        page = response.get_data(as_text=True)
+        self.assertIn('<strong>Favorites</strong>: 1', page)
+        self.assertIn('<strong>Visited</strong>: 1', page)
+        self.assertIn('<strong>Planned</strong>: 1', page)
+        self.assertIn('Torres del Paine', page)
+        self.assertFalse(any('count(' in statement.lower()
+            for statement in counter.statements))
+
+        # Editing a favorite moves its favoriters between stats.
+        self.app.post('/location/1', data={
+            'title': 'Torres del Paine',
+            'visited_date': '2016-05-17',
+            'list': 1,
+            'landscape': 'GLACIER',
+        })
+        stats = user_stats(User.query.filter_by(username='me1').one().id)
+        self.assertEqual(stats['visited'], 1)
+        self.assertEqual(stats['landscapes'], {'GLACIER': 1})
+
+        rebuild_user_stats()
+        self.assertEqual(user_stats(1), stats)
+
+        # Adjustments are upserts, so the second of two that both create
+        # a stat adds to it instead of failing.
+        adjust_stats({(1, 'landscape:TUNDRA'): 1})
+        adjust_stats({(1, 'landscape:TUNDRA'): 1})
+        db.session.commit()
+        self.assertEqual(user_stats(1)['landscapes'],
+            {'GLACIER': 1, 'TUNDRA': 2})
+
+        self.assertEqual(self.app.get('/profile/nobody').status_code, 404)
+
+    def test_background_jobs(self):
+        """Test that side effects are queued, retried and dead-lettered."""
+        app.config['JOBS_EXECUTOR'] = 'external'
+        app.config['JOBS_RETRY_DELAY'] = 0
+        create_user()
+        create_locations()
+        login(self.app, 'me1', 'password')
+
+        self.app.post('/create_location', data={
+            'title': 'Grey Glacier',
+            'visited_date': '2016-05-17',
+            'list': 1,
+            'landscape': 'GLACIER',
+        })
+        self.assertEqual([job.name for job in Job.query.all()],
+            ['search.index', 'recommendations.refresh'])
+        self.assertEqual(self.app.get('/search.json?q=grey').get_json()
+            ['results'], [])
+
+        with app.app_context():
+            self.assertEqual(jobs.work(burst=True), 2)
+        self.assertEqual(self.app.get('/search.json?q=grey').get_json()
+            ['results'], [{'kind': 'location', 'id': 3, 'text': 'Grey Glacier'}])
+        self.assertEqual(Job.query.count(), 0)
+
+        calls = []
+        @jobs.job('test.flaky')
+        def flaky(n):
+            calls.append(n)
+            raise RuntimeError('boom')
+        with app.app_context():
+            jobs.enqueue('test.flaky', max_attempts=2, n=1)
+            db.session.commit()
+            self.assertEqual(jobs.work(burst=True), 2)
+        self.assertEqual(calls, [1, 1])
+        self.assertEqual(Job.query.count(), 0)
+        dead = DeadJob.query.one()
+        self.assertEqual((dead.name, dead.attempts), ('test.flaky', 2))
+        self.assertIn('boom', dead.error)
+        self.assertEqual(jobs.queue_depth(),
+            {'queued': 0, 'running': 0, 'dead': 1})
+        self.assertEqual(jobs.stats.to_dict()['test.flaky']['dead'], 1)
+
+    def test_nearest_locations(self):
+        """Test k-nearest queries against a brute force ranking."""
+        create_locations()
+        import random
+        rng = random.Random(17)
+        points = [(rng.uniform(-60, 60), rng.uniform(-180, 180))
+            for _ in range(300)]
+        # A dense cluster near Torres del Paine, and points by the antimeridian.
+        points += [(-50.94 + rng.uniform(-0.05, 0.05),
+            -73.40 + rng.uniform(-0.05, 0.05)) for _ in range(30)]
+        points += [(10.0, 179.999), (10.0, -179.999)]
+        import_rows('locations', ({'title': f'Point {i}', 'list_id': 1,
+                'latitude': lat, 'longitude': lng}
+            for i, (lat, lng) in enumerate(points)))
+
+        self.assertEqual(geohash(57.64911, 10.40744, 11), 'u4pruydqqvj')
+        for lat, lng in [(-50.94, -73.40), (10.0, 180.0), (0.0, 0.0),
+                (59.5, 120.0)]:
+            expected = sorted(haversine_km(lat, lng,
+                [p[0] for p in points], [p[1] for p in points]))[:7]
+            found = [distance for _, distance in nearest(lat, lng, k=7)]
+            for want, got in zip(expected, found):
+                self.assertAlmostEqual(want, got, places=6)
+            self.assertEqual(len(found), 7)
+
+        within = nearest(-50.94, -73.40, k=100, max_km=5)
+        self.assertEqual(len(within), sum(haversine_km(-50.94, -73.40,
+            [p[0] for p in points], [p[1] for p in points]) <= 5))
+        self.assertTrue(all(distance <= 5 for _, distance in within))
+        # The radius search has to wrap around the antimeridian.
+        self.assertEqual({row.title for row, _ in
+                nearest(10.0, 179.9995, k=5, max_km=1)},
+            {'Point 330', 'Point 331'})
+
+        response = self.app.get('/nearby.json?lat=-50.94&lng=-73.40&k=3')
+        results = response.get_json()['results']
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(result['distance_km'] < 10 for result in results))
+        self.assertEqual(self.app.get('/nearby.json?lat=91&lng=0').status_code,
+            400)
+        for km in ('-1', 'nan', 'inf'):
+            self.assertEqual(self.app.get(
+                f'/nearby.json?lat=0&lng=0&km={km}').status_code, 400)
+        # Huge radii are cut down rather than scanning every location.
+        from unittest import mock
+        with mock.patch('scenery_app.main.routes.nearest',
+                return_value=[]) as search:
+            self.app.get('/nearby.json?lat=0&lng=0&km=1e9')
+        self.assertEqual(search.call_args[1]['max_km'],
+            app.config['NEARBY_MAX_KM'])
+
+        location_id = results[0]['id']
+        response = self.app.get(f'/location/{location_id}/nearby.json?k=2')
+        self.assertNotIn(location_id,
+            [result['id'] for result in response.get_json()['results']])
+        self.assertEqual(
+            self.app.get('/location/1/nearby.json').get_json()['results'], [])
+
+    def test_itinerary(self):
+        """Test route planning over a list and a visitlist."""
+        create_locations()
+        create_user()
+        import random
+        rng = random.Random(5)
+        # Ten stops a degree apart along the equator, in a random order.
+        longitudes = list(range(10))
+        rng.shuffle(longitudes)
+        db.session.add_all([Location(title=f'Stop {lng}', list_id=1,
+                latitude=0.0, longitude=float(lng)) for lng in longitudes])
+        db.session.commit()
+
+        response = self.app.get('/list/1/itinerary.json')
+        body = response.get_json()
+        order = [stop['title'] for stop in body['stops']]
+        self.assertIn(order, [[f'Stop {lng}' for lng in range(10)],
+            [f'Stop {lng}' for lng in reversed(range(10))]])
+        self.assertAlmostEqual(body['total_km'],
+            haversine_km(0, 0, 0, 9), places=2)
+        self.assertEqual([stop['title'] for stop in body['unlocated']],
+            ['Torres del Paine National Park'])
+
+        # From a start point the route begins at the nearest end.
+        body = self.app.get('/list/1/itinerary.json?lat=0&lng=12').get_json()
+        self.assertEqual(body['stops'][0]['title'], 'Stop 9')
+        self.assertAlmostEqual(body['stops'][0]['leg_km'],
+            haversine_km(0, 12, 0, 9), places=2)
+        # Nearby starts are rounded to the same one and share its route.
+        from unittest import mock
+        with mock.patch('scenery_app.itinerary.optimize',
+                side_effect=AssertionError('not cached')):
+            response = self.app.get(
+                '/list/1/itinerary.json?lat=0.0012&lng=11.9987')
+        self.assertEqual(response.get_json(), body)
+
+        # Routes are cached by content: a rename doesn't plan it again.
+        Location.query.filter_by(title='Stop 4').update({'title': 'Four'})
+        db.session.commit()
+        with mock.patch('scenery_app.itinerary.optimize',
+                side_effect=AssertionError('not cached')):
+            body = self.app.get('/list/1/itinerary.json').get_json()
+        self.assertIn('Four', [stop['title'] for stop in body['stops']])
+
+        # Dated stops keep their date order, even against the distance.
+        Location.query.filter_by(title='Stop 8').update(
+            {'visited_date': date(2020, 1, 1)})
+        Location.query.filter_by(title='Stop 1').update(
+            {'visited_date': date(2020, 1, 2)})
+        Location.query.filter_by(title='Stop 9').update(
+            {'visited_date': date(2020, 1, 3)})
+        db.session.commit()
+        body = self.app.get('/list/1/itinerary.json').get_json()
+        dated = [stop['title'] for stop in body['stops']
+            if stop['visited_date']]
+        self.assertEqual(dated, ['Stop 8', 'Stop 1', 'Stop 9'])
+
+        db.session.execute(visitlist_locations_table.insert(),
+            [{'user_id': 1, 'location_id': id} for id in (3, 4, 5)])
+        db.session.commit()
+        body = self.app.get('/profile/me1/itinerary.json').get_json()
+        self.assertEqual(len(body['stops']), 3)
+        self.assertEqual(
+            self.app.get('/profile/nobody/itinerary.json').status_code, 404)
+        self.assertEqual(self.app.get('/list/99/itinerary.json').status_code,
+            404)
+        self.assertEqual(
+            self.app.get('/list/1/itinerary.json?lat=0').status_code, 400)
+        max_stops = app.config['ITINERARY_MAX_STOPS']
+        app.config['ITINERARY_MAX_STOPS'] = 5
+        try:
+            self.assertEqual(
+                self.app.get('/list/1/itinerary.json').status_code, 422)
+        finally:
+            app.config['ITINERARY_MAX_STOPS'] = max_stops
+
+        # Anonymous clients can only ask for so many routes.
+        for _ in range(30):
+            self.app.get('/list/1/itinerary.json?lat=1&lng=1')
+        response = self.app.get('/list/1/itinerary.json?lat=1&lng=1')
+        self.assertEqual(response.status_code, 429)
+
+        # A 500 stop list, a tenth of it dated, is planned within a second
+        # and comes out much shorter than the greedy route.
+        latitudes = [rng.uniform(35, 60) for _ in range(500)]
+        longitudes = [rng.uniform(-10, 30) for _ in range(500)]
+        dates = [date(2024, rng.randint(1, 12), 1) if rng.random() < 0.1
+            else None for _ in range(500)]
+        import time
+        started = time.perf_counter()
+        order = itinerary.optimize(latitudes, longitudes, dates,
+            time_budget=app.config['ITINERARY_TIME_BUDGET'])
+        self.assertLess(time.perf_counter() - started, 1)
+        self.assertEqual(sorted(order), list(range(500)))
+        visited = [dates[index] for index in order if dates[index]]
+        self.assertEqual(visited, sorted(visited))
+        dist = itinerary.distance_matrix(latitudes, longitudes)
+        greedy = itinerary.nearest_neighbour(dist,
+            itinerary.date_ranks(dates))
+        length = lambda order: dist[order[:-1], order[1:]].sum()
+        self.assertLess(length(order), 0.85 * length(greedy))
+
+    def test_recommendations(self):
+        """Test precomputed suggestions and their incremental refresh."""
+        create_user()
+        create_locations()
+        for title, landscape in [('Grey Glacier', Landscape.GLACIER),
+                ('Fitz Roy', Landscape.MOUNTAINS),
+                ('Perito Moreno', Landscape.GLACIER)]:
+            db.session.add(Location(title=title, list_id=1,
+                landscape=landscape))
+        hiking = Entry(name='Hiking')
+        db.session.add(hiking)
+        db.session.commit()
+        for location in Location.query.filter(Location.id.in_([1, 3])):
+            location.entries.append(hiking)
+        for username, favorites in [('other1', [1, 3, 4]), ('other2', [1, 3]),
+                ('other3', [2, 5])]:
+            user = User(username=username, password='x')
+            user.favorite_locations = [Location.query.get(id)
+                for id in favorites]
+            db.session.add(user)
+        db.session.commit()
+
+        # Anonymous visitors see the most favorited locations.
+        with app.app_context():
+            rebuild_recommendations()
+        response = self.app.get('/')
+        page = response.get_data(as_text=True)
+        self.assertIn('Unsure Where to Head Next?', page)
+        self.assertLess(page.index('Torres del Paine'), page.index('Fitz Roy'))
+
+        # Favoriting 1 suggests what people who like 1 also like.
+        login(self.app, 'me1', 'password')
+        self.app.post('/favorite/1')
+        me_id = User.query.filter_by(username='me1').one().id
+        with count_queries() as counter:
+            self.assertEqual([row.id for row in recommended_locations(me_id)],
+                [3, 4])
+        self.assertEqual(len(counter.statements), 1)
+
+        # A full rebuild agrees with the incremental refresh.
+        with app.app_context():
+            rebuild_recommendations()
+        self.assertEqual([row.id for row in recommended_locations(me_id)],
+            [3, 4])
+
+        self.app.post('/unfavorite/1')
+        self.assertEqual([row.id for row in recommended_locations(me_id)][:2],
+            [1, 3])
+
+    def test_photo_upload(self):
+        """Test uploading, deduplicating and serving location photos."""
+        create_user()
+        create_locations()
+        login(self.app, 'me1', 'password')
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        app.config['MEDIA_ROOT'] = media_root.name
+        app.config['MEDIA_THUMBNAIL_SIZES'] = [160, 480]
+
+        image = BytesIO()
+        Image.new('RGB', (800, 600), 'teal').save(image, 'PNG')
+        def upload(location_id, data):
+            return self.app.post(f'/location/{location_id}/photos', data={
+                'photo': (BytesIO(data), 'photo.png')},
+                content_type='multipart/form-data', follow_redirects=True)
+
+        response = upload(1, image.getvalue())
+        self.assertIn(b'Photo was uploaded successfully.', response.data)
+        photo = Photo.query.one()
+        self.assertEqual((photo.extension, photo.size),
+            ('png', len(image.getvalue())))
+        self.assertEqual((photo.width, photo.height), (800, 600))
+        self.assertTrue(photo.thumbnails)
+        digest = photo.digest
+        self.assertIn(f'/media/{digest}/480.jpg'.encode(), response.data)
+        with Image.open(os.path.join(media_root.name,
+                'thumbnails', '160', digest[:2], digest[2:4],
+                f'{digest}.jpg')) as thumbnail:
+            self.assertEqual(thumbnail.size, (160, 120))
+
+        # The same file is stored once, however often it is attached.
+        response = upload(1, image.getvalue())
+        self.assertIn(b'That photo is already on this location.', response.data)
+        upload(2, image.getvalue())
+        self.assertEqual(Photo.query.count(), 2)
+        self.assertTrue(Photo.query.get(2).thumbnails)
+        originals = [name for _, _, names in os.walk(
+            os.path.join(media_root.name, 'originals')) for name in names]
+        self.assertEqual(originals, [f'{digest}.png'])
+        self.assertEqual(os.listdir(os.path.join(media_root.name, 'tmp')), [])
+
+        response = upload(1, b'#!/bin/sh\necho not a photo\n')
+        self.assertIn(b'Upload a JPEG, PNG, GIF or WebP image.', response.data)
+        app.config['MEDIA_MAX_BYTES'] = 1024
+        self.addCleanup(app.config.__setitem__, 'MEDIA_MAX_BYTES',
+            20 * 1024 * 1024)
+        self.assertEqual(upload(1, b'\xff\xd8\xff' + bytes(4096))
+            .status_code, 413)
+        self.assertEqual(Photo.query.count(), 2)
+        self.assertEqual(os.listdir(os.path.join(media_root.name, 'tmp')), [])
+
+        response = self.app.get(f'/media/{digest}.png')
+        self.assertEqual(response.data, image.getvalue())
+        self.assertEqual(response.mimetype, 'image/png')
+        self.assertEqual(response.headers['Cache-Control'],
+            'public, max-age=31536000, immutable')
+        response.close()
+        self.assertEqual(self.app.get(f'/media/{digest}/320.jpg')
+            .status_code, 404)
+        self.assertEqual(self.app.get(f'/media/{"0" * 64}.png')
+            .status_code, 404)
+
+        app.config['MEDIA_SENDFILE'] = 'x-accel-redirect'
+        response = self.app.get(f'/media/{digest}/160.jpg')
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['X-Accel-Redirect'],
+            f'/_media/thumbnails/160/{digest[:2]}/{digest[2:4]}/'
+            f'{digest}.jpg')
+
+    def test_migrations(self):
+        """Test upgrading a database made by the first release."""
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        legacy = os.path.join(tmp.name, 'legacy.db')
+        shutil.copy(os.path.join(os.path.dirname(app.root_path),
+            'scenery_app', 'database.db'), legacy)
+        conn = sqlite3.connect(legacy)
+        conn.executescript("""
+            DELETE FROM location_entry; DELETE FROM user_location;
+            DELETE FROM location; DELETE FROM entry; DELETE FROM list;
+            DELETE FROM user;
+            INSERT INTO list (id, name) VALUES (1, 'Chile');
+            INSERT INTO location (id, title, list_id, landscape)
+                VALUES (1, 'Grey Glacier', 1, 'GLACIER'),
+                       (2, 'Fitz Roy', 1, 'MOUNTAINS');
+            INSERT INTO entry (id, name) VALUES (1, 'Hiking');
+            INSERT INTO user (id, username, password) VALUES (1, 'me1', 'x');
+            INSERT INTO location_entry VALUES (1, 1), (1, 1), (2, 1), (NULL, 1);
+            INSERT INTO user_location VALUES (1, 1), (1, 1), (2, 1);
+        """)
+        conn.commit()
+        conn.close()
+
+        db.session.remove()
+        app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{legacy}'
+        messages = []
+        with app.app_context():
+            upgrade(echo=messages.append)
+            self.assertEqual(len(messages), len(migrations()))
+            with db.engine.connect() as conn:
+                self.assertEqual(applied_versions(conn),
+                    {migration.version for migration in migrations()})
+                self.assertTrue(has_index(conn, 'location_entry',
+                    'uq_location_entry'))
+                self.assertTrue(has_index(conn, 'user_location',
+                    'ix_user_location_location_id'))
+                self.assertEqual(conn.execute(
+                    'SELECT * FROM location_entry ORDER BY location_id')
+                    .fetchall(), [(1, 1), (2, 1)])
+                self.assertEqual(conn.execute(
+                    'SELECT COUNT(*) FROM user_location').scalar(), 2)
+                self.assertEqual(conn.execute(
+                    "SELECT COUNT(*) FROM location WHERE updated_at "
+                    "= '1970-01-01 00:00:00'").scalar(), 0)
+                self.assertTrue(has_index(conn, 'user', 'ix_user_updated_at'))
+            self.assertEqual(Location.query.get(1).version, 1)
+            self.assertEqual(user_stats(1)['favorites'], 2)
+            self.assertEqual(FacetCount.query.filter_by(
+                facet='landscape', value='GLACIER').one().count, 1)
+
+            # Nothing left to do the second time.
+            messages = []
+            upgrade(echo=messages.append)
+            self.assertEqual(messages, [])
+
+            fresh = os.path.join(tmp.name, 'fresh.db')
+            db.session.remove()
+            app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{fresh}'
+            upgrade(echo=messages.append)
+            self.assertEqual(messages, ['Created the tables for a new database.'])
+            with db.engine.connect() as conn:
+                self.assertEqual(len(applied_versions(conn)), len(migrations()))
+                self.assertTrue(has_index(conn, 'location_entry',
+                    'ix_location_entry_entry_id'))
+            db.session.remove()
+
@@ -0,0 +1,364 @@
+"""
+Photo uploads, thumbnails and serving.
+
+Uploaded files are streamed straight into a temporary file under
+MEDIA_ROOT/tmp while they are parsed, hashing them on the way, so a
+request never holds a whole photo in memory. The finished file is renamed
+to a path made from its SHA-256 digest; the same photo uploaded twice is
+stored once.
+
+Thumbnails (one JPEG per MEDIA_THUMBNAIL_SIZES entry) are made by a
+'media.thumbnails' job that hands the image work to a process pool, so
+neither web requests nor the job workers' threads spend time in Pillow.
+
+File names never change once written, so /media responses are cached as
+immutable. With MEDIA_SENDFILE set, the app only answers with a header
+and the front-end server sends the bytes.
+"""
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+import re
+import tempfile
+import threading
+
+import click
+from flask import Request, abort, current_app, send_file, url_for
+from flask.cli import AppGroup
+from PIL import Image, ImageOps
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from scenery_app.extensions import app, db
+from scenery_app.fragment_cache import bump_locations
+from scenery_app.jobs import job, enqueue
+from scenery_app.models import Photo
+
+FORMATS = {
+    'jpg': 'image/jpeg',
+    'png': 'image/png',
+    'gif': 'image/gif',
+    'webp': 'image/webp',
+}
+CHUNK_SIZE = 64 * 1024
+EXIF_ORIENTATION = 0x0112
+_DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+class UnsupportedMedia(ValueError):
+    """The upload isn't an image format we store."""
+
+def sniff(head):
+    """The extension for a file starting with `head`, or None. The client's
+    file name and Content-Type are never trusted."""
+    if head.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if head[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+###########################
+# Paths
+###########################
+
+def valid_digest(digest):
+    return bool(_DIGEST.match(digest))
+
+def original_path(digest, extension):
+    """Where an upload is stored, relative to MEDIA_ROOT."""
+    return f'originals/{digest[:2]}/{digest[2:4]}/{digest}.{extension}'
+
+def thumbnail_path(digest, size):
+    return f'thumbnails/{size}/{digest[:2]}/{digest[2:4]}/{digest}.jpg'
+
+def _absolute(relative_path):
+    return os.path.join(current_app.config['MEDIA_ROOT'], relative_path)
+
+def photo_url(photo, size=None):
+    """
+    URL of a photo, or of its smallest thumbnail at least `size` pixels
+    wide (the largest if none is) once thumbnails exist.
+    """
+    if size is None or not photo.thumbnails:
+        return url_for('main.media_original', digest=photo.digest,
+            extension=photo.extension)
+    sizes = sorted(current_app.config['MEDIA_THUMBNAIL_SIZES'])
+    best = next((each for each in sizes if each >= size), sizes[-1])
+    return url_for('main.media_thumbnail', digest=photo.digest, size=best)
+
+def photo_srcset(photo):
+    """A srcset listing every thumbnail, for responsive <img> tags."""
+    if not photo.thumbnails:
+        return ''
+    return ', '.join(
+        url_for('main.media_thumbnail', digest=photo.digest, size=size) +
+            f' {size}w'
+        for size in sorted(current_app.config['MEDIA_THUMBNAIL_SIZES']))
+
+app.add_template_global(photo_url)
+app.add_template_global(photo_srcset)
+
+###########################
+# Uploads
+###########################
+
+class UploadSpool(object):
+    """
+    A temporary file in MEDIA_ROOT/tmp that hashes and counts what is
+    written to it, so a finished upload can be renamed into place without
+    reading it again. The file is deleted on close unless it was stored.
+    """
+    def __init__(self, directory, max_bytes):
+        os.makedirs(directory, exist_ok=True)
+        self._file = tempfile.NamedTemporaryFile(dir=directory, delete=False)
+        self.name = self._file.name
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.head = b''
+        self.stored = False
+        self._sha256 = hashlib.sha256()
+
+    def write(self, data):
+        self.size += len(data)
+        if self.max_bytes and self.size > self.max_bytes:
+            self.close()
+            raise RequestEntityTooLarge(
+                f'Photos are limited to {self.max_bytes} bytes.')
+        if len(self.head) < 16:
+            self.head += data[:16 - len(self.head)]
+        self._sha256.update(data)
+        self._file.write(data)
+
+    def hexdigest(self):
+        return self._sha256.hexdigest()
+
+    def close(self):
+        self._file.close()
+        if not self.stored:
+            try:
+                os.unlink(self.name)
+            except FileNotFoundError:
+                pass
+
+    def __getattr__(self, name):
+        # read(), seek() and friends for code that wants the contents
+        return getattr(self._file, name)
+
+def new_spool():
+    config = current_app.config
+    return UploadSpool(os.path.join(config['MEDIA_ROOT'], 'tmp'),
+        config['MEDIA_MAX_BYTES'])
+
+class UploadRequest(Request):
+    """Parse uploaded files into UploadSpools rather than Werkzeug's
+    default, which keeps files under 500KB in memory."""
+    def _get_file_stream(self, total_content_length, content_type,
+            filename=None, content_length=None):
+        return new_spool()
+
+def _spooled(upload):
+    """The upload's spool, copying it into one in chunks if it was parsed
+    some other way."""
+    if isinstance(upload.stream, UploadSpool):
+        return upload.stream
+    spool = new_spool()
+    try:
+        upload.stream.seek(0)
+        for chunk in iter(lambda: upload.stream.read(CHUNK_SIZE), b''):
+            spool.write(chunk)
+    except BaseException:
+        spool.close()
+        raise
+    return spool
+
+def store(spool):
+    """
+    Move a finished upload to its content-addressed path. Returns
+    (digest, extension, size); a file already stored under the same
+    digest is kept and the spool discarded.
+    """
+    extension = sniff(spool.head)
+    if extension is None:
+        raise UnsupportedMedia('Upload a JPEG, PNG, GIF or WebP image.')
+    digest = spool.hexdigest()
+    path = _absolute(original_path(digest, extension))
+    if not os.path.exists(path):
+        spool.flush()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Temporary files are private; the front-end server must read it.
+        os.chmod(spool.name, 0o644)
+        os.replace(spool.name, path)
+        spool.stored = True
+    return digest, extension, spool.size
+
+def attach_photo(location_id, upload):
+    """
+    Store an uploaded file and attach it to a location, queueing its
+    thumbnails unless the same file already has them. Returns
+    (photo, created); commit with the caller's transaction.
+    """
+    spool = _spooled(upload)
+    try:
+        digest, extension, size = store(spool)
+    finally:
+        if spool is not upload.stream:
+            spool.close()
+    photo = Photo.query.filter_by(
+        location_id=location_id, digest=digest).first()
+    if photo is not None:
+        return photo, False
+    processed = (db.session.query(Photo.width, Photo.height)
+        .filter(Photo.digest == digest, Photo.thumbnails.is_(True))
+        .first())
+    photo = Photo(location_id=location_id, digest=digest,
+        extension=extension, size=size)
+    if processed is not None:
+        photo.width, photo.height = processed
+        photo.thumbnails = True
+    db.session.add(photo)
+    if processed is None:
+        enqueue('media.thumbnails', digest=digest, extension=extension)
+    return photo, True
+
+###########################
+# Thumbnails
+###########################
+
+def _flatten(image):
+    """An RGB copy of the image, with any transparency on white."""
+    if image.mode in ('RGB', 'L'):
+        return image
+    image = image.convert('RGBA')
+    background = Image.new('RGB', image.size, 'white')
+    background.paste(image, mask=image.getchannel('A'))
+    return background
+
+def _save_jpeg(image, path):
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, partial = tempfile.mkstemp(dir=directory, suffix='.jpg')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            image.save(out, 'JPEG', quality=85, optimize=True,
+                progressive=True)
+        os.chmod(partial, 0o644)
+        os.replace(partial, path)
+    except BaseException:
+        os.unlink(partial)
+        raise
+
+def render_thumbnails(source, targets, replace=False):
+    """
+    Write a JPEG for each (size, path) in `targets` that doesn't exist
+    yet (or every one, with `replace`), fitting the image in a size x size
+    box. Returns the image's (width, height) as displayed. Runs in the
+    thumbnail pool.
+    """
+    with Image.open(source) as image:
+        width, height = image.size
+        if image.getexif().get(EXIF_ORIENTATION, 1) in (5, 6, 7, 8):
+            width, height = height, width
+        missing = [(size, path) for size, path in targets
+            if replace or not os.path.exists(path)]
+        if missing:
+            largest = max(size for size, _ in missing)
+            # JPEGs can be scaled down while decoding, which is much
+            # cheaper than decoding at full size and resizing.
+            image.draft('RGB', (largest, largest))
+            upright = _flatten(ImageOps.exif_transpose(image))
+            for size, path in sorted(missing, reverse=True):
+                thumbnail = upright.copy()
+                thumbnail.thumbnail((size, size))
+                _save_jpeg(thumbnail, path)
+    return width, height
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor():
+    """The process-wide thumbnail pool, created on first use."""
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ProcessPoolExecutor(
+                    max_workers=current_app.config['MEDIA_THUMBNAIL_WORKERS'])
+    return _executor
+
+def shutdown():
+    """Stop the pool, e.g. in a gunicorn post_fork hook."""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
+
+@job('media.thumbnails')
+def make_thumbnails(digest, extension, replace=False):
+    """Render a stored file's thumbnails and mark its photos ready."""
+    config = current_app.config
+    source = _absolute(original_path(digest, extension))
+    targets = [(size, _absolute(thumbnail_path(digest, size)))
+        for size in config['MEDIA_THUMBNAIL_SIZES']]
+    if config['MEDIA_THUMBNAIL_EXECUTOR'] == 'inline':
+        width, height = render_thumbnails(source, targets, replace)
+    else:
+        width, height = get_executor().submit(
+            render_thumbnails, source, targets, replace).result(
+                timeout=config['MEDIA_THUMBNAIL_TIMEOUT'])
+    location_ids = [id for (id,) in db.session.query(Photo.location_id)
+        .filter(Photo.digest == digest)]
+    Photo.query.filter(Photo.digest == digest).update(
+        {Photo.width: width, Photo.height: height, Photo.thumbnails: True},
+        synchronize_session=False)
+    bump_locations(location_ids)
+
+###########################
+# Serving
+###########################
+
+def send_media(relative_path, mimetype):
+    """
+    Respond with a stored file, handing the body to the front-end server
+    when MEDIA_SENDFILE is 'x-accel-redirect' (nginx) or 'x-sendfile'.
+    """
+    config = current_app.config
+    path = _absolute(relative_path)
+    if not os.path.isfile(path):
+        abort(404)
+    if config['MEDIA_SENDFILE'] == 'x-accel-redirect':
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = (
+            config['MEDIA_ACCEL_PREFIX'].rstrip('/') + '/' + relative_path)
+    elif config['MEDIA_SENDFILE'] == 'x-sendfile':
+        response = current_app.response_class(mimetype=mimetype)
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+    else:
+        response = send_file(path, mimetype=mimetype, conditional=True)
+    # The name is the content's digest, so it never needs revalidating.
+    response.headers['Cache-Control'] = (
+        f'public, max-age={config["MEDIA_MAX_AGE"]}, immutable')
+    return response
+
+###########################
+# Commands
+###########################
+
+media_cli = AppGroup('media', help='Manage uploaded photos.')
+
+@media_cli.command('thumbnails')
+@click.option('--all', 'redo', is_flag=True,
+    help='Redo every file, e.g. after changing MEDIA_THUMBNAIL_SIZES.')
+def thumbnails_command(redo):
+    """Queue thumbnail jobs for stored photos."""
+    query = db.session.query(Photo.digest, Photo.extension).distinct()
+    if not redo:
+        query = query.filter(Photo.thumbnails.is_(False))
+    files = query.all()
+    for digest, extension in files:
+        enqueue('media.thumbnails', digest=digest, extension=extension,
+            replace=redo)
+    db.session.commit()
+    click.echo(f'Queued thumbnails for {len(files)} files.')
@@ -0,0 +1,9 @@
+"""
+Create the tables a database made by an older release doesn't have yet
+(user_visitlist, facet_count, user_stat, job, ...). Existing tables are
+left alone; the scripts after this one bring them up to date.
+"""
+from scenery_app.extensions import db
+
+def upgrade(conn):
+    db.metadata.create_all(bind=conn)
@@ -0,0 +1,26 @@
+"""
+Add the location columns introduced since the first release, then fill
+in geohashes for rows that have coordinates but no hash, in batches.
+"""
+from sqlalchemy import Column, Float, Integer, String, text
+
+from scenery_app.geo import position_hash
+from scenery_app.migrations import add_column, batches
+
+TRANSACTIONAL = False
+
+def upgrade(conn):
+    add_column(conn, 'location', Column('version', Integer, nullable=False,
+        server_default='1'))
+    add_column(conn, 'location', Column('latitude', Float))
+    add_column(conn, 'location', Column('longitude', Float))
+    add_column(conn, 'location', Column('geohash', String(12)))
+
+    for rows in batches(conn, 'location', ['latitude', 'longitude'],
+            where='geohash IS NULL AND latitude IS NOT NULL '
+                'AND longitude IS NOT NULL'):
+        with conn.begin():
+            conn.execute(text(
+                'UPDATE location SET geohash = :geohash WHERE id = :id'),
+                [{'id': id, 'geohash': position_hash(latitude, longitude)}
+                    for id, latitude, longitude in rows])
@@ -0,0 +1,19 @@
+"""
+Remove the rows that would break the unique indexes added next:
+association rows missing either side, and repeated links.
+"""
+from sqlalchemy import text
+
+from scenery_app.migrations import dedupe
+
+LINKS = {
+    'location_entry': ['location_id', 'entry_id'],
+    'user_location': ['user_id', 'location_id'],
+    'user_visitlist': ['user_id', 'location_id'],
+}
+
+def upgrade(conn):
+    for table, columns in LINKS.items():
+        conn.execute(text(f'DELETE FROM {table} WHERE ' +
+            ' OR '.join(f'{column} IS NULL' for column in columns)))
+        dedupe(conn, table, columns)
@@ -0,0 +1,30 @@
+"""
+Index the association tables in both directions (the unique index on
+each pair doubles as the lookup from its first column) and add the
+location indexes that create_all() never added to existing tables.
+Built online, so the site keeps taking writes meanwhile.
+"""
+from scenery_app.migrations import create_index
+
+TRANSACTIONAL = False
+
+INDEXES = [
+    # (name, table, columns, unique)
+    ('uq_location_entry', 'location_entry', ['location_id', 'entry_id'], True),
+    ('ix_location_entry_entry_id', 'location_entry', ['entry_id'], False),
+    ('uq_user_location', 'user_location', ['user_id', 'location_id'], True),
+    ('ix_user_location_location_id', 'user_location', ['location_id'], False),
+    ('uq_user_visitlist', 'user_visitlist', ['user_id', 'location_id'], True),
+    ('ix_user_visitlist_location_id', 'user_visitlist', ['location_id'],
+        False),
+    ('ix_location_landscape_visited_date', 'location',
+        ['landscape', 'visited_date'], False),
+    ('ix_location_list_id_visited_date', 'location',
+        ['list_id', 'visited_date'], False),
+    ('ix_location_visited_date', 'location', ['visited_date'], False),
+    ('ix_location_geohash', 'location', ['geohash'], False),
+]
+
+def upgrade(conn):
+    for name, table, columns, unique in INDEXES:
+        create_index(conn, name, table, columns, unique)
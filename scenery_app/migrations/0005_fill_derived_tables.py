@@ -0,0 +1,28 @@
+"""
+Fill the tables derived from existing data (facet counts, user stats,
+the search index and recommendations) when a database has rows they
+should count but they are still empty.
+"""
+from sqlalchemy import text
+
+from scenery_app import facets, recommendations, search, user_stats
+
+TRANSACTIONAL = False
+
+def _has_rows(conn, table):
+    row = conn.execute(text(f'SELECT 1 FROM {table} LIMIT 1')).first()
+    return row is not None
+
+def upgrade(conn):
+    if _has_rows(conn, 'location'):
+        if not _has_rows(conn, 'facet_count'):
+            facets.rebuild()
+        if not _has_rows(conn, 'search_index'):
+            search.rebuild()
+    if ((_has_rows(conn, 'user_location') or
+            _has_rows(conn, 'user_visitlist')) and
+            not _has_rows(conn, 'user_stat')):
+        user_stats.rebuild()
+    if (_has_rows(conn, 'user_location') and
+            not _has_rows(conn, 'recommendation')):
+        recommendations.rebuild()
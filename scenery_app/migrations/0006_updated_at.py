@@ -0,0 +1,38 @@
+"""
+Add updated_at to locations, lists, entries and users, stamp the rows
+that already exist with the time of the upgrade, in batches, and index
+the columns the page validators read MAX() from.
+"""
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, text
+
+from scenery_app.migrations import add_column, batches, create_index
+
+TRANSACTIONAL = False
+
+TABLES = ['location', 'list', 'entry', 'user']
+
+# SQLite can only add a NOT NULL column with a constant default, so rows
+# start out at this and are stamped below.
+UNSET = '1970-01-01 00:00:00'
+
+INDEXES = [
+    ('ix_location_updated_at', 'location', ['updated_at']),
+    ('ix_user_updated_at', 'user', ['updated_at']),
+]
+
+def upgrade(conn):
+    now = datetime.utcnow()
+    for table in TABLES:
+        add_column(conn, table, Column('updated_at', DateTime,
+            nullable=False, server_default=UNSET))
+        quoted = conn.dialect.identifier_preparer.quote(table)
+        for rows in batches(conn, table, [],
+                where=f"updated_at = '{UNSET}'"):
+            with conn.begin():
+                conn.execute(text(
+                    f'UPDATE {quoted} SET updated_at = :now WHERE id = :id'),
+                    [{'id': id, 'now': now} for (id,) in rows])
+    for name, table, columns in INDEXES:
+        create_index(conn, name, table, columns)
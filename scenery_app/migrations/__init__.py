@@ -0,0 +1,212 @@
+"""
+Versioned schema migrations.
+
+Each script in this package is named NNNN_description.py and defines
+`upgrade(conn)`. `flask db upgrade` runs the ones not yet recorded in the
+schema_version table, in order. Deploys run it once; web workers never
+touch the schema on startup.
+
+A brand new database skips the scripts: the tables are created from the
+models and every version is recorded as applied. An existing database
+with no schema_version table (one made by the old `create_all()` at
+startup) runs them all, so scripts check before changing anything and
+are safe to re-run.
+
+Scripts run in a transaction unless they set TRANSACTIONAL = False. That
+is required for PostgreSQL's CREATE INDEX CONCURRENTLY, which builds an
+index without blocking writes, and for backfills that commit batch by
+batch so they never lock a large table for long.
+"""
+from collections import namedtuple
+from datetime import datetime
+import importlib
+import pkgutil
+import re
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import (Column, DateTime, Integer, MetaData, String, Table,
+    inspect, text)
+from sqlalchemy.schema import CreateColumn
+
+from scenery_app.extensions import db
+
+# Kept out of db.metadata so create_all() never makes it.
+schema_version = Table('schema_version', MetaData(),
+    Column('version', Integer, primary_key=True, autoincrement=False),
+    Column('name', String(200), nullable=False),
+    Column('applied_at', DateTime, nullable=False),
+)
+
+Migration = namedtuple('Migration', 'version name module')
+
+# Any constant shared by the processes that might migrate at once
+_LOCK_ID = 7305
+
+def migrations():
+    """Every migration script, in version order."""
+    found = []
+    for info in pkgutil.iter_modules(__path__):
+        match = re.match(r'^(\d{4})_\w+$', info.name)
+        if match:
+            found.append(Migration(int(match.group(1)), info.name,
+                importlib.import_module(f'{__name__}.{info.name}')))
+    found.sort()
+    versions = [migration.version for migration in found]
+    if len(set(versions)) != len(versions):
+        raise RuntimeError('Two migrations share a version number.')
+    return found
+
+def applied_versions(conn):
+    schema_version.create(conn, checkfirst=True)
+    return {version for (version,) in
+        conn.execute(schema_version.select().with_only_columns(
+            [schema_version.c.version]))}
+
+def _record(conn, migration):
+    conn.execute(schema_version.insert(), version=migration.version,
+        name=migration.name, applied_at=datetime.utcnow())
+
+def _run(conn, migration):
+    if getattr(migration.module, 'TRANSACTIONAL', True):
+        with conn.begin():
+            migration.module.upgrade(conn)
+            _record(conn, migration)
+        return
+    # A connection of its own, as the isolation level sticks to it until
+    # it goes back to the pool.
+    with db.engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as autocommit:
+        migration.module.upgrade(autocommit)
+    with conn.begin():
+        _record(conn, migration)
+
+def upgrade(target=None, echo=click.echo):
+    """Apply the pending migrations up to `target` (default: all)."""
+    with db.engine.connect() as conn:
+        postgres = conn.dialect.name == 'postgresql'
+        if postgres:
+            # Deploys on several hosts at once take turns.
+            conn.execute(text('SELECT pg_advisory_lock(:id)'), id=_LOCK_ID)
+        try:
+            done = applied_versions(conn)
+            pending = [migration for migration in migrations()
+                if migration.version not in done and
+                    (target is None or migration.version <= target)]
+            if not done and target is None and set(
+                    inspect(conn).get_table_names()) == {'schema_version'}:
+                with conn.begin():
+                    db.metadata.create_all(bind=conn)
+                    for migration in pending:
+                        _record(conn, migration)
+                echo('Created the tables for a new database.')
+                return
+            for migration in pending:
+                echo(f'Applying {migration.name}...')
+                _run(conn, migration)
+        finally:
+            if postgres:
+                conn.execute(text('SELECT pg_advisory_unlock(:id)'),
+                    id=_LOCK_ID)
+
+###########################
+# Helpers for scripts
+###########################
+
+def _quote(conn, name):
+    return conn.dialect.identifier_preparer.quote(name)
+
+def has_column(conn, table, column):
+    return column in {each['name']
+        for each in inspect(conn).get_columns(table)}
+
+def has_index(conn, table, name):
+    """Whether `table` has an index or unique constraint called `name`."""
+    inspector = inspect(conn)
+    return name in ({each['name'] for each in inspector.get_indexes(table)} |
+        {each['name'] for each in inspector.get_unique_constraints(table)})
+
+def add_column(conn, table, column):
+    """ALTER TABLE ... ADD COLUMN for a Column object, unless it exists.
+    New NOT NULL columns need a server_default to fill existing rows."""
+    if has_column(conn, table, column.name):
+        return False
+    ddl = CreateColumn(column).compile(dialect=conn.dialect)
+    conn.execute(text(f'ALTER TABLE {_quote(conn, table)} ADD COLUMN {ddl}'))
+    return True
+
+def create_index(conn, name, table, columns, unique=False):
+    """
+    Create an index unless it exists. On PostgreSQL it is built
+    CONCURRENTLY, so the migration must set TRANSACTIONAL = False; a
+    build that failed part way leaves an invalid index, which is dropped
+    and built again.
+    """
+    postgres = conn.dialect.name == 'postgresql'
+    if postgres and conn.execute(text(
+            'SELECT NOT indisvalid FROM pg_index '
+            'WHERE indexrelid = to_regclass(:name)'), name=name).scalar():
+        conn.execute(text(f'DROP INDEX CONCURRENTLY {_quote(conn, name)}'))
+    if has_index(conn, table, name):
+        return False
+    conn.execute(text(
+        f'CREATE {"UNIQUE " if unique else ""}INDEX '
+        f'{"CONCURRENTLY " if postgres else ""}{_quote(conn, name)} '
+        f'ON {_quote(conn, table)} '
+        f'({", ".join(_quote(conn, column) for column in columns)})'))
+    return True
+
+def dedupe(conn, table, columns):
+    """Delete all but one of each set of rows with equal `columns`,
+    e.g. before adding a unique index. Returns the rows deleted."""
+    quoted = _quote(conn, table)
+    if conn.dialect.name == 'postgresql':
+        same = ' AND '.join(
+            f'a.{_quote(conn, column)} = b.{_quote(conn, column)}'
+            for column in columns)
+        statement = (f'DELETE FROM {quoted} a USING {quoted} b '
+            f'WHERE a.ctid > b.ctid AND {same}')
+    else:
+        statement = (f'DELETE FROM {quoted} WHERE rowid NOT IN ('
+            f'SELECT MIN(rowid) FROM {quoted} GROUP BY '
+            f'{", ".join(_quote(conn, column) for column in columns)})')
+    return conn.execute(text(statement)).rowcount
+
+def batches(conn, table, columns, where='1 = 1', batch_size=1000):
+    """
+    Yield lists of up to `batch_size` rows of `table` matching `where`,
+    walking its integer `id` primary key. Apply each batch's changes in
+    a short transaction of its own before asking for the next.
+    """
+    selected = ', '.join(_quote(conn, column) for column in ['id'] + columns)
+    statement = f'SELECT {selected} FROM {_quote(conn, table)} WHERE ({where})'
+    rows = conn.execute(text(f'{statement} ORDER BY id LIMIT :limit'),
+        limit=batch_size).fetchall()
+    while rows:
+        yield rows
+        rows = conn.execute(text(
+            f'{statement} AND id > :after ORDER BY id LIMIT :limit'),
+            after=rows[-1][0], limit=batch_size).fetchall()
+
+###########################
+# Commands
+###########################
+
+db_cli = AppGroup('db', help='Manage the database schema.')
+
+@db_cli.command('upgrade')
+@click.option('--to', 'target', type=int,
+    help='Stop after this version.')
+def upgrade_command(target):
+    """Apply pending migrations."""
+    upgrade(target)
+    click.echo('Database is up to date.')
+
+@db_cli.command('status')
+def status_command():
+    """List the migrations and whether each has been applied."""
+    with db.engine.connect() as conn:
+        done = applied_versions(conn)
+    for migration in migrations():
+        state = 'applied' if migration.version in done else 'pending'
+        click.echo(f'{migration.name}: {state}')
@@ -3,6 +3,7 @@
 from scenery_app.extensions import db
 from sqlalchemy.orm import backref
 from flask_login import UserMixin
+from datetime import datetime
 import enum
 
 class FormEnum(enum.Enum):
@@ -34,6 +35,19 @@ class Landscape(FormEnum):
 
 class Location(db.Model):
     """Location Model"""
+    __table_args__ = (
+        # Back the browse filters: landscape or list, then a date range.
+        db.Index('ix_location_landscape_visited_date',
+            'landscape', 'visited_date'),
+        db.Index('ix_location_list_id_visited_date',
+            'list_id', 'visited_date'),
+        db.Index('ix_location_visited_date', 'visited_date'),
+        # Nearest-location queries scan geohash prefix ranges.
+        db.Index('ix_location_geohash', 'geohash'),
+        # The newest change to any location, for page validators
+        db.Index('ix_location_updated_at', 'updated_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(80), nullable=False)
     visited_date = db.Column(db.Date)
@@ -46,6 +60,22 @@ class Location(db.Model):
     users_who_favorited = db.relationship(
         'User', secondary='user_location', back_populates='favorite_locations'
     )
+    users_who_visitlisted = db.relationship(
+        'User', secondary='user_visitlist', back_populates='visitlist_locations'
+    )
+    photos = db.relationship('Photo', back_populates='location',
+        order_by='Photo.id')
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    # Kept in step with the coordinates by geo.set_position()
+    geohash = db.Column(db.String(12))
+    # Bumped whenever the rendered page would change; see fragment_cache.py
+    version = db.Column(db.Integer, nullable=False, default=1,
+        server_default='1')
+    # Set again by every UPDATE of the row, bulk ones included, for the
+    # Last-Modified and ETag headers (see scenery_app/http_cache.py)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow,
+        onupdate=datetime.utcnow)
 
     def __str__(self):
         return f'<Location: {self.title}>'
@@ -53,12 +83,41 @@ class Location(db.Model):
     def __repr__(self):
         return f'<Location: {self.title}>'
     
+class Photo(db.Model):
+    """A photo attached to a location. The file itself is stored once per
+    distinct content, under its SHA-256 digest; see scenery_app/media.py."""
+    __table_args__ = (
+        db.UniqueConstraint('location_id', 'digest',
+            name='uq_photo_location_digest'),
+        # Thumbnail jobs update every photo sharing a file.
+        db.Index('ix_photo_digest', 'digest'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'),
+        nullable=False)
+    location = db.relationship('Location', back_populates='photos')
+    digest = db.Column(db.String(64), nullable=False)
+    extension = db.Column(db.String(8), nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    # Filled in by the thumbnail job
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    thumbnails = db.Column(db.Boolean, nullable=False, default=False,
+        server_default='0')
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Photo: {self.digest[:12]} of location {self.location_id}>'
+
 class List(db.Model):
     """List model."""
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(80), nullable=False)
     description = db.Column(db.String(500))
     locations = db.relationship('Location', back_populates='list')
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow,
+        onupdate=datetime.utcnow)
 
     def __str__(self):
         return f'<List: {self.name}>'
@@ -72,6 +131,8 @@ class Entry(db.Model):
     name = db.Column(db.String(80), nullable=False, unique=True)
     locations = db.relationship(
         'Location', secondary='location_entry', back_populates='entries')
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow,
+        onupdate=datetime.utcnow)
 
     def __str__(self):
         return f'<Entry: {self.name}>'
@@ -79,22 +140,118 @@ class Entry(db.Model):
     def __repr__(self):
         return f'<Entry: {self.name}>'
 
+class FacetCount(db.Model):
+    """Number of locations per landscape and per list, kept up to date as
+    locations are written so the browse page never has to count them."""
+    facet = db.Column(db.String(16), primary_key=True)
+    value = db.Column(db.String(80), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<FacetCount: {self.facet}={self.value} ({self.count})>'
+
+class UserStat(db.Model):
+    """Per-user totals for the profile page (favorites, visited, planned
+    and favorites per landscape), adjusted in the same transaction as the
+    collections they count."""
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    stat = db.Column(db.String(32), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<UserStat: {self.user_id} {self.stat} ({self.count})>'
+
+class Recommendation(db.Model):
+    """Precomputed suggestions: the top locations for each location
+    ('location'), user ('user') and everyone ('global', owner 0), in rank
+    order; see scenery_app/recommendations.py."""
+    owner_kind = db.Column(db.String(16), primary_key=True)
+    owner_id = db.Column(db.Integer, primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'),
+        nullable=False)
+    score = db.Column(db.Float, nullable=False)
+
+    def __repr__(self):
+        return (f'<Recommendation: {self.owner_kind} {self.owner_id} '
+            f'#{self.rank} -> {self.location_id}>')
+
 location_entry_table = db.Table('location_entry',
     db.Column('location_id', db.Integer, db.ForeignKey('location.id')),
-    db.Column('entry_id', db.Integer, db.ForeignKey('entry.id'))
+    db.Column('entry_id', db.Integer, db.ForeignKey('entry.id')),
+    db.UniqueConstraint('location_id', 'entry_id', name='uq_location_entry'),
+    # Which locations have an entry, e.g. for recommendations and renames
+    db.Index('ix_location_entry_entry_id', 'entry_id')
 )
 
 class User(UserMixin, db.Model):
+    __table_args__ = (
+        db.Index('ix_user_updated_at', 'updated_at'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), nullable=False, unique=True)
     password = db.Column(db.String(200), nullable=False)
     favorite_locations = db.relationship(
         'Location', secondary='user_location', back_populates='users_who_favorited')
+    visitlist_locations = db.relationship(
+        'Location', secondary='user_visitlist', back_populates='users_who_visitlisted')
+    # Also set when the user's favorites or visitlist change
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow,
+        onupdate=datetime.utcnow)
 
     def __repr__(self):
         return f'<User: {self.username}>'
 
+# The (user_id, location_id) unique constraints double as the index used
+# for membership checks, so they must keep user_id first.
 favorite_locations_table = db.Table('user_location',
     db.Column('location_id', db.Integer, db.ForeignKey('location.id')),
-    db.Column('user_id', db.Integer, db.ForeignKey('user.id'))
-)
\ No newline at end of file
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
+    db.UniqueConstraint('user_id', 'location_id', name='uq_user_location'),
+    # Who favorited a location, for the recommendation pair counts
+    db.Index('ix_user_location_location_id', 'location_id')
+)
+
+visitlist_locations_table = db.Table('user_visitlist',
+    db.Column('location_id', db.Integer, db.ForeignKey('location.id')),
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id')),
+    db.UniqueConstraint('user_id', 'location_id', name='uq_user_visitlist'),
+    db.Index('ix_user_visitlist_location_id', 'location_id')
+)
+
+class Job(db.Model):
+    """A queued side effect waiting for, or claimed by, a worker; see
+    scenery_app/jobs.py."""
+    __table_args__ = (
+        # Workers claim the oldest runnable job by status and time.
+        db.Index('ix_job_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(16), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(80))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    def __repr__(self):
+        return f'<Job: {self.name} #{self.id} ({self.status})>'
+
+class DeadJob(db.Model):
+    """A job that failed on every attempt, kept for inspection and retry."""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(80), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    attempts = db.Column(db.Integer, nullable=False)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, nullable=False)
+    failed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<DeadJob: {self.name} #{self.id}>'
@@ -0,0 +1,57 @@
+"""Keyset (cursor) pagination helpers shared by the list views."""
+from flask import current_app, request
+
+
+def page_size(arg='per_page', default_key='PAGE_SIZE'):
+    """Read the requested page size from the query string, bounded by
+    the `MAX_PAGE_SIZE` config value."""
+    default = current_app.config[default_key]
+    requested = request.args.get(arg, default, type=int)
+    return max(1, min(requested, current_app.config['MAX_PAGE_SIZE']))
+
+
+def keyset_page(query, column, after=None, limit=25):
+    """
+    Return one page of `query` ordered by `column`, starting strictly after
+    the cursor value `after`, along with the cursor for the next page (or
+    None on the last page).
+
+    `column` should be indexed (e.g. a primary key) so each page is a
+    bounded range scan no matter how far into the table it starts.
+    """
+    if after is not None:
+        query = query.filter(column > after)
+    rows = query.order_by(column).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = getattr(rows[-1], column.key)
+    return rows, next_cursor
+
+
+class KeysetStream(object):
+    """
+    The same page as keyset_page(), read while it is iterated instead of
+    up front, for templates that are streamed (see streaming.py): rows
+    come off the cursor `batch` at a time (yield_per), so the first ones
+    are sent before the rest are fetched. `next_cursor` is set once the
+    page has been iterated, so read it after the loop.
+    """
+    def __init__(self, query, column, after=None, limit=25, batch=None):
+        if after is not None:
+            query = query.filter(column > after)
+        self.query = query.order_by(column).limit(limit + 1)
+        self.column = column
+        self.limit = limit
+        self.batch = batch or current_app.config['STREAM_YIELD_PER']
+        self.next_cursor = None
+
+    def __iter__(self):
+        last = None
+        for count, row in enumerate(self.query.yield_per(self.batch), 1):
+            if count > self.limit:
+                self.next_cursor = getattr(last, self.column.key)
+                break
+            last = row
+            yield row
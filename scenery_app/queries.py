@@ -0,0 +1,91 @@
+"""Loaders that fetch everything a page needs up front. Their statement
+counts are kept honest with instrumentation.count_queries."""
+from sqlalchemy import exists, literal
+from sqlalchemy.orm import joinedload, selectinload
+
+from scenery_app.extensions import db
+from scenery_app.models import (Location, favorite_locations_table,
+    visitlist_locations_table)
+
+###########################
+# Loaders
+###########################
+
+def _membership(table, user_id, location_id):
+    """EXISTS clause for one (user, location) row of an association table."""
+    return exists().where(
+        (table.c.user_id == user_id) & (table.c.location_id == location_id))
+
+def get_location_detail(location_id, user_id=None):
+    """
+    Load a location for the detail page, returning
+    (location, is_favorite, in_visitlist).
+
+    The location, its list and the user's favorite/visitlist status come
+    back in one statement; the entries and the photos follow in one
+    SELECT ... IN each.
+    Returns (None, False, False) if there is no such location.
+    """
+    if user_id is None:
+        is_favorite = in_visitlist = literal(False)
+    else:
+        is_favorite = _membership(
+            favorite_locations_table, user_id, Location.id)
+        in_visitlist = _membership(
+            visitlist_locations_table, user_id, Location.id)
+
+    row = (db.session.query(Location,
+            is_favorite.label('is_favorite'),
+            in_visitlist.label('in_visitlist'))
+        .options(joinedload(Location.list), selectinload(Location.entries),
+            selectinload(Location.photos))
+        .filter(Location.id == location_id)
+        .first())
+    if row is None:
+        return None, False, False
+    return row.Location, bool(row.is_favorite), bool(row.in_visitlist)
+
+def get_location_state(location_id, user_id=None):
+    """
+    The cheap per-request facts about a location: (version, updated_at,
+    is_favorite, in_visitlist) from a single primary key lookup, or None if
+    there is no such location.
+    """
+    if user_id is None:
+        is_favorite = in_visitlist = literal(False)
+    else:
+        is_favorite = _membership(
+            favorite_locations_table, user_id, Location.id)
+        in_visitlist = _membership(
+            visitlist_locations_table, user_id, Location.id)
+
+    row = (db.session.query(Location.version, Location.updated_at,
+            is_favorite.label('is_favorite'),
+            in_visitlist.label('in_visitlist'))
+        .filter(Location.id == location_id)
+        .first())
+    if row is None:
+        return None
+    return (row.version, row.updated_at, bool(row.is_favorite),
+        bool(row.in_visitlist))
+
+###########################
+# Favorites & visitlist
+###########################
+
+def has_location(table, user_id, location_id):
+    """Whether the association `table` links the user to the location.
+    Answered from the (user_id, location_id) index alone."""
+    return db.session.query(
+        _membership(table, user_id, location_id)).scalar()
+
+def add_location(table, user_id, location_id):
+    """Link the user to the location in the association `table`."""
+    db.session.execute(
+        table.insert().values(user_id=user_id, location_id=location_id))
+
+def remove_location(table, user_id, location_id):
+    """Unlink the user from the location, returning the rows removed."""
+    result = db.session.execute(table.delete().where(
+        (table.c.user_id == user_id) & (table.c.location_id == location_id)))
+    return result.rowcount
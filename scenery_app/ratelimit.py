@@ -0,0 +1,137 @@
+"""
+Per-endpoint rate limits.
+
+RATELIMITS maps an endpoint to the limits it enforces, one per scope:
+
+    'auth.login': {'ip': '20/minute', 'username': '5/minute'}
+
+Scopes are 'ip' (the client address), 'username' (the submitted form
+field, so one account can't be hammered from many addresses) and 'user'
+(the logged in user). By default only writes are limited; add 'methods':
+['GET'] to limit reads too.
+
+Each (endpoint, scope, value) has a token bucket that holds the limit's
+count and refills evenly over its period, so short bursts are fine but a
+sustained rate above the limit is not. The check runs before the view,
+with no database or bcrypt work, and rejects with 429 and Retry-After.
+Buckets live in RATELIMIT_STORAGE_URL (see kvstore.py): 'memory://'
+limits each worker separately, a sqlite:/// file or Redis shares them
+between every gunicorn worker.
+"""
+from collections import Counter
+from functools import lru_cache
+import math
+import threading
+
+from flask import current_app, request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+
+from scenery_app.instrumentation import metrics
+from scenery_app.kvstore import store_from_url
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+SCOPES = ('ip', 'username', 'user')
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+@lru_cache(maxsize=None)
+def parse_limit(limit):
+    """'5/minute' -> (5, 60): `count` requests per `seconds`."""
+    count, _, period = limit.partition('/')
+    if not count.isdigit() or int(count) < 1 or period not in PERIODS:
+        raise ValueError(f'Bad rate limit {limit!r}; expected e.g. 5/minute')
+    return int(count), PERIODS[period]
+
+class RateLimited(TooManyRequests):
+    """429 with a Retry-After header."""
+    def __init__(self, retry_after):
+        super().__init__(
+            f'Too many requests. Try again in {retry_after} seconds.')
+        self.retry_after = retry_after
+
+    def get_headers(self, environ=None):
+        return super().get_headers(environ) + [
+            ('Retry-After', str(self.retry_after))]
+
+def scope_value(scope):
+    """Who a request counts against in `scope`, or None to skip it."""
+    if scope == 'ip':
+        return request.remote_addr
+    if scope == 'username':
+        username = request.form.get('username', '').strip().lower()
+        return username[:80] or None
+    if scope == 'user':
+        return current_user.get_id() if current_user.is_authenticated else None
+    raise ValueError(f'Unknown rate limit scope {scope!r}')
+
+class RateLimiter(object):
+    """Checks the current request against its endpoint's limits."""
+    def __init__(self):
+        self.store = None
+        self._lock = threading.Lock()
+        self.rejected = Counter()
+
+    def _get_store(self):
+        if self.store is None:
+            with self._lock:
+                if self.store is None:
+                    self.store = store_from_url(
+                        current_app.config['RATELIMIT_STORAGE_URL'],
+                        'ratelimit')
+        return self.store
+
+    def hit(self, key, limit):
+        """Count one request against `key`; (allowed, retry_after)."""
+        count, seconds = parse_limit(limit)
+        return self._get_store().consume(key, count / seconds, count)
+
+    def check(self):
+        config = current_app.config
+        rules = config['RATELIMITS'].get(request.endpoint)
+        if (not config['RATELIMIT_ENABLED'] or not rules or
+                request.method not in rules.get('methods', WRITE_METHODS)):
+            return
+        for scope, limit in rules.items():
+            if scope == 'methods':
+                continue
+            value = scope_value(scope)
+            if value is None:
+                continue
+            try:
+                allowed, retry_after = self.hit(
+                    f'{request.endpoint}:{scope}:{value}', limit)
+            except Exception:
+                # An unreachable store shouldn't take logins down with it.
+                current_app.logger.exception('Rate limit check failed')
+                return
+            if not allowed:
+                with self._lock:
+                    self.rejected[f'{request.endpoint}:{scope}'] += 1
+                raise RateLimited(max(1, math.ceil(retry_after)))
+
+    def reset(self):
+        """Empty every bucket, e.g. between tests."""
+        if self.store is not None:
+            self.store.clear()
+        with self._lock:
+            self.rejected.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'rejected': dict(self.rejected)}
+
+limiter = RateLimiter()
+metrics.add_source('ratelimit', limiter.stats)
+
+def init_ratelimit(app):
+    """Check every request against RATELIMITS before its view runs."""
+    # Catch typos at startup rather than on the first matching request.
+    for endpoint, rules in app.config['RATELIMITS'].items():
+        for scope, limit in rules.items():
+            if scope == 'methods':
+                continue
+            if scope not in SCOPES:
+                raise ValueError(
+                    f'Unknown rate limit scope {scope!r} for {endpoint}')
+            parse_limit(limit)
+    app.before_request(limiter.check)
@@ -0,0 +1,376 @@
+"""
+"Where to head next" suggestions, precomputed into the Recommendation
+table so the homepage reads them with one indexed lookup.
+
+Two locations are similar when the same users favorite them (cosine over
+the user_location graph), when they share entries (cosine over
+location_entry) and, as a tie-breaker, when they have the same landscape.
+Each location keeps its top RECOMMENDATIONS_PER_OWNER neighbors. A user's
+suggestions add up the neighbors of their favorites, weighted towards the
+landscapes they favor most, leaving out what they already favorited.
+Users without suggestions see the most favorited locations.
+
+`flask recommend rebuild` recomputes everything with NumPy. In between,
+favoriting or editing a location queues a 'recommendations.refresh' job
+that recomputes just the locations and user involved.
+"""
+from collections import defaultdict
+
+import click
+import numpy as np
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy import and_, func, or_
+from sqlalchemy.orm import aliased
+
+from scenery_app.extensions import db
+from scenery_app.jobs import job, enqueue
+from scenery_app.models import (Location, Recommendation, UserStat,
+    favorite_locations_table, location_entry_table)
+
+FAVORITES_WEIGHT = 1.0
+ENTRIES_WEIGHT = 0.5
+LANDSCAPE_WEIGHT = 0.1
+# Users and entries linked to more locations than this say little about
+# any one pair, and would make the pair counts quadratic.
+MAX_GROUP_SIZE = 1000
+
+###########################
+# Scoring
+###########################
+
+def score_candidates(landscape, n_favorites, n_entries, candidates):
+    """
+    Similarity of one location to each of its candidates. `candidates`
+    has equal-length arrays: 'landscape', 'co_favorites' (users who
+    favorited both), 'favorites', 'co_entries' (entries both have) and
+    'entries'.
+    """
+    def cosine(shared, mine, theirs):
+        norm = np.sqrt(mine * theirs.astype(float))
+        return np.divide(shared, norm, out=np.zeros(len(shared)),
+            where=norm > 0)
+    return (FAVORITES_WEIGHT * cosine(candidates['co_favorites'],
+            n_favorites, candidates['favorites']) +
+        ENTRIES_WEIGHT * cosine(candidates['co_entries'], n_entries,
+            candidates['entries']) +
+        LANDSCAPE_WEIGHT * (candidates['landscape'] == landscape))
+
+def top_k(ids, scores, k):
+    """(ids, scores) of the k best positive scores, best first."""
+    keep = scores > 0
+    ids, scores = ids[keep], scores[keep]
+    if len(ids) > k:
+        best = np.argpartition(-scores, k - 1)[:k]
+        ids, scores = ids[best], scores[best]
+    # Highest score first, lowest id first among ties.
+    order = np.lexsort((ids, -scores))
+    return ids[order], scores[order]
+
+def score_user(favorites, neighbors, landscape_counts, landscape_of, k):
+    """
+    Rank suggestions for a user from the neighbor lists of their
+    `favorites`. `neighbors` maps a location id to (ids, scores) arrays,
+    `landscape_counts` maps landscape names to how many of the user's
+    favorites have it, and `landscape_of` gives candidates' landscapes.
+    """
+    lists = [neighbors[id] for id in favorites if id in neighbors]
+    if not lists:
+        return np.array([], int), np.array([])
+    ids = np.concatenate([ids for ids, _ in lists])
+    scores = np.concatenate([scores for _, scores in lists])
+    ids, inverse = np.unique(ids, return_inverse=True)
+    totals = np.zeros(len(ids))
+    np.add.at(totals, inverse, scores)
+    total_favorites = sum(landscape_counts.values()) or 1
+    affinity = np.array([landscape_counts.get(landscape_of.get(id), 0)
+        for id in ids.tolist()]) / total_favorites
+    totals *= 1 + affinity
+    totals[np.isin(ids, list(favorites))] = 0
+    return top_k(ids, totals, k)
+
+def _landscape_name(landscape):
+    return landscape.name if landscape is not None else None
+
+###########################
+# Storage
+###########################
+
+def _replace(owner_kind, owner_ids, ranked, delete=True):
+    """Replace the stored suggestions of some owners. `ranked` maps an
+    owner id to its (ids, scores)."""
+    owner_ids = list(owner_ids)
+    if delete and owner_ids:
+        Recommendation.query.filter(
+            Recommendation.owner_kind == owner_kind,
+            Recommendation.owner_id.in_(owner_ids)).delete(
+                synchronize_session=False)
+    rows = []
+    for owner_id in owner_ids:
+        ids, scores = ranked.get(owner_id, ((), ()))
+        rows.extend({'owner_kind': owner_kind, 'owner_id': owner_id,
+                'rank': rank, 'location_id': int(id), 'score': float(score)}
+            for rank, (id, score) in enumerate(zip(ids, scores)))
+    if rows:
+        db.session.execute(Recommendation.__table__.insert(), rows)
+
+def recommended_locations(user_id=None):
+    """
+    The (id, title) suggestions for a user, or the most favorited
+    locations for anonymous users and users without suggestions, read
+    together in one query on the Recommendation primary key.
+    """
+    owners = [and_(Recommendation.owner_kind == 'global',
+        Recommendation.owner_id == 0)]
+    if user_id is not None:
+        owners.append(and_(Recommendation.owner_kind == 'user',
+            Recommendation.owner_id == user_id))
+    rows = (db.session.query(Recommendation.owner_kind, Location.id,
+            Location.title)
+        .join(Location, Location.id == Recommendation.location_id)
+        .filter(or_(*owners))
+        .order_by(Recommendation.owner_kind.desc(), Recommendation.rank)
+        .all())
+    personal = [row for row in rows if row.owner_kind == 'user']
+    return personal or rows
+
+###########################
+# Full rebuild
+###########################
+
+def _pairs(groups, size):
+    """
+    Count how often two locations share a group (a user's favorites or an
+    entry's locations): returns (a, b, count) arrays over ordered pairs,
+    sorted by a, for locations indexed 0..size-1.
+    """
+    keys = []
+    for members in groups:
+        members = np.asarray(members)
+        if 1 < len(members) <= MAX_GROUP_SIZE:
+            a = np.repeat(members, len(members))
+            b = np.tile(members, len(members))
+            keys.append((a * size + b)[a != b])
+    if not keys:
+        empty = np.array([], int)
+        return empty, empty, empty
+    keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+    return keys // size, keys % size, counts
+
+def _grouped(query):
+    groups = defaultdict(list)
+    for group, location_id in query:
+        groups[group].append(location_id)
+    return groups
+
+def rebuild():
+    """Recompute every location's, user's and the global suggestions."""
+    k = current_app.config['RECOMMENDATIONS_PER_OWNER']
+    locations = db.session.query(Location.id, Location.landscape).all()
+    ids = np.array([row.id for row in locations], int)
+    landscape_of = {row.id: _landscape_name(row.landscape)
+        for row in locations}
+    landscapes = np.array([landscape_of[id] for id in ids.tolist()],
+        dtype=object)
+    index = {id: i for i, id in enumerate(ids.tolist())}
+
+    user_favorites = _grouped(db.session.query(
+        favorite_locations_table.c.user_id,
+        favorite_locations_table.c.location_id))
+    entry_locations = _grouped(db.session.query(
+        location_entry_table.c.entry_id, location_entry_table.c.location_id))
+
+    favorites = np.zeros(len(ids), int)
+    entries = np.zeros(len(ids), int)
+    for counts, groups in ((favorites, user_favorites),
+            (entries, entry_locations)):
+        for members in groups.values():
+            for id in members:
+                counts[index[id]] += 1
+
+    fav_a, fav_b, fav_n = _pairs(([index[id] for id in members]
+        for members in user_favorites.values()), len(ids))
+    tag_a, tag_b, tag_n = _pairs(([index[id] for id in members]
+        for members in entry_locations.values()), len(ids))
+    fav_start = np.searchsorted(fav_a, np.arange(len(ids) + 1))
+    tag_start = np.searchsorted(tag_a, np.arange(len(ids) + 1))
+
+    neighbors = {}
+    for i, id in enumerate(ids.tolist()):
+        fav_ids = fav_b[fav_start[i]:fav_start[i + 1]]
+        tag_ids = tag_b[tag_start[i]:tag_start[i + 1]]
+        candidates = np.union1d(fav_ids, tag_ids)
+        if not len(candidates):
+            continue
+        co_favorites = np.zeros(len(candidates), int)
+        co_favorites[np.searchsorted(candidates, fav_ids)] = (
+            fav_n[fav_start[i]:fav_start[i + 1]])
+        co_entries = np.zeros(len(candidates), int)
+        co_entries[np.searchsorted(candidates, tag_ids)] = (
+            tag_n[tag_start[i]:tag_start[i + 1]])
+        scores = score_candidates(landscapes[i], favorites[i], entries[i], {
+            'landscape': landscapes[candidates],
+            'co_favorites': co_favorites, 'favorites': favorites[candidates],
+            'co_entries': co_entries, 'entries': entries[candidates]})
+        best, best_scores = top_k(candidates, scores, k)
+        neighbors[id] = (ids[best], best_scores)
+
+    user_landscapes = defaultdict(dict)
+    for user_id, stat, count in (db.session.query(UserStat.user_id,
+            UserStat.stat, UserStat.count)
+            .filter(UserStat.stat.like('landscape:%'))):
+        user_landscapes[user_id][stat.partition(':')[2]] = count
+
+    Recommendation.query.delete()
+    _replace('location', neighbors, neighbors, delete=False)
+    _replace('user', user_favorites, {user_id: score_user(set(members),
+            neighbors, user_landscapes[user_id], landscape_of, k)
+        for user_id, members in user_favorites.items()}, delete=False)
+    popular = top_k(ids, favorites.astype(float), k)
+    _replace('global', [0], {0: popular}, delete=False)
+    db.session.commit()
+
+###########################
+# Incremental refresh
+###########################
+
+def _score_location(location_id):
+    """
+    Score one location against every location it shares a user or an
+    entry with, using a few aggregate queries. Returns (ids, scores)
+    arrays, or None if there is no such location.
+    """
+    location = (db.session.query(Location.landscape)
+        .filter(Location.id == location_id).first())
+    if location is None:
+        return None
+    fav, other = favorite_locations_table, aliased(favorite_locations_table)
+    tag, other_tag = location_entry_table, aliased(location_entry_table)
+    co_favorites = dict(db.session.query(other.c.location_id, func.count())
+        .join(fav, fav.c.user_id == other.c.user_id)
+        .filter(fav.c.location_id == location_id,
+            other.c.location_id != location_id)
+        .group_by(other.c.location_id))
+    co_entries = dict(db.session.query(other_tag.c.location_id, func.count())
+        .join(tag, tag.c.entry_id == other_tag.c.entry_id)
+        .filter(tag.c.location_id == location_id,
+            other_tag.c.location_id != location_id)
+        .group_by(other_tag.c.location_id))
+    candidates = sorted(set(co_favorites) | set(co_entries))
+    if not candidates:
+        return np.array([], int), np.array([])
+    def counts(table):
+        return dict(db.session.query(table.c.location_id, func.count())
+            .filter(table.c.location_id.in_(candidates + [location_id]))
+            .group_by(table.c.location_id))
+    favorites, entries = counts(fav), counts(tag)
+    landscape_of = dict(db.session.query(Location.id, Location.landscape)
+        .filter(Location.id.in_(candidates)))
+    ids = np.array(candidates, int)
+    return ids, score_candidates(_landscape_name(location.landscape),
+        favorites.get(location_id, 0), entries.get(location_id, 0), {
+            'landscape': np.array([_landscape_name(landscape_of[id])
+                for id in candidates], dtype=object),
+            'co_favorites': np.array(
+                [co_favorites.get(id, 0) for id in candidates]),
+            'favorites': np.array(
+                [favorites.get(id, 0) for id in candidates]),
+            'co_entries': np.array(
+                [co_entries.get(id, 0) for id in candidates]),
+            'entries': np.array(
+                [entries.get(id, 0) for id in candidates])})
+
+def refresh_location(location_id, k, related=()):
+    """
+    Recompute one location's neighbors. Similarity is symmetric, so the
+    same scores also update this location's entry in the stored lists of
+    the `related` locations, without rescoring those from scratch. Their
+    other neighbors keep their scores until the next full rebuild.
+    """
+    scored = _score_location(location_id)
+    if scored is None:
+        return
+    ids, scores = scored
+    _replace('location', [location_id],
+        {location_id: top_k(ids, scores, k)})
+    related = [id for id in related if id != location_id]
+    if not related:
+        return
+    score_of = dict(zip(ids.tolist(), scores.tolist()))
+    lists = defaultdict(dict)
+    for owner_id, neighbor_id, score in (db.session.query(
+            Recommendation.owner_id, Recommendation.location_id,
+            Recommendation.score)
+            .filter(Recommendation.owner_kind == 'location',
+                Recommendation.owner_id.in_(related))):
+        lists[owner_id][neighbor_id] = score
+    ranked = {}
+    for owner_id in related:
+        neighbors = lists[owner_id]
+        neighbors[location_id] = score_of.get(owner_id, 0.0)
+        ranked[owner_id] = top_k(np.array(list(neighbors), int),
+            np.array(list(neighbors.values())), k)
+    _replace('location', related, ranked)
+
+def refresh_user(user_id, k):
+    """Recompute a user's suggestions from the stored location neighbors."""
+    favorites = {id for (id,) in db.session.query(
+        favorite_locations_table.c.location_id)
+        .filter(favorite_locations_table.c.user_id == user_id)}
+    neighbors = defaultdict(lambda: ([], []))
+    landscape_of = {}
+    if favorites:
+        rows = (db.session.query(Recommendation.owner_id,
+                Recommendation.location_id, Recommendation.score,
+                Location.landscape)
+            .join(Location, Location.id == Recommendation.location_id)
+            .filter(Recommendation.owner_kind == 'location',
+                Recommendation.owner_id.in_(favorites)))
+        for owner_id, location_id, score, landscape in rows:
+            neighbors[owner_id][0].append(location_id)
+            neighbors[owner_id][1].append(score)
+            landscape_of[location_id] = _landscape_name(landscape)
+    neighbors = {id: (np.array(ids, int), np.array(scores))
+        for id, (ids, scores) in neighbors.items()}
+    landscape_counts = {stat.partition(':')[2]: count
+        for stat, count in db.session.query(UserStat.stat, UserStat.count)
+            .filter(UserStat.user_id == user_id,
+                UserStat.stat.like('landscape:%'))}
+    _replace('user', [user_id], {user_id: score_user(favorites, neighbors,
+        landscape_counts, landscape_of, k)})
+
+@job('recommendations.refresh')
+def refresh(location_ids=(), user_id=None):
+    """Recompute the given locations' neighbors, then the user's
+    suggestions that are built from them."""
+    k = current_app.config['RECOMMENDATIONS_PER_OWNER']
+    related = ()
+    if user_id is not None and location_ids:
+        # A favorite changes its pair counts with everything else the
+        # user favorited, so those neighbor lists move too.
+        fav = favorite_locations_table
+        related = [id for (id,) in db.session.query(fav.c.location_id)
+            .filter(fav.c.user_id == user_id)
+            .order_by(fav.c.location_id.desc())
+            .limit(current_app.config['RECOMMENDATIONS_REFRESH_LIMIT'])]
+    for location_id in sorted(set(location_ids)):
+        refresh_location(location_id, k, related)
+    if user_id is not None:
+        refresh_user(user_id, k)
+
+def refresh_later(location_ids, user_id=None):
+    """Queue a refresh once the current transaction commits."""
+    enqueue('recommendations.refresh', location_ids=list(location_ids),
+        user_id=user_id)
+
+###########################
+# Commands
+###########################
+
+recommend_cli = AppGroup('recommend', help='Manage location suggestions.')
+
+@recommend_cli.command('rebuild')
+def rebuild_command():
+    """Recompute all suggestions from the favorites and entries."""
+    rebuild()
+    click.echo('Recommendations rebuilt.')
@@ -0,0 +1,88 @@
+"""
+Read-replica routing for the SQLAlchemy session.
+
+Endpoints decorated with `@read_only` send their GET queries to one of the
+SQLALCHEMY_REPLICA_URIS; everything else (and every flush) goes to the
+primary. After a request commits, the client's session is pinned to the
+primary for REPLICA_STICKY_SECONDS so they always read their own writes.
+"""
+from functools import wraps
+import random
+import threading
+import time
+
+from flask import g, has_request_context, request, session, current_app
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+
+from scenery_app.config import engine_options
+
+STICKY_KEY = '_primary_until'
+
+class RoutingSession(SignallingSession):
+    """Session that reads from a replica when the request allows it."""
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context() and \
+                g.get('use_replica'):
+            engine = self.db.replica_engine(self.app)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper, clause)
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension whose sessions are RoutingSessions."""
+    def __init__(self, *args, **kwargs):
+        self._replicas = {}
+        self._replicas_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(factory, 'after_commit', _mark_write)
+        return factory
+
+    def replica_engines(self, app):
+        """Engines for the configured replicas, created on first use."""
+        uris = tuple(app.config.get('SQLALCHEMY_REPLICA_URIS') or ())
+        with self._replicas_lock:
+            if uris not in self._replicas:
+                self._replicas[uris] = [
+                    create_engine(uri, **engine_options(uri)) for uri in uris]
+            return self._replicas[uris]
+
+    def replica_engine(self, app):
+        engines = self.replica_engines(app)
+        return random.choice(engines) if engines else None
+
+    def dispose_engines(self, app):
+        """Drop pooled connections, e.g. inherited across a fork."""
+        self.get_engine(app).dispose()
+        for engine in self.replica_engines(app):
+            engine.dispose()
+
+def _mark_write(session):
+    if has_request_context():
+        g.wrote = True
+
+def read_only(view):
+    """Let GET/HEAD requests to `view` read from a replica, unless the
+    client wrote something recently."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method in ('GET', 'HEAD') and \
+                session.get(STICKY_KEY, 0) < time.time():
+            g.use_replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+def init_routing(app):
+    @app.after_request
+    def _stick_to_primary(response):
+        if g.get('wrote') and app.config.get('SQLALCHEMY_REPLICA_URIS'):
+            session[STICKY_KEY] = (time.time() +
+                app.config['REPLICA_STICKY_SECONDS'])
+        return response
@@ -0,0 +1,191 @@
+"""
+Full-text search over location titles and entry names.
+
+SQLite databases get an FTS5 virtual table, PostgreSQL gets a table with a
+tsvector column behind a GIN index. Both are created alongside the model
+tables (or by `flask search rebuild` on an existing database) and kept in
+sync by 'search.index' jobs that the routes writing locations and entries
+queue.
+"""
+import re
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import event, text
+
+from scenery_app.extensions import app, db
+from scenery_app.models import Location, Entry
+from scenery_app.jobs import job, enqueue
+
+KINDS = ('location', 'entry')
+
+###########################
+# Backends
+###########################
+
+class SQLiteSearch(object):
+    """FTS5 index; the rowid packs (ref_id, kind) so upserts hit the PK."""
+    create = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+        "kind UNINDEXED, ref_id UNINDEXED, body, tokenize='unicode61')",
+    ]
+    drop = ["DROP TABLE IF EXISTS search_index"]
+
+    @staticmethod
+    def _rowid(kind, ref_id):
+        return ref_id * len(KINDS) + KINDS.index(kind)
+
+    def upsert(self, conn, kind, docs):
+        params = [{'rowid': self._rowid(kind, ref_id), 'kind': kind,
+            'ref_id': ref_id, 'body': body} for ref_id, body in docs]
+        conn.execute(text(
+            "DELETE FROM search_index WHERE rowid = :rowid"), params)
+        conn.execute(text(
+            "INSERT INTO search_index (rowid, kind, ref_id, body) "
+            "VALUES (:rowid, :kind, :ref_id, :body)"), params)
+
+    def query(self, conn, terms, limit, offset):
+        # Quote every term so user input can't inject FTS5 syntax, and
+        # prefix-match the last one so partial words still find results.
+        match = ' '.join(f'"{term}"' for term in terms) + '*'
+        return conn.execute(text(
+            "SELECT kind, ref_id, body FROM search_index "
+            "WHERE search_index MATCH :match "
+            "ORDER BY rank LIMIT :limit OFFSET :offset"),
+            {'match': match, 'limit': limit, 'offset': offset}).fetchall()
+
+class PostgresSearch(object):
+    """tsvector documents behind a GIN index."""
+    create = [
+        "CREATE TABLE IF NOT EXISTS search_index ("
+        "kind VARCHAR(16) NOT NULL, ref_id INTEGER NOT NULL, "
+        "body TEXT NOT NULL, document TSVECTOR NOT NULL, "
+        "PRIMARY KEY (kind, ref_id))",
+        "CREATE INDEX IF NOT EXISTS ix_search_index_document "
+        "ON search_index USING GIN (document)",
+    ]
+    drop = ["DROP TABLE IF EXISTS search_index"]
+
+    def upsert(self, conn, kind, docs):
+        params = [{'kind': kind, 'ref_id': ref_id, 'body': body,
+            'language': app.config['SEARCH_LANGUAGE']}
+            for ref_id, body in docs]
+        conn.execute(text(
+            "INSERT INTO search_index (kind, ref_id, body, document) "
+            "VALUES (:kind, :ref_id, :body, "
+            "to_tsvector(CAST(:language AS regconfig), :body)) "
+            "ON CONFLICT (kind, ref_id) DO UPDATE "
+            "SET body = EXCLUDED.body, document = EXCLUDED.document"),
+            params)
+
+    def query(self, conn, terms, limit, offset):
+        match = ' & '.join(terms) + ':*'
+        return conn.execute(text(
+            "SELECT kind, ref_id, body FROM search_index, "
+            "to_tsquery(CAST(:language AS regconfig), :match) query "
+            "WHERE document @@ query "
+            "ORDER BY ts_rank(document, query) DESC, ref_id "
+            "LIMIT :limit OFFSET :offset"),
+            {'match': match, 'limit': limit, 'offset': offset,
+             'language': app.config['SEARCH_LANGUAGE']}).fetchall()
+
+BACKENDS = {
+    'sqlite': SQLiteSearch(),
+    'postgresql': PostgresSearch(),
+}
+
+def get_backend(bind):
+    try:
+        return BACKENDS[bind.dialect.name]
+    except KeyError:
+        raise NotImplementedError(
+            f'Search is not supported on {bind.dialect.name}')
+
+@event.listens_for(db.metadata, 'after_create')
+def _create_search_index(target, connection, **kwargs):
+    for statement in get_backend(connection).create:
+        connection.execute(text(statement))
+
+@event.listens_for(db.metadata, 'before_drop')
+def _drop_search_index(target, connection, **kwargs):
+    for statement in get_backend(connection).drop:
+        connection.execute(text(statement))
+
+###########################
+# Indexing & querying
+###########################
+
+def index_documents(kind, docs):
+    """Add or replace (ref_id, body) documents in the current transaction."""
+    docs = list(docs)
+    if docs:
+        session = db.session
+        get_backend(session.get_bind()).upsert(session, kind, docs)
+
+@job('search.index')
+def reindex(kind, ids):
+    """Index the current text of some locations or entries."""
+    model, column = {
+        'location': (Location, Location.title),
+        'entry': (Entry, Entry.name),
+    }[kind]
+    index_documents(kind,
+        db.session.query(model.id, column).filter(model.id.in_(ids)))
+
+def index_later(kind, ids):
+    """Queue rows for indexing once the current transaction commits."""
+    if ids:
+        enqueue('search.index', kind=kind, ids=list(ids))
+
+def index_location(location):
+    """Queue a location for indexing; call after it has an id."""
+    index_later('location', [location.id])
+
+def index_entry(entry):
+    """Queue an entry for indexing; call after it has an id."""
+    index_later('entry', [entry.id])
+
+def search(q, page=1, per_page=25):
+    """
+    Return (results, has_next) for the best matches of `q` on the given
+    page. Each result is a dict with the kind, id and matched text.
+    """
+    terms = re.findall(r'\w+', q.lower())
+    if not terms:
+        return [], False
+    session = db.session
+    rows = get_backend(session.get_bind()).query(
+        session, terms, per_page + 1, (page - 1) * per_page)
+    results = [{'kind': row.kind, 'id': row.ref_id, 'text': row.body}
+        for row in rows[:per_page]]
+    return results, len(rows) > per_page
+
+def rebuild(batch_size=5000):
+    """Recreate the index from scratch and reindex every row."""
+    backend = get_backend(db.session.get_bind())
+    for statement in backend.drop + backend.create:
+        db.session.execute(text(statement))
+    for kind, query in (
+            ('location', db.session.query(Location.id, Location.title)),
+            ('entry', db.session.query(Entry.id, Entry.name))):
+        batch = []
+        for row in query.yield_per(batch_size):
+            batch.append(tuple(row))
+            if len(batch) == batch_size:
+                index_documents(kind, batch)
+                batch = []
+        index_documents(kind, batch)
+    db.session.commit()
+
+###########################
+# Commands
+###########################
+
+search_cli = AppGroup('search', help='Manage the full-text search index.')
+
+@search_cli.command('rebuild')
+@click.option('--batch-size', default=5000, show_default=True)
+def rebuild_command(batch_size):
+    """Recreate the search index and reindex all locations and entries."""
+    rebuild(batch_size)
+    click.echo('Search index rebuilt.')
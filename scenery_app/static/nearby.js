@@ -0,0 +1,26 @@
+// Fills <div data-nearby="..."> with the closest locations. It is loaded
+// separately so the rest of the location page can stay cached.
+document.querySelectorAll('[data-nearby]').forEach(function (panel) {
+    fetch(panel.dataset.nearby).then(function (response) {
+        return response.json();
+    }).then(function (data) {
+        if (!data.results.length) {
+            return;
+        }
+        var heading = document.createElement('strong');
+        heading.textContent = 'Nearby';
+        var list = document.createElement('ul');
+        data.results.forEach(function (result) {
+            var link = document.createElement('a');
+            link.href = '/location/' + result.id;
+            link.textContent = result.title;
+            var item = document.createElement('li');
+            item.appendChild(link);
+            item.appendChild(document.createTextNode(
+                ' (' + result.distance_km.toFixed(1) + ' km)'));
+            list.appendChild(item);
+        });
+        panel.appendChild(heading);
+        panel.appendChild(list);
+    });
+});
@@ -0,0 +1,31 @@
+// Adds a search box to <select data-typeahead="..."> fields whose tables
+// are too large to list in full. Selected options are kept; the rest are
+// replaced with the search results as the user types.
+document.querySelectorAll('select[data-typeahead]').forEach(function (select) {
+    var input = document.createElement('input');
+    input.type = 'search';
+    input.placeholder = 'Search...';
+    select.parentNode.insertBefore(input, select);
+
+    var timer = null;
+    input.addEventListener('input', function () {
+        clearTimeout(timer);
+        timer = setTimeout(function () {
+            var url = select.dataset.typeahead + '?q=' + encodeURIComponent(input.value);
+            fetch(url).then(function (response) {
+                return response.json();
+            }).then(function (data) {
+                Array.from(select.options).forEach(function (option) {
+                    if (!option.selected) {
+                        option.remove();
+                    }
+                });
+                data.results.forEach(function (result) {
+                    if (!select.querySelector('option[value="' + result.id + '"]')) {
+                        select.add(new Option(result.label, result.id));
+                    }
+                });
+            });
+        }, 200);
+    });
+});
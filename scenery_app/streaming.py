@@ -0,0 +1,49 @@
+"""
+Streamed page rendering.
+
+`stream_template()` returns a response whose body is rendered while it
+is sent: the page header goes out before the list queries feeding the
+rest (see pagination.KeysetStream) have run, and only one chunk of HTML
+is held at a time. The request context stays open until the last chunk.
+
+Headers are sent before the body is rendered, so anything that writes
+to the session must happen first; flashed messages are popped up front.
+An error part way through can only cut the page short, so streamed
+views should do whatever might fail (404s, permissions) before
+returning.
+
+A streamed body holds its request context until it has been read to the
+end, as a WSGI server always does; `app.test_client()` is a
+BufferedClient so tests and the benchmark do the same.
+"""
+from flask import current_app, get_flashed_messages, stream_with_context
+from flask.testing import FlaskClient
+
+def chunked(pieces, size):
+    """Join rendered pieces into chunks of at least `size` characters."""
+    buffer, length = [], 0
+    for piece in pieces:
+        buffer.append(piece)
+        length += len(piece)
+        if length >= size:
+            yield ''.join(buffer)
+            buffer, length = [], 0
+    if buffer:
+        yield ''.join(buffer)
+
+def stream_template(template_name, **context):
+    """Render `template_name` as a streamed text/html response."""
+    app = current_app._get_current_object()
+    get_flashed_messages()
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(template_name)
+    body = chunked(template.generate(context),
+        app.config['STREAM_CHUNK_BYTES'])
+    return app.response_class(stream_with_context(body),
+        mimetype='text/html')
+
+class BufferedClient(FlaskClient):
+    """Test client that reads every response in full before returning it."""
+    def open(self, *args, **kwargs):
+        kwargs.setdefault('buffered', True)
+        return super().open(*args, **kwargs)
@@ -0,0 +1,21 @@
+"""
+Helpers shared by the test suites in scenery_app/*/tests.py.
+"""
+from scenery_app.extensions import bcrypt, db
+from scenery_app.models import User
+
+def login(client, username, password):
+    return client.post('/login', data=dict(
+        username=username,
+        password=password
+    ), follow_redirects=True)
+
+def logout(client):
+    return client.get('/logout', follow_redirects=True)
+
+def create_user():
+    # Creates a user with username 'me1' and password of 'password'
+    password_hash = bcrypt.generate_password_hash('password').decode('utf-8')
+    user = User(username='me1', password=password_hash)
+    db.session.add(user)
+    db.session.commit()
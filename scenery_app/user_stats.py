@@ -0,0 +1,149 @@
+"""
+Denormalized per-user totals shown in the profile header.
+
+Each user has a UserStat row per stat:
+
+    favorites           locations in user_location
+    visited             favorites that have a visited date
+    planned             locations in user_visitlist
+    landscape:<NAME>    favorites per landscape
+
+The routes that change a user's collections, or the landscape and date
+of a favorited location, adjust the rows before committing, so reading
+the header is a single primary key range scan instead of COUNT(*)s over
+the association tables.
+"""
+from collections import Counter
+from datetime import datetime
+
+import click
+from flask.cli import AppGroup
+from sqlalchemy import and_, exists, func, literal, select
+
+from scenery_app.counters import add_counts
+from scenery_app.extensions import db
+from scenery_app.facets import landscape_name
+from scenery_app.models import (Location, User, UserStat,
+    favorite_locations_table, visitlist_locations_table)
+
+def location_stats(table, landscape, visited_date):
+    """The stats a location with these attributes counts towards when it
+    is in `table` (favorites or visitlist)."""
+    if table is visitlist_locations_table:
+        return ['planned']
+    stats = ['favorites']
+    if visited_date is not None:
+        stats.append('visited')
+    if landscape is not None:
+        stats.append(f'landscape:{landscape_name(landscape)}')
+    return stats
+
+###########################
+# Maintaining the counts
+###########################
+
+def adjust_stats(deltas):
+    """Apply a {(user_id, stat): delta} mapping in the current transaction."""
+    add_counts(UserStat.__table__, deltas)
+
+def links_changed(table, links, delta):
+    """
+    Count a batch of {'user_id', 'location_id'} rows added to (+1) or
+    removed from (-1) the favorites or visitlist `table`.
+    """
+    location_ids = {link['location_id'] for link in links}
+    attributes = {row.id: (row.landscape, row.visited_date)
+        for row in db.session.query(Location.id, Location.landscape,
+            Location.visited_date).filter(Location.id.in_(location_ids))}
+    deltas = Counter()
+    for link in links:
+        for stat in location_stats(table, *attributes[link['location_id']]):
+            deltas[(link['user_id'], stat)] += delta
+    adjust_stats(deltas)
+    # Their profile pages changed too.
+    User.query.filter(User.id.in_({link['user_id'] for link in links})).update(
+        {User.updated_at: datetime.utcnow()}, synchronize_session=False)
+
+def collection_changed(table, user_id, location_id, delta):
+    """Count one location added to (+1) or removed from (-1) a collection."""
+    links_changed(table,
+        [{'user_id': user_id, 'location_id': int(location_id)}], delta)
+
+def _adjust_favoriters(location_id, stat, delta):
+    """Adjust one stat for everyone who has favorited a location."""
+    favoriters = select([favorite_locations_table.c.user_id]).where(
+        favorite_locations_table.c.location_id == location_id)
+    if delta > 0:
+        missing = favoriters.column(literal(stat)).column(literal(0)).where(
+            ~exists().where(and_(
+                UserStat.user_id == favorite_locations_table.c.user_id,
+                UserStat.stat == stat)))
+        db.session.execute(UserStat.__table__.insert().from_select(
+            ['user_id', 'stat', 'count'], missing))
+    (UserStat.query
+        .filter(UserStat.stat == stat, UserStat.user_id.in_(favoriters))
+        .update({UserStat.count: UserStat.count + delta},
+            synchronize_session=False))
+
+def favorited_location_changed(before, location):
+    """
+    Move everyone who favorited `location` between stats after an edit.
+    `before` is the (landscape, visited_date) captured before the form was
+    applied.
+    """
+    deltas = Counter(location_stats(favorite_locations_table,
+        location.landscape, location.visited_date))
+    deltas.subtract(Counter(location_stats(favorite_locations_table,
+        *before)))
+    for stat, delta in deltas.items():
+        if delta:
+            _adjust_favoriters(location.id, stat, delta)
+    db.session.flush()
+
+def rebuild():
+    """Recount every user's stats from the association tables."""
+    UserStat.query.delete()
+    deltas = Counter()
+    for table in (favorite_locations_table, visitlist_locations_table):
+        rows = (db.session.query(table.c.user_id, Location.landscape,
+                Location.visited_date.isnot(None), func.count())
+            .join(Location, Location.id == table.c.location_id)
+            .group_by(table.c.user_id, Location.landscape,
+                Location.visited_date.isnot(None)))
+        for user_id, landscape, has_date, count in rows:
+            visited_date = True if has_date else None
+            for stat in location_stats(table, landscape, visited_date):
+                deltas[(user_id, stat)] += count
+    adjust_stats(deltas)
+    db.session.commit()
+
+###########################
+# Reading
+###########################
+
+def user_stats(user_id):
+    """
+    Return {'favorites': n, 'visited': n, 'planned': n,
+    'landscapes': {name: n}} for the profile header.
+    """
+    stats = {'favorites': 0, 'visited': 0, 'planned': 0, 'landscapes': {}}
+    for stat, count in (db.session.query(UserStat.stat, UserStat.count)
+            .filter(UserStat.user_id == user_id)):
+        if stat.startswith('landscape:'):
+            if count:
+                stats['landscapes'][stat.partition(':')[2]] = count
+        else:
+            stats[stat] = count
+    return stats
+
+###########################
+# Commands
+###########################
+
+stats_cli = AppGroup('stats', help='Manage the per-user profile totals.')
+
+@stats_cli.command('rebuild')
+def rebuild_command():
+    """Recount every user's favorites and visitlist totals from scratch."""
+    rebuild()
+    click.echo('User stats rebuilt.')